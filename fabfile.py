@@ -59,6 +59,7 @@ from fabgis.dropbox import (
     start_dropbox,
     stop_dropbox)
 from fabgis.system import create_user
+from fabgis.common import execute_parallel
 from fabgis.docker import (
     setup_docker, setup_docker_image, docker, create_docker_container)
 # You can also make generic tasks available at the command line simply by
@@ -100,6 +101,18 @@ def build_server():
     install_qgis2(gdal_from_source=True)
 
 
+@task
+def build_servers(pool_size=5):
+    """Build several servers at once, e.g.::
+
+        fab -H foo,bar,baz build_servers:pool_size=3
+
+    Output is prefixed with the host name and a summary of the result for
+    each host is printed at the end.
+    """
+    execute_parallel(build_server, pool_size=int(pool_size))
+
+
 @task
 @hosts('192.168.1.1:22')
 def get_gis_dump():
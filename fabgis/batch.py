@@ -0,0 +1,185 @@
+# coding=utf-8
+"""Run a sequence of remote commands in a single round trip.
+
+Many tasks issue a long list of independent ``run`` / ``sudo`` calls, each
+of which costs a full SSH exec. A :class:`CommandBatch` collects such
+commands and sends them to the host as one generated shell script, e.g.::
+
+    from fabgis.batch import command_batch
+
+    with command_batch(use_sudo=True) as batch:
+        batch.add('ufw default deny incoming')
+        batch.add('ufw default allow outgoing')
+        batch.add('ufw allow http')
+
+    for result in batch.results:
+        print result.command, result.return_code
+
+The commands are executed when the ``with`` block is left. Every command
+runs in its own subshell so, as with separate ``run`` calls, a ``cd`` or an
+``exit`` in one command does not affect the next. Failures behave as they
+would for sequential calls: execution stops at the first command that
+fails and the task is aborted, unless ``env.warn_only`` is set in which
+case a warning is shown and the remaining commands are still run.
+"""
+import uuid
+from fabric.api import env, run, sudo, hide, settings
+from fabric.operations import _AttributeString
+from fabric.state import output
+from fabric.utils import abort, puts, warn
+
+
+class CommandBatch(object):
+    """Collect remote commands and execute them in one SSH exec."""
+
+    def __init__(self, use_sudo=False, user=None):
+        """Constructor.
+
+        :param use_sudo: Run the batch with sudo rather than run.
+        :type use_sudo: bool
+
+        :param user: User to run the batch as when using sudo.
+        :type user: str
+        """
+        self.use_sudo = use_sudo
+        self.user = user
+        self.commands = []
+        self.results = []
+        self.marker = '__fabgis_batch_%s' % uuid.uuid4().hex[:8]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Commands queued before an exception in the with block would have
+        # been run already when executed sequentially, so run them now.
+        self.execute()
+        return False
+
+    def add(self, command):
+        """Queue a command for execution.
+
+        :param command: Shell command to run on the host.
+        :type command: str
+
+        :returns: Index of the command's result in :attr:`results` once the
+            batch has been executed.
+        :rtype: int
+        """
+        self.commands.append(command)
+        return len(self.results) + len(self.commands) - 1
+
+    def script(self, warn_only=False):
+        """Build the shell script that runs all queued commands.
+
+        :param warn_only: Whether the script should carry on after a failed
+            command rather than stopping.
+        :type warn_only: bool
+
+        :returns: Shell script printing a start and an end marker, including
+            the exit code, around the output of each command.
+        :rtype: str
+        """
+        lines = []
+        for index, command in enumerate(self.commands):
+            lines.append('echo %s_start_%i' % (self.marker, index))
+            lines.append('(\n%s\n) 2>&1' % command)
+            lines.append('code=$?')
+            lines.append('echo')
+            lines.append('echo %s_end_%i_$code' % (self.marker, index))
+            if not warn_only:
+                lines.append('[ $code -eq 0 ] || exit $code')
+        lines.append('exit 0')
+        return '\n'.join(lines)
+
+    def parse(self, text):
+        """Split the output of :meth:`script` into per command results.
+
+        :param text: Output of the batch script.
+        :type text: str
+
+        :returns: One result per command that was run, in order. Each result
+            is a string with the ``command``, ``return_code``, ``failed``
+            and ``succeeded`` attributes set, like the result of ``run``.
+        :rtype: list
+        """
+        results = []
+        lines = None
+        for line in text.splitlines():
+            stripped = line.strip()
+            if stripped.startswith('%s_start_' % self.marker):
+                lines = []
+            elif stripped.startswith('%s_end_' % self.marker):
+                index, code = stripped.split('_')[-2:]
+                # Drop the newline we added to terminate the output
+                if lines and not lines[-1].strip():
+                    lines.pop()
+                result = _AttributeString('\n'.join(lines))
+                result.command = self.commands[int(index)]
+                result.real_command = result.command
+                result.return_code = int(code)
+                result.failed = result.return_code != 0
+                result.succeeded = not result.failed
+                result.stderr = ''
+                results.append(result)
+                lines = None
+            elif lines is not None:
+                lines.append(line)
+        return results
+
+    def execute(self):
+        """Execute all queued commands in a single remote command.
+
+        :returns: The results of the commands that were run.
+        :rtype: list
+        """
+        if not self.commands:
+            return []
+        warn_only = env.warn_only
+        name = 'sudo' if self.use_sudo else 'run'
+        with hide('running', 'output', 'warnings'), settings(warn_only=True):
+            if self.use_sudo:
+                text = sudo(self.script(warn_only), user=self.user)
+            else:
+                text = run(self.script(warn_only))
+        results = self.parse(text)
+        self.results.extend(results)
+        for result in results:
+            # puts adds the [host] prefix as fabric's own output does
+            if output.running:
+                puts('%s (batch): %s' % (name, result.command))
+            if output.stdout and result:
+                for line in result.splitlines():
+                    puts('out: %s' % line)
+        commands = self.commands
+        self.commands = []
+        failed = [result for result in results if result.failed]
+        if not failed and len(results) < len(commands):
+            # The script died without reporting on all commands
+            abort('%s() batch stopped unexpectedly after %i of %i commands:'
+                  '\n\n%s' % (name, len(results), len(commands), text))
+        for result in failed:
+            message = (
+                '%s() received nonzero return code %s while executing!'
+                '\n\nRequested: %s' % (
+                    name, result.return_code, result.command))
+            if warn_only:
+                warn(message)
+            else:
+                abort(message)
+        return results
+
+
+def command_batch(use_sudo=False, user=None):
+    """Create a :class:`CommandBatch` to use as a context manager.
+
+    :param use_sudo: Run the batch with sudo rather than run.
+    :type use_sudo: bool
+
+    :param user: User to run the batch as when using sudo.
+    :type user: str
+
+    :returns: A new, empty batch.
+    :rtype: CommandBatch
+    """
+    return CommandBatch(use_sudo=use_sudo, user=user)
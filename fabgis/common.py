@@ -1,9 +1,15 @@
 # coding=utf-8
-"""Common helpers to bootstrap fabric."""
+"""Common helpers to bootstrap fabric.
+
+The fabgis environment (``env.fg``) is kept per host so that tasks can be run
+against several hosts, including in parallel (see :func:`execute_parallel`).
+"""
 import os
-from fabric.api import env, task, fastprint, run, hide
+from fabric.api import env, task, fastprint, hide, settings, execute
+from fabric.colors import green, red
 from fabric.utils import _AttributeDict as fdict
-import fabtools
+from .facts import get_facts
+from .packages import require_ppas
 
 
 #TODO Not really used, but potentially useful
@@ -18,6 +24,8 @@ env.roledefs = {
 #if os.path.exists('~/.ssh/config'):
 env.use_ssh_config = True
 env.fg = None
+# fabgis environments keyed by env.host_string
+env.fg_hosts = {}
 
 
 def show_environment():
@@ -25,25 +33,37 @@ def show_environment():
     setup_env()
     fastprint('\n-------------------------------------------------\n')
     for key, value in env.fg.iteritems():
+        if key == 'facts':
+            continue
         fastprint('Key: %s \t\t Value: %s\n' % (key, value))
+    for key, value in env.fg.facts.iteritems():
+        if key == 'packages':
+            value = '%i installed' % len(value)
+        fastprint('Fact: %s \t\t Value: %s\n' % (key, value))
     fastprint('-------------------------------------------------\n')
 
 
 def setup_env():
-    """Things to do regardless of whether command is local or remote."""
-    if env.fg is not None:
+    """Things to do regardless of whether command is local or remote.
+
+    The environment is set up once per host and stored in ``env.fg_hosts``.
+    Every call points ``env.fg`` at the environment of the current host so
+    that a task running against several hosts never sees the user and paths
+    of the previous host.
+    """
+    if env.host_string in env.fg_hosts:
+        env.fg = env.fg_hosts[env.host_string]
         fastprint('Environment already set!\n')
         return
 
-    fastprint('Setting environment!\n')
+    fastprint('Setting environment for %s!\n' % env.host_string)
     env.fg = fdict()
+    env.fg_hosts[env.host_string] = env.fg
     with hide('output'):
-        env.fg.user = run('whoami')
-        # Workaround for
-        env.fg.hostname = run('hostname')
-        # this which fails in docker - see
-        # https://github.com/dotcloud/docker/issues/1301
-        #env.fg.hostname = fabtools.system.get_hostname()
+        # One round trip for everything we need to know about the host
+        env.fg.facts = get_facts()
+        env.fg.user = env.fg.facts.user
+        env.fg.hostname = env.fg.facts.hostname
         env.fg.home = os.path.join('/home/', env.fg.user)
         env.fg.workspace = os.path.join(env.fg.home, 'dev')
         env.fg.inasafe_git_url = 'git://github.com/AIFDR/inasafe.git'
@@ -60,11 +80,70 @@ def setup_env():
             env.fg.workspace, env.fg.qgis_checkout_alias)
 
 
+def execute_parallel(task_function, *args, **kwargs):
+    """Run a task against all hosts in parallel and report each host's result.
+
+    Output lines are prefixed with the host they came from. Unlike a plain
+    ``execute`` in parallel mode, a failure on one host does not hide the
+    results of the others - the exception is returned as that host's result
+    and all results are summarised once every host has finished.
+
+    Tasks decorated with ``@serial`` (e.g. tasks that prompt for input) are
+    still run one host at a time.
+
+    :param task_function: The task to run e.g.
+        :func:`fabgis.postgres.setup_postgis_2`.
+    :type task_function: callable
+
+    :param args: Positional arguments to pass to the task.
+
+    :param kwargs: Keyword arguments to pass to the task. A ``pool_size``
+        keyword may be given to limit the number of hosts handled at once,
+        otherwise ``env.pool_size`` is used.
+
+    :returns: A dictionary of results (or exceptions) keyed by host string.
+    :rtype: dict
+
+    Example usage in a fabfile::
+
+        @task
+        def build_servers():
+            execute_parallel(setup_postgis_2, pool_size=5)
+
+    """
+    pool_size = kwargs.pop('pool_size', None) or env.pool_size
+
+    def collect_result(*task_args, **task_kwargs):
+        """Run the task, returning any failure rather than raising it."""
+        try:
+            return task_function(*task_args, **task_kwargs)
+        except (Exception, SystemExit), e:
+            return e
+
+    collect_result.serial = getattr(task_function, 'serial', False)
+    with settings(parallel=True, linewise=True, pool_size=pool_size):
+        results = execute(collect_result, *args, **kwargs)
+    report_results(results)
+    return results
+
+
+def report_results(results):
+    """Print a summary of per host results as returned by execute.
+
+    :param results: Results keyed by host string. Exceptions are reported
+        as failures.
+    :type results: dict
+    """
+    fastprint('\n-------------------------------------------------\n')
+    for host, result in sorted(results.items()):
+        if isinstance(result, BaseException):
+            fastprint(red('%s: FAILED %s\n' % (host, result)))
+        else:
+            fastprint(green('%s: OK %s\n' % (host, result)))
+    fastprint('-------------------------------------------------\n')
+
+
 @task
 def add_ubuntugis_ppa():
     """Ensure we have ubuntu-gis repo."""
-    fabtools.deb.update_index(quiet=True)
-    fabtools.require.deb.package('software-properties-common')
-    fabtools.require.deb.ppa(
-        #'ppa:ubuntugis/ubuntugis-unstable', auto_yes=True)
-        'ppa:ubuntugis/ubuntugis-unstable')
+    require_ppas(['ubuntugis'])
@@ -0,0 +1,440 @@
+# coding=utf-8
+"""Content addressed, deduplicating store for database dumps.
+
+Nightly dumps of a database are mostly identical from one night to the
+next. Rather than keeping every dump in full, a :class:`ChunkStore` splits
+each dump into chunks at content defined boundaries, stores every distinct
+chunk once (compressed, in pack files) and records each dump as a snapshot
+listing its chunks. Six months of nightly dumps then take little more
+space than a single dump plus the daily changes.
+
+Chunk boundaries are anchored at line ends: a chunk ends after a line whose
+crc32 matches a bit mask, once the chunk has reached a minimum size, or
+when it reaches a maximum size. An insert or delete therefore only changes
+the chunks around it, and the rows of plain ``COPY`` data in a dump make
+good anchors. Dumps should be made without compression (``pg_dump -Fc -Z
+0``) since compressed output changes completely after a small change. The
+store compresses the chunks itself.
+
+Layout of a store directory::
+
+    packs/<id>.pack     compressed chunks, one after the other
+    packs/<id>.idx      json index of the chunks in the pack
+    snapshots/<id>.json name, date, size, checksum and chunk list
+
+This module only uses the standard library so that it can also be copied
+to a host and run there as a script, e.g.::
+
+    python dedup.py ~/sql_backups/store ingest PG_gis.dmp gis
+    python dedup.py ~/sql_backups/store list
+    python dedup.py ~/sql_backups/store restore <snapshot> gis.dmp
+    python dedup.py ~/sql_backups/store prune 180
+    python dedup.py ~/sql_backups/store gc
+    python dedup.py ~/sql_backups/store stats
+
+"""
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+import zlib
+
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# A line ends a chunk when the low bits of its crc32 are all zero, i.e. on
+# average after one in 8192 lines.
+BOUNDARY_MASK = 0x1fff
+PACK_SIZE = 64 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+
+
+def iter_chunks(stream):
+    """Split a stream into content defined chunks.
+
+    :param stream: File like object opened in binary mode.
+    :type stream: file
+
+    :returns: A generator yielding the chunks as byte strings.
+    :rtype: generator
+    """
+    chunk = []
+    chunk_size = 0
+    pending = b''
+    while True:
+        block = stream.read(READ_SIZE)
+        data = pending + block
+        start = 0
+        while True:
+            end = data.find(b'\n', start)
+            if end == -1:
+                break
+            line = data[start:end + 1]
+            start = end + 1
+            chunk.append(line)
+            chunk_size += len(line)
+            if chunk_size >= MAX_CHUNK_SIZE or (
+                    chunk_size >= MIN_CHUNK_SIZE and
+                    zlib.crc32(line) & BOUNDARY_MASK == 0):
+                yield b''.join(chunk)
+                chunk = []
+                chunk_size = 0
+        pending = data[start:]
+        # Data without line ends (e.g. binary blobs) is cut at the maximum
+        while chunk_size + len(pending) >= MAX_CHUNK_SIZE:
+            cut = MAX_CHUNK_SIZE - chunk_size
+            chunk.append(pending[:cut])
+            pending = pending[cut:]
+            yield b''.join(chunk)
+            chunk = []
+            chunk_size = 0
+        if not block:
+            break
+    if pending:
+        chunk.append(pending)
+    if chunk:
+        yield b''.join(chunk)
+
+
+class ChunkStore(object):
+    """A deduplicating store of snapshots of files."""
+
+    def __init__(self, path):
+        """Constructor.
+
+        :param path: Directory of the store. It is created if needed.
+        :type path: str
+        """
+        self.path = path
+        self.pack_dir = os.path.join(path, 'packs')
+        self.snapshot_dir = os.path.join(path, 'snapshots')
+        for directory in [self.pack_dir, self.snapshot_dir]:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        self.lock_file = open(os.path.join(path, 'lock'), 'w')
+        # Only one process may change the store at a time
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self.index = self.load_index()
+        self.pack = None
+
+    def close(self):
+        """Finish the current pack and release the store."""
+        self.finish_pack()
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+    def load_index(self):
+        """Load the chunk index from the index files of all packs.
+
+        :returns: Chunk locations keyed by chunk checksum, each a list of
+            pack id, offset, stored length and original length.
+        :rtype: dict
+        """
+        index = {}
+        for file_name in os.listdir(self.pack_dir):
+            if not file_name.endswith('.idx'):
+                continue
+            with open(os.path.join(self.pack_dir, file_name)) as index_file:
+                pack_index = json.load(index_file)
+            pack_id = file_name[:-len('.idx')]
+            for digest, location in pack_index.items():
+                index[digest] = [pack_id] + location
+        return index
+
+    def add_chunk(self, chunk):
+        """Add a chunk to the store unless it is already there.
+
+        :param chunk: The chunk data.
+        :type chunk: bytes
+
+        :returns: A tuple of the chunk's checksum and the number of bytes
+            added to the store.
+        :rtype: tuple
+        """
+        digest = hashlib.sha256(chunk).hexdigest()
+        if digest in self.index:
+            return digest, 0
+        if self.pack is None:
+            pack_id = uuid.uuid4().hex
+            self.pack = {
+                'id': pack_id,
+                'file': open(os.path.join(
+                    self.pack_dir, '%s.pack.tmp' % pack_id), 'wb'),
+                'index': {},
+                'size': 0}
+        data = zlib.compress(chunk, 6)
+        location = [self.pack['size'], len(data), len(chunk)]
+        self.pack['file'].write(data)
+        self.pack['size'] += len(data)
+        self.pack['index'][digest] = location
+        self.index[digest] = [self.pack['id']] + location
+        if self.pack['size'] >= PACK_SIZE:
+            self.finish_pack()
+        return digest, len(data)
+
+    def finish_pack(self):
+        """Write the index of the current pack and make it part of the
+        store."""
+        if self.pack is None:
+            return
+        pack_path = os.path.join(self.pack_dir, '%s.pack' % self.pack['id'])
+        self.pack['file'].flush()
+        os.fsync(self.pack['file'].fileno())
+        self.pack['file'].close()
+        os.rename(pack_path + '.tmp', pack_path)
+        index_path = os.path.join(self.pack_dir, '%s.idx' % self.pack['id'])
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(self.pack['index'], index_file)
+        # A pack without an index is ignored, so this makes it visible
+        os.rename(index_path + '.tmp', index_path)
+        self.pack = None
+
+    def read_chunk(self, digest):
+        """Read a chunk from the store.
+
+        :param digest: Checksum of the chunk.
+        :type digest: str
+
+        :returns: The chunk data.
+        :rtype: bytes
+        """
+        pack_id, offset, length, _ = self.index[digest]
+        with open(os.path.join(
+                self.pack_dir, '%s.pack' % pack_id), 'rb') as pack_file:
+            pack_file.seek(offset)
+            return zlib.decompress(pack_file.read(length))
+
+    def ingest(self, file_path, name):
+        """Store a file as a new snapshot.
+
+        :param file_path: Path to the file to store.
+        :type file_path: str
+
+        :param name: Name of the snapshot e.g. the database name. Snapshots
+            of the same name are kept as versions of one another.
+        :type name: str
+
+        :returns: The snapshot, including ``added`` - the number of bytes
+            the store grew by.
+        :rtype: dict
+        """
+        digest = hashlib.sha256()
+        chunks = []
+        size = 0
+        added = 0
+        with open(file_path, 'rb') as stream:
+            for chunk in iter_chunks(stream):
+                digest.update(chunk)
+                size += len(chunk)
+                chunk_digest, chunk_added = self.add_chunk(chunk)
+                chunks.append(chunk_digest)
+                added += chunk_added
+        self.finish_pack()
+        created = time.time()
+        snapshot_id = '%s.%s' % (name, time.strftime(
+            '%Y%m%d%H%M%S', time.localtime(created)))
+        suffix = 1
+        while os.path.exists(os.path.join(
+                self.snapshot_dir, '%s.json' % snapshot_id)):
+            snapshot_id = '%s.%s-%i' % (name, time.strftime(
+                '%Y%m%d%H%M%S', time.localtime(created)), suffix)
+            suffix += 1
+        snapshot = {
+            'id': snapshot_id,
+            'name': name,
+            'file_name': os.path.basename(file_path),
+            'created': created,
+            'size': size,
+            'sha256': digest.hexdigest(),
+            'chunks': chunks}
+        snapshot_path = os.path.join(
+            self.snapshot_dir, '%s.json' % snapshot['id'])
+        with open(snapshot_path + '.tmp', 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.rename(snapshot_path + '.tmp', snapshot_path)
+        snapshot['added'] = added
+        return snapshot
+
+    def snapshots(self):
+        """List the snapshots in the store, oldest first.
+
+        :returns: The snapshots without their chunk lists.
+        :rtype: list
+        """
+        snapshots = []
+        for file_name in os.listdir(self.snapshot_dir):
+            if not file_name.endswith('.json'):
+                continue
+            snapshot = self.load_snapshot(file_name[:-len('.json')])
+            del snapshot['chunks']
+            snapshots.append(snapshot)
+        return sorted(snapshots, key=lambda item: item['created'])
+
+    def load_snapshot(self, snapshot_id):
+        """Load a snapshot.
+
+        :param snapshot_id: Id of the snapshot e.g. gis.20131120020000.
+        :type snapshot_id: str
+
+        :returns: The snapshot.
+        :rtype: dict
+        """
+        with open(os.path.join(
+                self.snapshot_dir, '%s.json' % snapshot_id)) as snapshot_file:
+            return json.load(snapshot_file)
+
+    def restore(self, snapshot_id, file_path):
+        """Write the file of a snapshot.
+
+        :param snapshot_id: Id of the snapshot.
+        :type snapshot_id: str
+
+        :param file_path: Path of the file to write.
+        :type file_path: str
+
+        :raises: ValueError if the restored file does not match the
+            snapshot's checksum.
+        """
+        snapshot = self.load_snapshot(snapshot_id)
+        digest = hashlib.sha256()
+        with open(file_path + '.part', 'wb') as output:
+            for chunk_digest in snapshot['chunks']:
+                chunk = self.read_chunk(chunk_digest)
+                digest.update(chunk)
+                output.write(chunk)
+        if digest.hexdigest() != snapshot['sha256']:
+            os.remove(file_path + '.part')
+            raise ValueError('%s did not restore intact' % snapshot_id)
+        os.rename(file_path + '.part', file_path)
+
+    def prune(self, keep_days):
+        """Remove snapshots older than a number of days.
+
+        The newest snapshot of each name is always kept, so that a database
+        that has not changed in a long time still has a backup. Run
+        :meth:`gc` afterwards to reclaim the space.
+
+        :param keep_days: Age in days of the oldest snapshots to keep.
+        :type keep_days: int
+
+        :returns: Ids of the removed snapshots.
+        :rtype: list
+        """
+        limit = time.time() - keep_days * 24 * 60 * 60
+        newest = {}
+        for snapshot in self.snapshots():
+            newest[snapshot['name']] = snapshot['id']
+        removed = []
+        for snapshot in self.snapshots():
+            if (snapshot['created'] < limit and
+                    newest[snapshot['name']] != snapshot['id']):
+                os.remove(os.path.join(
+                    self.snapshot_dir, '%s.json' % snapshot['id']))
+                removed.append(snapshot['id'])
+        return removed
+
+    def gc(self):
+        """Remove chunks that are no longer used by any snapshot.
+
+        Packs without live chunks are deleted. Packs that are less than half
+        live are rewritten with only their live chunks.
+
+        :returns: Number of bytes freed.
+        :rtype: int
+        """
+        self.finish_pack()
+        live = set()
+        for file_name in os.listdir(self.snapshot_dir):
+            if file_name.endswith('.json'):
+                live.update(
+                    self.load_snapshot(file_name[:-len('.json')])['chunks'])
+        packs = {}
+        for digest, location in self.index.items():
+            packs.setdefault(location[0], []).append(digest)
+        freed = 0
+        for pack_id, digests in packs.items():
+            live_digests = [digest for digest in digests if digest in live]
+            pack_path = os.path.join(self.pack_dir, '%s.pack' % pack_id)
+            pack_size = os.path.getsize(pack_path)
+            live_size = sum(self.index[digest][2] for digest in live_digests)
+            if live_size * 2 >= pack_size:
+                continue
+            # Copy the live chunks to a new pack before removing the old one
+            for digest in live_digests:
+                chunk = self.read_chunk(digest)
+                del self.index[digest]
+                self.add_chunk(chunk)
+            self.finish_pack()
+            os.remove(os.path.join(self.pack_dir, '%s.idx' % pack_id))
+            os.remove(pack_path)
+            for digest in digests:
+                if digest not in live:
+                    del self.index[digest]
+            freed += pack_size - live_size
+        return freed
+
+    def stats(self):
+        """Get statistics about the store.
+
+        :returns: The number of snapshots, the total size of all snapshots
+            (``logical_size``), the size of the distinct chunks
+            (``unique_size``), the size on disk (``stored_size``) and the
+            ratio of the logical size to the size on disk.
+        :rtype: dict
+        """
+        snapshots = self.snapshots()
+        logical_size = sum(snapshot['size'] for snapshot in snapshots)
+        unique_size = sum(location[3] for location in self.index.values())
+        stored_size = 0
+        for file_name in os.listdir(self.pack_dir):
+            stored_size += os.path.getsize(
+                os.path.join(self.pack_dir, file_name))
+        return {
+            'snapshots': len(snapshots),
+            'chunks': len(self.index),
+            'logical_size': logical_size,
+            'unique_size': unique_size,
+            'stored_size': stored_size,
+            'ratio': float(logical_size) / max(stored_size, 1)}
+
+
+def main(arguments):
+    """Command line interface, see the module documentation.
+
+    :param arguments: Command line arguments without the script name.
+    :type arguments: list
+    """
+    if len(arguments) < 2:
+        print(__doc__)
+        return 1
+    store = ChunkStore(arguments[0])
+    command = arguments[1]
+    try:
+        if command == 'ingest':
+            snapshot = store.ingest(arguments[2], arguments[3])
+            print('%s: %i bytes, %i bytes added' % (
+                snapshot['id'], snapshot['size'], snapshot['added']))
+        elif command == 'restore':
+            store.restore(arguments[2], arguments[3])
+        elif command == 'list':
+            for snapshot in store.snapshots():
+                print('%s %i' % (snapshot['id'], snapshot['size']))
+        elif command == 'prune':
+            for snapshot_id in store.prune(int(arguments[2])):
+                print('Removed %s' % snapshot_id)
+        elif command == 'gc':
+            print('Freed %i bytes' % store.gc())
+        elif command == 'stats':
+            print(json.dumps(store.stats(), indent=2, sort_keys=True))
+        else:
+            print('Unknown command %s' % command)
+            return 1
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -7,11 +7,14 @@ Django related tasks
 import os
 from fabric.api import cd, task, sudo, fastprint, run
 from fabric.colors import green
-from fabric.contrib.files import sed, upload_template
+from fabric.contrib.files import sed
 from fabric.contrib.files import exists
 from fabtools import require, fabtools
 from .common import setup_env
+from .utilities import upload_content
 from . import virtualenv
+from .packages import require_package
+from .batch import command_batch
 
 
 @task
@@ -84,7 +87,7 @@ def setup_apache(
     # Note that you may have problems if you intend to run more than one
     # site from the same server
     require.postfix.server(site_name)
-    require.deb.package('libapache2-mod-wsgi')
+    require_package('libapache2-mod-wsgi')
 
     # Find out if the wsgi user exists and create it if needed e.g.
     require.user(
@@ -110,19 +113,18 @@ def setup_apache(
     destination = '/etc/apache2/sites-available/%s.apache.conf' % site_name
     fastprint(context)
 
-    upload_template(
-        template_path,
-        destination,
-        context=context,
-        use_sudo=True)
+    with open(template_path) as template_file:
+        content = template_file.read() % context
+    upload_content(content, destination, use_sudo=True)
 
     set_media_permissions(code_path, wsgi_user, media_dir=media_dir)
 
-    sudo('a2ensite %s.apache.conf' % site_name)
-    sudo('a2dissite default')
-    sudo('a2enmod rewrite')
-    # Check if apache configs are ok - script will abort if not ok
-    sudo('/usr/sbin/apache2ctl configtest')
+    with command_batch(use_sudo=True) as batch:
+        batch.add('a2ensite %s.apache.conf' % site_name)
+        batch.add('a2dissite default')
+        batch.add('a2enmod rewrite')
+        # Check if apache configs are ok - script will abort if not ok
+        batch.add('/usr/sbin/apache2ctl configtest')
     require.service.restarted('apache2')
     return destination
 
@@ -163,12 +165,13 @@ def setup_celery(project_name, user, password, code_path):
     http://docs.celeryproject.org/en/latest/tutorials/daemonizing.html#
     daemonizing
     """
-    fabtools.require.deb.package('rabbitmq-server')
-    sudo('rabbitmqctl add_user %s %s' % (user, password))
-    sudo('rabbitmqctl add_vhost %s' % project_name)
-    sudo('rabbitmqctl set_permissions -p %s %s ".*" ".*" ".*"' % (
-        project_name, user))
-    sudo('rabbitmqctl delete_user guest')
+    require_package('rabbitmq-server')
+    with command_batch(use_sudo=True) as batch:
+        batch.add('rabbitmqctl add_user %s %s' % (user, password))
+        batch.add('rabbitmqctl add_vhost %s' % project_name)
+        batch.add('rabbitmqctl set_permissions -p %s %s ".*" ".*" ".*"' % (
+            project_name, user))
+        batch.add('rabbitmqctl delete_user guest')
     venv = os.path.join(code_path, 'venv')
     with cd(venv):
         run('bin/pip install django-celery')
@@ -34,13 +34,14 @@ fabric tasks against it e.g.::
 
 """
 
-from fabric.api import run, sudo, task, fastprint, env, prompt, reboot, abort
+from fabric.api import (
+    run, sudo, task, serial, fastprint, env, prompt, reboot, abort)
 from fabric.colors import red, green, blue, yellow
 from fabric.contrib.files import exists, contains, sed
-from fabtools.deb import update_index as apt_get_update, is_installed
-from fabtools.require.deb import ppa as require_ppa
-from fabtools.require.deb import package as require_package
-from fabtools.require.deb import packages as require_packages
+from .packages import require_package, require_packages, require_ppas
+from .facts import get_facts, package_installed
+from .utilities import ensure_replacements
+from .firewall import apply_firewall, firewall_roles
 
 
 @task
@@ -85,6 +86,7 @@ def docker():
 
 
 @task
+@serial
 def setup_docker(force=False):
     """Setup docker on the target host.
 
@@ -93,11 +95,11 @@ def setup_docker(force=False):
     :type force: bool
     """
     fastprint(yellow('Setting up docker on host: %s\n' % env.host))
-    if is_installed('lxc-docker'):
+    if package_installed('lxc-docker'):
         fastprint(green(
             'This system already appears to have docker installed on it\n'))
     else:
-        version = run('uname -r')
+        version = get_facts().kernel
         if '3.2' in version:
             # LTS 3.2 version is too old so we install a backported one
             # see http://docs.docker.io/en/latest/installation/ubuntulinux/
@@ -117,8 +119,7 @@ def setup_docker(force=False):
                 reboot()
         else:
             require_package('linux-image-extra-%s' % version)
-        require_ppa('ppa:dotcloud/lxc-docker')
-        apt_get_update()
+        require_ppas(['dotcloud'])
         require_packages([
             'software-properties-common',
             'lxc-docker'])
@@ -163,6 +164,7 @@ def setup_docker_user(user=None):
 
 
 @task
+@serial
 def setup_docker_image():
     """Set up the default docker image to be used in fabgis deployments.
 
@@ -302,25 +304,19 @@ def current_docker_container():
 def allow_docker_through_ufw():
     """Allow docker networking to communicate out through UFW.
 
+    Sets the ufw forward policy to ACCEPT and adds the docker role of
+    :data:`fabgis.firewall.FIREWALL_RULES` to the host's firewall, which
+    allows traffic coming in from the docker0 bridge.
 
-         TODO Implement this task fully
-
-
-        http://stackoverflow.com/questions/17394241/my-firewall-is-blocking
-        -network-connections-from-the-docker-container-to-outside
-    """
-    before_rules = """
-    # docker rules to enable external network access from the container
-    # forward traffic accross the bridge
-    -A ufw - before - forward - i  docker0 - j  ACCEPT
-    -A ufw - before - forward - i  testbr0 - j  ACCEPT
-    -A ufw - before - forward - m  state - -state
-    RELATED, ESTABLISHED - j ACCEPT"""
-
-    after_rules = """
-    *nat
-    :POSTROUTING ACCEPT [0:0]
-    -A POSTROUTING -s 172.16.42.0/8 -o eth0 -j MASQUERADE
-    # don't delete the 'COMMIT' line or these rules won't be processed
-    COMMIT
+    .. seealso:: http://stackoverflow.com/questions/17394241/my-firewall-is-
+        blocking-network-connections-from-the-docker-container-to-outside
     """
+    ensure_replacements('/etc/default/ufw', [(
+        'DEFAULT_FORWARD_POLICY="DROP"',
+        'DEFAULT_FORWARD_POLICY="ACCEPT"')], use_sudo=True)
+    roles = firewall_roles()
+    if 'docker' not in roles:
+        roles.append('docker')
+    apply_firewall(*roles)
+    # Pick up the new forward policy
+    sudo('ufw reload')
@@ -1,18 +1,17 @@
 # coding=utf-8
 """Helpers dropbox so that you can easily move gis data to the server."""
 
-import os
-
 from fabric.contrib.files import exists
 from fabtools import require
 
-from fabric.api import run, cd, env, task, sudo, put
+from fabric.api import run, cd, env, task, serial, sudo
 from .common import setup_env
-from .utilities import replace_tokens
+from .utilities import resource_path, upload_template_file
 from .utilities import append_if_not_present
 
 
 @task
+@serial
 def setup_dropbox():
     """Setup a headless dropbox installation."""
     setup_env()
@@ -53,24 +52,13 @@ def setup_dropbox_daemon():
 
     """
     setup_env()
-    with cd('/etc/init.d/'):
-        if not exists('dropbox'):
-            local_dir = os.path.dirname(__file__)
-            local_file = os.path.abspath(os.path.join(
-                local_dir,
-                '..',
-                '../fabgis_resources',
-                'server_config',
-                'dropbox',
-                'dropbox.templ'))
-            put(local_file,
-                '/etc/init.d/dropbox',
-                use_sudo=True)
-
-        my_tokens = {'USER': env.fg.user, }
-        replace_tokens('/etc/init.d/dropbox', my_tokens)
-
-    sudo('chmod +x /etc/init.d/dropbox')
+    my_tokens = {'USER': env.fg.user, }
+    upload_template_file(
+        resource_path('server_config', 'dropbox', 'dropbox.templ'),
+        '/etc/init.d/dropbox',
+        my_tokens,
+        use_sudo=True,
+        mode=0755)
     sudo('update-rc.d dropbox defaults')
     start_dropbox()
     dropbox_status()
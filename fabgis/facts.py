@@ -0,0 +1,282 @@
+# coding=utf-8
+"""Gather facts about the remote host in a single round trip.
+
+Rather than probing the host with a separate ``run`` for every detail we
+need (user name, hostname, processor count, kernel and so on) we send one
+small shell script that prints everything as ``key=value`` lines. The
+result is parsed into an attribute dictionary and kept per host so that
+any module can read from it without going back to the server, e.g.::
+
+    from fabgis.facts import get_facts
+    processor_count = get_facts().cpu_count
+
+Facts are also cached on disk under
+:file:`fabgis_resources/.cache/hosts/<host>.json` so that subsequent ``fab``
+invocations against the same host can skip discovery altogether. Cached
+facts expire after ``env.fg_facts_ttl`` seconds (one hour by default) and
+can be overridden on the command line e.g.::
+
+    fab --set fg_facts_ttl=86400 -H foo build_server
+
+Use the :func:`clear_facts_cache` task to discard cached facts explicitly.
+"""
+import json
+import os
+import re
+import time
+from fabric.api import env, run, hide, task, fastprint
+from fabric.utils import _AttributeDict as fdict
+
+# The lists directory keeps its mtime when an update fetches nothing new.
+# update-success-stamp is touched after every successful update (by
+# update-notifier-common and by fabgis.packages.update_index), pkgcache.bin
+# is rebuilt by updates on hosts without it. The newest of the two counts.
+APT_UPDATE_STAMP = (
+    '$(ls -t /var/lib/apt/periodic/update-success-stamp '
+    '/var/cache/apt/pkgcache.bin 2>/dev/null | head -n 1)')
+
+# Each fact is a shell snippet whose first line of output becomes the value
+# of the fact. Order is preserved in the generated script.
+FACT_COMMANDS = (
+    ('user', 'whoami'),
+    # We use hostname rather than fabtools.system.get_hostname which fails
+    # in docker - see https://github.com/dotcloud/docker/issues/1301
+    ('hostname', 'hostname'),
+    ('cpu_count', 'grep -c ^processor /proc/cpuinfo'),
+    ('ram_kb', "awk '/^MemTotal:/ {print $2}' /proc/meminfo"),
+    ('os_release', 'cat /etc/issue.net'),
+    ('os_version', 'lsb_release -rs'),
+    ('kernel', 'uname -r'),
+    # 1 if any of the disks is a spinning disk, 0 for solid state only
+    ('disk_rotational', (
+        'cat /sys/block/[hsv]d[a-z]/queue/rotational '
+        '/sys/block/xvd[a-z]/queue/rotational '
+        '/sys/block/nvme*/queue/rotational | sort -r')),
+    # Older ifconfig output first, falling back to hostname -I
+    ('ip_address', (
+        "ifconfig eth0 | grep 'inet addr:' | cut -d: -f2 | "
+        "awk '{print $1}'; hostname -I | awk '{print $1}'")),
+    # Seconds since the apt package lists were last updated
+    ('apt_lists_age', (
+        'echo $(( $(date +%%s) - $(stat -c %%Y %s) ))' % APT_UPDATE_STAMP)),
+    # 1 if an apt source was added or changed since the last update
+    ('apt_sources_changed', (
+        'find /etc/apt/sources.list /etc/apt/sources.list.d '
+        '-newer %s | head -n 1 | wc -l' % APT_UPDATE_STAMP)),
+    # Space separated list of enabled PPAs e.g. ppa.launchpad.net/foo/bar
+    ('apt_ppas', (
+        "grep -rh '^deb ' /etc/apt/sources.list /etc/apt/sources.list.d | "
+        "grep -oE 'ppa.launchpad.net/[^/]+/[^/ ]+' | sort -u | "
+        "tr '\\n' ' '")),
+)
+INTEGER_FACTS = (
+    'cpu_count', 'ram_kb', 'disk_rotational', 'apt_lists_age',
+    'apt_sources_changed')
+
+# Installed packages are reported one per line as package:<name>=<version>
+PACKAGE_PREFIX = 'package:'
+PACKAGES_COMMAND = (
+    "dpkg-query -W -f='${Status} ${Package} ${Version}\\n' 2>/dev/null | "
+    "awk '$3 == \"installed\" {print \"%s\" $4 \"=\" $5}'" % PACKAGE_PREFIX)
+
+FACTS_CACHE_DIR = os.path.join('fabgis_resources', '.cache', 'hosts')
+
+env.fg_facts = {}
+env.fg_facts_ttl = 3600
+
+
+def facts_script():
+    """Build the shell script used to collect all facts in one exec.
+
+    :returns: A shell script that prints one ``key=value`` line per fact
+        followed by one line per installed package.
+    :rtype: str
+    """
+    lines = []
+    for name, command in FACT_COMMANDS:
+        lines.append(
+            'echo "%s=$({ %s; } 2>/dev/null | head -n 1)"' % (name, command))
+    lines.append(PACKAGES_COMMAND)
+    return '\n'.join(lines)
+
+
+def parse_facts(output):
+    """Parse the output of :func:`facts_script` into a facts dictionary.
+
+    :param output: Output produced by running the facts script.
+    :type output: str
+
+    :returns: Facts keyed by name. Installed packages are provided as a
+        dictionary of package name to version under the ``packages`` key.
+    :rtype: fdict
+    """
+    names = [name for name, _ in FACT_COMMANDS]
+    facts = fdict()
+    for name in names:
+        facts[name] = None
+    facts.packages = {}
+    for line in output.splitlines():
+        line = line.strip()
+        if '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        if key.startswith(PACKAGE_PREFIX):
+            facts.packages[key[len(PACKAGE_PREFIX):]] = value
+        elif key in names:
+            facts[key] = value
+    for name in INTEGER_FACTS:
+        try:
+            facts[name] = int(facts[name])
+        except (TypeError, ValueError):
+            facts[name] = None
+    return facts
+
+
+def gather_facts():
+    """Collect the facts for the current host with a single remote command.
+
+    :returns: Facts for the current host as returned by :func:`parse_facts`.
+    :rtype: fdict
+    """
+    with hide('running', 'output'):
+        output = run(facts_script())
+    facts = parse_facts(output)
+    facts.gathered = time.time()
+    # Keep the time of the last apt update relative to our own clock so that
+    # cached facts stay meaningful as time passes.
+    if facts.apt_lists_age is None:
+        facts.apt_updated = 0
+    else:
+        facts.apt_updated = time.time() - facts.apt_lists_age
+    return facts
+
+
+def facts_cache_path(host_string=None):
+    """Get the path of the on-disk facts cache file for a host.
+
+    :param host_string: Host to get the cache file for. Defaults to the
+        current host.
+    :type host_string: str
+
+    :returns: Path relative to the fabfile directory.
+    :rtype: str
+    """
+    if host_string is None:
+        host_string = env.host_string
+    file_name = re.sub(r'[^A-Za-z0-9._-]', '_', host_string)
+    return os.path.join(FACTS_CACHE_DIR, '%s.json' % file_name)
+
+
+def load_cached_facts():
+    """Load the facts for the current host from the on-disk cache.
+
+    :returns: Cached facts or None if there is no cache file, it is older
+        than ``env.fg_facts_ttl`` seconds or it lacks any of the facts we
+        gather (e.g. written by an older version of fabgis).
+    :rtype: fdict, None
+    """
+    path = facts_cache_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as cache_file:
+            cached = json.load(cache_file)
+    except ValueError:
+        return None
+    if time.time() - cached['gathered'] > int(env.fg_facts_ttl):
+        return None
+    for name, _ in FACT_COMMANDS:
+        if name not in cached['facts']:
+            return None
+    facts = fdict(cached['facts'])
+    facts.gathered = cached['gathered']
+    return facts
+
+
+def save_facts(facts):
+    """Store facts for the current host in memory and in the on-disk cache.
+
+    Facts updated in place (e.g. by :mod:`fabgis.packages`) keep the time
+    they were gathered, so saving them does not extend their lifetime.
+
+    :param facts: Facts for the current host.
+    :type facts: fdict
+    """
+    env.fg_facts[env.host_string] = facts
+    if not os.path.exists(FACTS_CACHE_DIR):
+        os.makedirs(FACTS_CACHE_DIR)
+    gathered = facts.get('gathered') or time.time()
+    with open(facts_cache_path(), 'w') as cache_file:
+        json.dump({'gathered': gathered, 'facts': facts}, cache_file)
+
+
+def get_facts(refresh=False):
+    """Get the facts for the current host, gathering them only when needed.
+
+    Facts are looked up in memory first, then in the on-disk cache and only
+    gathered from the host if neither has them.
+
+    :param refresh: Whether previously gathered facts should be discarded
+        and collected again from the host.
+    :type refresh: bool
+
+    :returns: Facts for the current host.
+    :rtype: fdict
+    """
+    if not refresh and env.host_string in env.fg_facts:
+        return env.fg_facts[env.host_string]
+    facts = None
+    if not refresh:
+        facts = load_cached_facts()
+    if facts is None:
+        facts = gather_facts()
+        save_facts(facts)
+    env.fg_facts[env.host_string] = facts
+    return facts
+
+
+def invalidate_facts():
+    """Discard the facts of the current host from memory and disk.
+
+    Call this after doing anything on the host that may change its facts,
+    e.g. installing or removing packages outside of :mod:`fabgis.packages`.
+    The next call to :func:`get_facts` will gather them again.
+    """
+    env.fg_facts.pop(env.host_string, None)
+    path = facts_cache_path()
+    if os.path.exists(path):
+        os.remove(path)
+
+
+@task
+def clear_facts_cache():
+    """Discard cached host facts.
+
+    When run against one or more hosts only their cache files are removed,
+    otherwise the whole cache is cleared e.g.::
+
+        fab -H foo clear_facts_cache
+        fab clear_facts_cache
+
+    """
+    if env.host_string:
+        invalidate_facts()
+        fastprint('Cleared cached facts for %s\n' % env.host_string)
+        return
+    env.fg_facts.clear()
+    if os.path.exists(FACTS_CACHE_DIR):
+        for file_name in os.listdir(FACTS_CACHE_DIR):
+            os.remove(os.path.join(FACTS_CACHE_DIR, file_name))
+    fastprint('Cleared all cached facts\n')
+
+
+def package_installed(name):
+    """Check whether a deb package is installed according to the host facts.
+
+    :param name: Name of the deb package.
+    :type name: str
+
+    :returns: True if the package was installed when facts were gathered.
+    :rtype: bool
+    """
+    return name in get_facts().packages
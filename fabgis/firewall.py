@@ -0,0 +1,207 @@
+# coding=utf-8
+"""Declarative ufw firewall configuration.
+
+The firewall is described as data: :data:`FIREWALL_RULES` lists the ufw
+rules needed for each host role (in ``ufw`` command syntax without the
+leading ``ufw``) and :data:`FIREWALL_POLICIES` the default policies.
+:func:`apply_firewall` reads the current state of the host in one round
+trip, works out the delta and applies only the missing policies and rules,
+and deletes rules that were removed from the spec, in a single batch.
+
+Which roles apply to a host is looked up in ``env.fg_firewall_hosts``
+(roles keyed by host string), falling back to ``env.fg_firewall_roles``
+plus any fabric roles (``-R``) that have firewall rules, e.g.::
+
+    fab -H foo apply_firewall
+    fab -H foo apply_firewall:base,docker
+
+ufw normalises rules when listing them (``ufw allow http`` is shown as
+``80``) so its status output can not be compared with the spec directly.
+Instead ``ufw --dry-run`` is asked to add each rule, which reports
+"Skipping adding existing rule" for the rules that are in place. A rule
+deleted by hand is therefore applied again. The rules applied by fabgis
+are recorded on the host in :data:`RULES_FILE` so that rules dropped from
+the spec can be deleted.
+"""
+from fabric.api import env, sudo, hide, task, fastprint
+from fabric.colors import green
+from fabric.utils import _AttributeDict as fdict
+from .batch import command_batch
+from .utilities import shell_quote
+
+FIREWALL_POLICIES = {
+    'incoming': 'deny',
+    'outgoing': 'allow',
+}
+
+FIREWALL_RULES = {
+    'base': [
+        'allow 8697',  # ssh on the port harden moves it to
+        'allow ssh',
+        'allow mosh',
+        'allow 25',  # mail
+        # Irc freenode
+        'allow from 127.0.0.1/32 to 78.40.125.4 port 6667',
+        'allow from 127.0.0.1/32 to any port 22',
+        'allow 53/udp',  # dns
+        'allow 53/tcp',
+        'allow 1053',  # dns client
+    ],
+    'web': [
+        'allow http',
+        'allow 443',
+    ],
+    'docker': [
+        'allow in on docker0',
+    ],
+}
+
+# Rules applied by fabgis, one per line
+RULES_FILE = '/etc/ufw/fabgis.rules'
+
+env.fg_firewall_roles = ['base', 'web']
+env.fg_firewall_hosts = {}
+
+
+def firewall_roles():
+    """Get the firewall roles of the current host.
+
+    :returns: Names of roles in :data:`FIREWALL_RULES`.
+    :rtype: list
+    """
+    if env.host_string in env.fg_firewall_hosts:
+        return list(env.fg_firewall_hosts[env.host_string])
+    roles = list(env.fg_firewall_roles)
+    for role in env.roles:
+        if role in FIREWALL_RULES and role not in roles:
+            roles.append(role)
+    return roles
+
+
+def firewall_spec(roles):
+    """Get the rules for a list of roles.
+
+    :param roles: Names of roles in :data:`FIREWALL_RULES`.
+    :type roles: list
+
+    :returns: The rules of all roles, in order and without duplicates.
+    :rtype: list
+    """
+    rules = []
+    for role in roles:
+        for rule in FIREWALL_RULES[role]:
+            if rule not in rules:
+                rules.append(rule)
+    return rules
+
+
+def read_firewall_state(rules):
+    """Read the ufw status and which rules are in place in one round trip.
+
+    :param rules: Rules of the spec to check.
+    :type rules: list
+
+    :returns: The state with ``active`` (bool), ``policies`` (dict of
+        direction to policy), ``recorded`` (list of rules previously applied
+        by fabgis) and ``existing`` (the rules of the spec and the recorded
+        rules that ufw has).
+    :rtype: fdict
+    """
+    marker = '__fabgis_firewall__'
+    # Prints 1 or more if ufw already has the rule in $RULE
+    check = (
+        'echo "$(ufw --dry-run $RULE 2>/dev/null | '
+        'grep -c \'Skipping adding existing rule\') $RULE"')
+    script = ['ufw status verbose', 'echo %s' % marker]
+    script += ['RULE=%s; %s' % (shell_quote(rule), check) for rule in rules]
+    script += [
+        'echo %s' % marker,
+        'while read -r RULE; do [ -n "$RULE" ] && %s; done < %s' % (
+            check, RULES_FILE),
+        'true']
+    with hide('running', 'output'):
+        output = sudo('; '.join(script))
+    sections = (output.replace('\r', '').split(marker) + ['', '', ''])[:3]
+    verbose, checked, recorded = sections
+    state = fdict()
+    state.active = 'Status: active' in verbose
+    state.policies = {}
+    for line in verbose.splitlines():
+        if line.startswith('Default:'):
+            # e.g. Default: deny (incoming), allow (outgoing)
+            for item in line[len('Default:'):].split(','):
+                parts = item.split()
+                if len(parts) == 2:
+                    state.policies[parts[1].strip('()')] = parts[0]
+    state.recorded = []
+    state.existing = []
+    for section, recorded_rules in [(checked, False), (recorded, True)]:
+        for line in section.splitlines():
+            parts = line.strip().split(' ', 1)
+            if len(parts) != 2 or not parts[0].isdigit():
+                continue
+            if recorded_rules:
+                state.recorded.append(parts[1])
+            if int(parts[0]) and parts[1] not in state.existing:
+                state.existing.append(parts[1])
+    return state
+
+
+def firewall_delta(rules, state):
+    """Work out the commands needed to bring the firewall in line with a spec.
+
+    :param rules: Rules that should be in place.
+    :type rules: list
+
+    :param state: Current state as returned by :func:`read_firewall_state`.
+    :type state: fdict
+
+    :returns: ufw commands to run, in order. Empty if nothing needs to
+        change.
+    :rtype: list
+    """
+    commands = []
+    for direction, policy in sorted(FIREWALL_POLICIES.items()):
+        if state.policies.get(direction) != policy:
+            commands.append('ufw default %s %s' % (policy, direction))
+    for rule in state.recorded:
+        if rule not in rules and rule in state.existing:
+            commands.append('ufw delete %s' % rule)
+    for rule in rules:
+        if rule not in state.existing:
+            commands.append('ufw %s' % rule)
+    if not state.active:
+        commands.append('ufw --force enable')
+    return commands
+
+
+@task
+def apply_firewall(*roles):
+    """Apply the declarative firewall spec to the host.
+
+    Only missing policies and rules are applied and rules that are no longer
+    in the spec are deleted, all in a single batch.
+
+    :param roles: Names of roles in :data:`FIREWALL_RULES`. Defaults to the
+        roles of the host, see :func:`firewall_roles`.
+    :type roles: str
+
+    :returns: The ufw commands that were run.
+    :rtype: list
+    """
+    if not roles:
+        roles = firewall_roles()
+    rules = firewall_spec(roles)
+    state = read_firewall_state(rules)
+    commands = firewall_delta(rules, state)
+    if not commands:
+        fastprint(green('Firewall is up to date (%s)\n' % ', '.join(roles)))
+        return commands
+    with command_batch(use_sudo=True) as batch:
+        for command in commands:
+            batch.add(command)
+        batch.add('printf \'%%s\\n\' %s > %s' % (
+            ' '.join(shell_quote(rule) for rule in rules), RULES_FILE))
+    fastprint(green('Firewall updated with %i changes (%s)\n' % (
+        len(commands), ', '.join(roles))))
+    return commands
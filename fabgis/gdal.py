@@ -1,12 +1,22 @@
 # coding=utf-8
 """Module for gdal related tasks"""
-import fabtools
 from fabric.contrib.files import exists, append
 from fabric.api import fastprint, run, cd, env, task, sudo, settings
 
 from .common import add_ubuntugis_ppa, setup_env
 from .system import setup_ccache
 from .proj4 import build_proj4
+from .packages import require_packages
+
+GDAL_BUILD_PACKAGES = [
+    'subversion',
+    'build-essential',
+    'libhdf5-serial-dev',
+    'libhdf5-7',
+    'libhdf4g-dev',
+    'libjpeg62-dev',
+    'libtiff4-dev',
+    'python-dev']
 
 
 @task
@@ -22,15 +32,8 @@ def build_gdal(with_ecw=False, with_mrsid=False):
     """
     setup_env()
     add_ubuntugis_ppa()
-    fabtools.require.deb.package('subversion')
-    fabtools.require.deb.package('build-essential')
+    require_packages(GDAL_BUILD_PACKAGES)
     setup_ccache()
-    fabtools.require.deb.package('libhdf5-serial-dev')
-    fabtools.require.deb.package('libhdf5-7')
-    fabtools.require.deb.package('libhdf4g-dev')
-    fabtools.require.deb.package('libjpeg62-dev')
-    fabtools.require.deb.package('libtiff4-dev')
-    fabtools.require.deb.package('python-dev')
 
     # Note that gdal does not compile against proj4, only uses the .so at
     # runtime
@@ -57,7 +60,7 @@ def build_gdal(with_ecw=False, with_mrsid=False):
         '--with-spatialite '
         '--without-libtool')
 
-    processor_count = run('cat /proc/cpuinfo | grep processor | wc -l')
+    processor_count = env.fg.facts.cpu_count
 
     # Currently you need to have downloaded the MRSID sdk to remote home dir
     if with_mrsid:
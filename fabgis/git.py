@@ -6,6 +6,7 @@ from fabric.contrib.files import exists
 import fabtools
 
 from .common import setup_env
+from .packages import require_package
 
 
 @task
@@ -42,7 +43,7 @@ def update_git_checkout(code_path, url, repo_alias, branch='master', tag=None):
     setup_env()
     repo_path = os.path.join(code_path, repo_alias)
 
-    fabtools.require.deb.package('git')
+    require_package('git')
     if not exists(repo_path):
         fastprint(green('Repository does not exist, creating.\n'))
         fabtools.require.directory(code_path, use_sudo=True, owner=env.user)
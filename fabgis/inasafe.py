@@ -3,19 +3,21 @@
 
 from fabric.api import task, fastprint
 from fabric.colors import blue, green
-import fabtools
+from .packages import require_packages
+
+INASAFE_PACKAGES = [
+    'pep8',
+    'pylint',
+    'python-nose',
+    'python-nosexcover',
+    'python-pip',
+    'python-numpy',
+    'python-qt4']
 
 
 @task
 def setup_inasafe():
     """Setup requirements for InaSAFE."""
     fastprint(blue('Setting up InaSAFE dependencies\n'))
-    fabtools.require.deb.package('pep8')
-    fabtools.require.deb.package('pylint')
-    fabtools.require.deb.package('python-nose')
-    fabtools.require.deb.package('python-nosexcover')
-    fabtools.require.deb.package('python-pip')
-    fabtools.require.deb.package('python-numpy')
-    fabtools.require.deb.package('python-qt4')
-    fabtools.require.deb.package('python-nose')
+    require_packages(INASAFE_PACKAGES)
     fastprint(green('Setting up InaSAFE dependencies completed.\n'))
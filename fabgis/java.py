@@ -3,18 +3,14 @@
 
 from fabric.api import run, sudo, task, fastprint, env
 from fabric.colors import red, green, blue, yellow
-from fabtools.deb import update_index as apt_get_update
-from fabtools.require.deb import ppa as require_ppa
-from fabtools.require.deb import package as require_package
+from .packages import require_package, require_ppas
 
 
 @task
 def install_oracle_jdk():
     """Install the official oracle jdk."""
     fastprint(yellow('Setting up oracle java on host: %s' % env.host))
-    require_ppa('ppa:webupd8team/java')
-    apt_get_update()
-    require_package('software-properties-common')
+    require_ppas(['webupd8team'])
     sudo(
         'echo oracle-java7-installer shared/accepted-oracle-license-v1-1 '
         'select true | debconf-set-selections')
@@ -1,10 +1,14 @@
 import os
 import time
 from fabric.contrib.files import contains, exists
-from fabric.api import run, cd, env, task, sudo, put
+from fabric.api import run, env, task, sudo
 import fabtools
-from .utilities import append_if_not_present, replace_tokens
+from .utilities import (
+    append_if_not_present, resource_path, upload_template_file)
 from .common import setup_env
+from .packages import require_package, require_packages, remove_packages
+from .facts import package_installed, invalidate_facts
+from .batch import command_batch
 
 
 @task
@@ -122,13 +126,14 @@ def install_jenkins(use_upstream_repo=False):
     """
     if use_upstream_repo:
         repo = 'upstream'
-        if fabtools.deb.is_installed('jenkins'):
-            fabtools.deb.uninstall(['jenkins-common',
-                                    'jenkins-cli',
-                                    'libjenkins-remoting-java'], purge=True)
+        if package_installed('jenkins'):
+            remove_packages(['jenkins-common',
+                             'jenkins-cli',
+                             'libjenkins-remoting-java'], purge=True)
         add_jenkins_repository()
         fabtools.deb.update_index(quiet=True)
         sudo('apt-get install jenkins')
+        invalidate_facts()
         #Jenkins needs time to come up
         time.sleep(5)
         configure_jenkins(repo)
@@ -137,13 +142,11 @@ def install_jenkins(use_upstream_repo=False):
         if os.path.exists('/etc/apt/sources.list.d/jenkins-repository.list'):
             sudo('rm /etc/apt/sources.list.d/jenkins-repository.list')
         fabtools.deb.update_index(quiet=True)
-        if fabtools.deb.is_installed('jenkins'):
-            fabtools.deb.uninstall(['jenkins-common',
-                                    'jenkins-cli',
-                                    'libjenkins-remoting-java'], purge=True)
-        fabtools.require.deb.package('jenkins')
-        fabtools.require.deb.package('jenkins-common')
-        fabtools.require.deb.package('jenkins-cli')
+        if package_installed('jenkins'):
+            remove_packages(['jenkins-common',
+                             'jenkins-cli',
+                             'libjenkins-remoting-java'], purge=True)
+        require_packages(['jenkins', 'jenkins-common', 'jenkins-cli'])
         #Jenkins needs time to come up
         time.sleep(5)
         configure_jenkins(repo)
@@ -156,7 +159,7 @@ def jenkins_deploy_website(site_url=None, use_upstream_repo=False):
     8080
     """
     setup_env()
-    fabtools.require.deb.package('apache2')
+    require_package('apache2')
     sitename = site_url
 
     if not sitename:
@@ -167,27 +170,16 @@ def jenkins_deploy_website(site_url=None, use_upstream_repo=False):
     jenkins_apache_conf = ('fabgis.%s.conf' % (sitename))
     jenkins_apache_conf_template = 'fabgis.jenkins.conf.templ'
 
-    with cd('/etc/apache2/sites-available/'):
-        if not exists(jenkins_apache_conf):
-            local_dir = os.path.dirname(__file__)
-            local_file = os.path.abspath(os.path.join(
-                local_dir,
-                '..',
-                '../fabgis_resources',
-                'server_config',
-                'apache',
-                jenkins_apache_conf_template))
-            put(local_file,
-                '/etc/apache2/sites-available/%s' %
-                jenkins_apache_conf_template,
-                use_sudo=True)
-
-        my_tokens = {
-            'SERVERNAME': env.fg.hostname,  # Web Url e.g. foo.com
-            'WEBMASTER': 'werner@linfiniti.com',  # email of web master
-            'SITENAME': sitename,  # Choosen name of jenkins 'root'
-        }
-        replace_tokens(jenkins_apache_conf_template, my_tokens)
+    my_tokens = {
+        'SERVERNAME': env.fg.hostname,  # Web Url e.g. foo.com
+        'WEBMASTER': 'werner@linfiniti.com',  # email of web master
+        'SITENAME': sitename,  # Choosen name of jenkins 'root'
+    }
+    upload_template_file(
+        resource_path('server_config', 'apache', jenkins_apache_conf_template),
+        '/etc/apache2/sites-available/%s' % jenkins_apache_conf,
+        my_tokens,
+        use_sudo=True)
 
     # Add a hosts entry for local testing - only really useful for localhost
     hosts = '/etc/hosts'
@@ -198,8 +190,9 @@ def jenkins_deploy_website(site_url=None, use_upstream_repo=False):
         append_if_not_present(hosts,
                               '127.0.0.1 %s.localhost' % env.fg.hostname,
                               use_sudo=True)
-        # For doing Reverse Proxy we need to enable 2 apache modules
-    sudo('a2enmod proxy')
-    sudo('a2enmod proxy_http')
-    sudo('a2ensite %s' % jenkins_apache_conf)
-    sudo('service apache2 reload')
+    # For doing Reverse Proxy we need to enable 2 apache modules
+    with command_batch(use_sudo=True) as batch:
+        batch.add('a2enmod proxy')
+        batch.add('a2enmod proxy_http')
+        batch.add('a2ensite %s' % jenkins_apache_conf)
+        batch.add('service apache2 reload')
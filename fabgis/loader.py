@@ -0,0 +1,402 @@
+# coding=utf-8
+"""Load directories of vector data into a postgis database.
+
+:func:`load_vector_data` loads every Shapefile, GeoPackage layer and
+GeoJSON file in a directory (local or on the host) into a database, e.g.::
+
+    fab -H foo load_vector_data:gis,data/osm
+    fab -H foo load_vector_data:gis,/srv/data/osm,remote=True,jobs=4
+
+Loading is done the fast way rather than the ogr2ogr default of inserting
+rows one by one into fully indexed tables:
+
+* ``shp2pgsql -D`` and ``ogr2ogr -f PGDump`` write ``COPY`` statements,
+  which are piped straight into psql.
+* Several layers are loaded at the same time.
+* Tables are created ``UNLOGGED`` so the load is not written to the WAL
+  (postgres 9.5 and later, which can turn them back into normal tables
+  afterwards). On older servers each table is created and filled in one
+  transaction, which skips the WAL when ``wal_level`` is minimal.
+* Primary keys and spatial indexes are only built once the data is in,
+  in parallel, followed by ``ANALYZE``.
+
+The number of rows loaded per second is shown for each layer and written
+to a json report in :file:`fabgis_resources/reports/`.
+"""
+import base64
+import os
+import re
+import time
+from fabric.api import env, task, run, sudo, hide, settings, abort, fastprint
+from fabric.colors import green, red, yellow
+from .common import setup_env
+from .packages import require_packages
+from .postgres import dump_jobs
+from .spatial_index import qualified_name, run_sql_pool, write_report
+from .sql import execute_sql, sql_identifier, sql_literal
+from .transfer import upload_directory
+from .utilities import as_bool, shell_quote
+
+VECTOR_EXTENSIONS = ['.shp', '.gpkg', '.geojson', '.json']
+GEOMETRY_COLUMN = 'geom'
+LOAD_MARKER = '__fabgis_load'
+
+# Turns the CREATE TABLE of the loaders into an unlogged one and drops
+# their primary keys, which are added after the load.
+UNLOGGED_SED = 's/^CREATE TABLE /CREATE UNLOGGED TABLE /'
+PRIMARY_KEY_SEDS = [
+    # shp2pgsql
+    '/^ALTER TABLE .* ADD PRIMARY KEY/d',
+    # ogr2ogr PGDump
+    's/, *CONSTRAINT "[^"]*" PRIMARY KEY *("[^"]*")//',
+]
+
+
+def table_name(name):
+    """Turn a file or layer name into a table name.
+
+    :param name: Name of the file (without extension) or layer.
+    :type name: str
+
+    :returns: Lower case name with only letters, digits and underscores.
+    :rtype: str
+    """
+    name = re.sub(r'[^a-z0-9_]+', '_', name.lower()).strip('_')
+    if not name or name[0].isdigit():
+        name = 't_%s' % name
+    return name[:63]
+
+
+def find_vector_layers(source_dir):
+    """List the vector layers in a directory on the host.
+
+    The loaders available on the host are checked in the same round trip.
+
+    :param source_dir: Directory on the host.
+    :type source_dir: str
+
+    :returns: The path of shp2pgsql (or None), whether ogr2ogr is available
+        and the layers as (path, layer or None) tuples. GeoPackages can hold
+        several layers, other files hold one.
+    :rtype: tuple
+    """
+    separator = '__fabgis_sep'
+    names = ' -o '.join(
+        '-iname \'*%s\'' % extension for extension in VECTOR_EXTENSIONS)
+    with hide('running', 'output'):
+        output = run(
+            '(command -v shp2pgsql || '
+            'ls /usr/lib/postgresql/*/bin/shp2pgsql 2>/dev/null | tail -n 1); '
+            'echo %(sep)s; command -v ogr2ogr; echo %(sep)s; '
+            'find %(dir)s -type f \\( %(names)s \\) | sort; echo %(sep)s; '
+            # One line per layer, the path and the layer separated by a tab
+            'find %(dir)s -type f -iname \'*.gpkg\' | '
+            'while IFS= read -r FILE; do ogrinfo -q "$FILE" | '
+            'while IFS= read -r LINE; do '
+            'printf \'%%s\\t%%s\\n\' "$FILE" "$LINE"; done; done; true' % {
+                'sep': separator,
+                'dir': shell_quote(source_dir),
+                'names': names})
+    sections = (output.replace('\r', '').split(separator) + [''] * 4)[:4]
+    shp2pgsql = sections[0].strip() or None
+    ogr2ogr = bool(sections[1].strip())
+    gpkg_layers = {}
+    for line in sections[3].splitlines():
+        # e.g. /data/osm.gpkg<tab>1: main roads (Line String), paths and
+        # layer names may contain spaces
+        path, _, layer = line.strip('\n').partition('\t')
+        match = re.match(r'^\d+: (.+?)( \([^()]*\))?$', layer.strip())
+        if match:
+            gpkg_layers.setdefault(path, []).append(match.group(1))
+    layers = []
+    for path in sections[2].splitlines():
+        if not path.strip():
+            continue
+        if path.lower().endswith('.gpkg'):
+            # Without gdal there is no ogrinfo to list the layers with
+            if ogr2ogr and path not in gpkg_layers:
+                fastprint(yellow('No layers found in %s\n' % path))
+            layers.extend((path, layer) for layer in gpkg_layers.get(path, []))
+        else:
+            layers.append((path, None))
+    return shp2pgsql, ogr2ogr, layers
+
+
+def load_command(
+        path, layer, table, dbname, schema, shp2pgsql, options):
+    """Build the shell command that loads one layer.
+
+    The command prints a line with the table, the exit code, the number of
+    rows copied and the time it took in milliseconds.
+
+    :param path: Path to the file on the host.
+    :type path: str
+
+    :param layer: Name of the layer in a GeoPackage, else None.
+    :type layer: str
+
+    :param table: Name of the table to create.
+    :type table: str
+
+    :param dbname: Name of the database.
+    :type dbname: str
+
+    :param schema: Schema for the table.
+    :type schema: str
+
+    :param shp2pgsql: Path to shp2pgsql to load shapefiles with, or None to
+        use ogr2ogr.
+    :type shp2pgsql: str
+
+    :param options: ``srid``, ``encoding``, ``unlogged`` and
+        ``postgis_version`` for the loaders.
+    :type options: dict
+
+    :returns: bash script.
+    :rtype: str
+    """
+    if shp2pgsql and path.lower().endswith('.shp'):
+        producer = '%s -D -g %s' % (shp2pgsql, GEOMETRY_COLUMN)
+        if options['srid']:
+            producer += ' -s %s' % options['srid']
+        if options['encoding']:
+            producer += ' -W %s' % shell_quote(options['encoding'])
+        producer += ' %s %s' % (
+            shell_quote(path), shell_quote('%s.%s' % (schema, table)))
+    else:
+        producer = 'ogr2ogr -f PGDump /vsistdout/ %s' % shell_quote(path)
+        if layer:
+            producer += ' %s' % shell_quote(layer)
+        producer += (
+            ' -nln %s -nlt PROMOTE_TO_MULTI -lco SCHEMA=%s '
+            '-lco GEOMETRY_NAME=%s -lco SPATIAL_INDEX=NO '
+            '-lco CREATE_SCHEMA=OFF' % (
+                table, shell_quote(schema), GEOMETRY_COLUMN))
+        if options['postgis_version'] < 2:
+            producer += ' -lco POSTGIS_VERSION=1.5'
+        if options['srid']:
+            producer += ' -t_srs EPSG:%s' % options['srid']
+        if options['encoding']:
+            producer += ' --config SHAPE_ENCODING %s' % shell_quote(
+                options['encoding'])
+    seds = list(PRIMARY_KEY_SEDS)
+    if options['unlogged']:
+        seds.append(UNLOGGED_SED)
+    return (
+        'set -o pipefail\n'
+        'START=$(date +%%s%%N)\n'
+        'ROWS=$(%(producer)s | sed %(seds)s | '
+        'psql -X -v ON_ERROR_STOP=1 -d %(dbname)s | '
+        'awk \'/^COPY [0-9]+/ {rows += $2} END {print rows + 0}\')\n'
+        'CODE=$?\n'
+        'echo %(marker)s %(table)s $CODE $ROWS '
+        '$(( ($(date +%%s%%N) - START) / 1000000 ))\n' % {
+            'producer': producer,
+            'seds': ' '.join('-e %s' % shell_quote(sed) for sed in seds),
+            'dbname': dbname,
+            'marker': LOAD_MARKER,
+            'table': table})
+
+
+@task
+def load_vector_data(
+        dbname,
+        source_dir,
+        remote=False,
+        jobs=None,
+        schema='public',
+        srid=None,
+        encoding=None,
+        overwrite=False,
+        unlogged=True):
+    """Load a directory of Shapefiles, GeoPackages and GeoJSON into postgis.
+
+    Each file (each layer for GeoPackages) becomes a table named after it,
+    with its geometry in a ``geom`` column, a primary key and a spatial
+    index, owned by the owner of the database. Files are read by the
+    postgres user on the host.
+
+    :param dbname: Name of the database e.g. one made by
+        :func:`fabgis.postgres.create_postgis_1_5_db`.
+    :type dbname: str
+
+    :param source_dir: Directory with the files, searched recursively.
+    :type source_dir: str
+
+    :param remote: Whether source_dir is on the host. A local directory is
+        uploaded to /tmp on the host first.
+    :type remote: bool (default False)
+
+    :param jobs: Number of layers to load at the same time. Defaults to the
+        number of processors on the host, limited to two for hosts with
+        spinning disks.
+    :type jobs: int
+
+    :param schema: Schema to load the tables into.
+    :type schema: str
+
+    :param srid: EPSG code of the data. Shapefiles are loaded with
+        shp2pgsql, which can not read .prj files, only when this is given.
+        Other files are reprojected to it by ogr2ogr.
+    :type srid: int
+
+    :param encoding: Character encoding of the attributes of shapefiles
+        e.g. LATIN1.
+    :type encoding: str
+
+    :param overwrite: Whether to replace existing tables of the same name.
+        Without it the load is aborted when any of the tables exist.
+    :type overwrite: bool (default False)
+
+    :param unlogged: Whether to load into unlogged tables on servers that
+        support making them logged afterwards (9.5 and later).
+    :type unlogged: bool (default True)
+
+    :returns: Path to the local report.
+    :rtype: str
+    """
+    setup_env()
+    if jobs is None:
+        jobs = dump_jobs()
+    jobs = int(jobs)
+    if not as_bool(remote):
+        local_dir = source_dir
+        # The files keep their names, the directory on the host gets one
+        # that needs no quoting
+        source_dir = '/tmp/fabgis_load/%s' % re.sub(
+            r'[^A-Za-z0-9._-]', '_',
+            os.path.basename(os.path.abspath(local_dir)))
+        run('rm -rf %s' % source_dir)
+        upload_directory(local_dir, source_dir)
+        run('chmod -R a+rX %s' % source_dir)
+
+    shp2pgsql, ogr2ogr, layers = find_vector_layers(source_dir)
+    if not ogr2ogr:
+        # GeoPackages are listed with ogrinfo, so list them again once
+        # gdal is installed
+        require_packages(['gdal-bin'])
+        shp2pgsql, ogr2ogr, layers = find_vector_layers(source_dir)
+    if not srid:
+        shp2pgsql = None
+    if not layers:
+        abort('No vector data found in %s' % source_dir)
+    tables = {}
+    for path, layer in layers:
+        name = table_name(
+            layer or os.path.splitext(os.path.basename(path))[0])
+        if name in tables:
+            abort('%s and %s would both be loaded into %s' % (
+                tables[name][0], path, name))
+        tables[name] = (path, layer)
+
+    info, existing = execute_sql([
+        'SELECT current_setting(\'server_version_num\'), '
+        'postgis_lib_version(), pg_get_userbyid(datdba) '
+        'FROM pg_database WHERE datname = current_database()',
+        'SELECT tablename FROM pg_tables WHERE schemaname = %s' %
+        sql_literal(schema)], database=dbname)
+    version, postgis_version, owner = info[0]
+    existing = [row[0] for row in existing if row[0] in tables]
+    if existing and not as_bool(overwrite):
+        abort('These tables exist already: %s' % ', '.join(sorted(existing)))
+    if existing:
+        execute_sql(
+            ['DROP TABLE %s' % qualified_name(schema, table)
+             for table in existing],
+            database=dbname)
+    options = {
+        'srid': srid,
+        'encoding': encoding,
+        'unlogged': as_bool(unlogged) and int(version) >= 90500,
+        'postgis_version': int(postgis_version.split('.')[0])}
+
+    commands = [
+        load_command(path, layer, table, dbname, schema, shp2pgsql, options)
+        for table, (path, layer) in sorted(tables.items())]
+    # Each command is passed to bash -c by xargs, null separated and base64
+    # encoded so that it needs no further quoting.
+    encoded = base64.b64encode(''.join(
+        '%s\0' % command for command in commands))
+    start = time.time()
+    with settings(warn_only=True):
+        output = sudo(
+            'echo %s | base64 -d | xargs -0 -n 1 -P %i bash -c' % (
+                encoded, jobs),
+            user='postgres')
+    load_seconds = time.time() - start
+
+    results = {}
+    for line in output.splitlines():
+        parts = line.strip().split()
+        if len(parts) == 5 and parts[0] == LOAD_MARKER:
+            results[parts[1]] = {
+                'file': tables[parts[1]][0],
+                'layer': tables[parts[1]][1],
+                'succeeded': parts[2] == '0',
+                'rows': int(parts[3]),
+                'seconds': int(parts[4]) / 1000.0}
+    loaded = sorted(
+        table for table, result in results.items() if result['succeeded'])
+
+    # Turn the tables into normal ones and find those without a primary key
+    statements = []
+    for table in loaded:
+        name = qualified_name(schema, table)
+        if options['unlogged']:
+            statements.append('ALTER TABLE %s SET LOGGED' % name)
+        statements.append('ALTER TABLE %s OWNER TO %s' % (
+            name, sql_identifier(owner)))
+    statements.append(
+        'SELECT c.relname, a.attname FROM pg_class c '
+        'JOIN pg_namespace n ON n.oid = c.relnamespace '
+        'JOIN pg_attribute a ON a.attrelid = c.oid '
+        'WHERE n.nspname = %s AND c.relname IN (%s) '
+        'AND a.attname IN (\'gid\', \'ogc_fid\') '
+        'AND NOT EXISTS (SELECT 1 FROM pg_constraint p '
+        'WHERE p.conrelid = c.oid AND p.contype = \'p\')' % (
+            sql_literal(schema),
+            ', '.join(sql_literal(table) for table in loaded) or 'NULL'))
+    without_key = execute_sql(statements, database=dbname)[-1]
+
+    statements = [
+        'ALTER TABLE %s ADD PRIMARY KEY (%s)' % (
+            qualified_name(schema, key_table), sql_identifier(column))
+        for key_table, column in without_key]
+    statements += [
+        'CREATE INDEX %s ON %s USING gist (%s)' % (
+            sql_identifier('%s_%s_gist' % (table[:50], GEOMETRY_COLUMN)),
+            qualified_name(schema, table), GEOMETRY_COLUMN)
+        for table in loaded]
+    statements += [
+        'ANALYZE %s' % qualified_name(schema, table) for table in loaded]
+    index_seconds, _ = run_sql_pool(dbname, statements, jobs)
+
+    for table in sorted(results):
+        result = results[table]
+        if not result['succeeded']:
+            fastprint(red('%s: failed to load %s\n' % (
+                table, result['file'])))
+            continue
+        result['rows_per_second'] = int(
+            result['rows'] / max(result['seconds'], 0.001))
+        fastprint(
+            '%(table)s: %(rows)i rows in %(seconds).1fs '
+            '(%(rows_per_second)i rows/s)\n' % dict(result, table=table))
+    missing = sorted(set(tables) - set(results))
+    for table in missing:
+        fastprint(red('%s: the loader did not finish\n' % table))
+    report_path = write_report({
+        'host': env.host,
+        'database': dbname,
+        'source': source_dir,
+        'jobs': jobs,
+        'unlogged': options['unlogged'],
+        'load_seconds': round(load_seconds, 2),
+        'index_seconds': round(index_seconds, 2),
+        'layers': results,
+        'missing': missing}, kind='load')
+    fastprint(green(
+        'Loaded %i of %i layers into %s in %.1fs, indexes took %.1fs\n' % (
+            len(loaded), len(tables), dbname, load_seconds, index_seconds)))
+    fastprint(green('Report written to %s\n' % report_path))
+    return report_path
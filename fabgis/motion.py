@@ -12,9 +12,10 @@ import os
 from fabgis.fabgis import sed
 from fabric.api import cd, task, sudo, fastprint, run
 from fabric.colors import green
-from fabric.contrib.files import upload_template
 from fabtools import require
 from .common import setup_env
+from .utilities import upload_content
+from .packages import require_package, require_packages
 
 
 @task
@@ -25,8 +26,7 @@ def setup_motion(email):
     :type email: str
 
     """
-    require.deb.package('motion')
-    require.deb.package('mpack')
+    require_packages(['motion', 'mpack'])
     sed(
         '/etc/default/motion',
         'start_motion_daemon=no',
@@ -91,13 +91,11 @@ def setup_apache(
     destination = '/etc/apache2/sites-available/%s.apache.conf' % site_name
     fastprint(context)
 
-    upload_template(
-        template_path,
-        destination,
-        context=context,
-        use_sudo=True)
+    with open(template_path) as template_file:
+        content = template_file.read() % context
+    upload_content(content, destination, use_sudo=True)
 
-    require.deb.package('apache2')
+    require_package('apache2')
     sudo('a2dissite default')
     sudo('a2ensite %s.apache.conf' % site_name)
     # Check if apache configs are ok - script will abort if not ok
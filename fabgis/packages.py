@@ -0,0 +1,212 @@
+# coding=utf-8
+"""Deb package helpers that keep the host facts up to date.
+
+Modules declare the packages they need as plain lists (package sets) e.g.::
+
+    TILESTREAM_PACKAGES = ['curl', 'build-essential', 'libssl-dev']
+    require_packages(TILESTREAM_PACKAGES)
+
+:func:`require_packages` first consults the (cached) host facts from
+:mod:`fabgis.facts`, then runs a single ``dpkg-query`` for any packages the
+facts don't know about and finally a single ``apt-get install`` for
+everything that is missing. Package sets can simply be added together when
+tasks are chained so that the whole chain is installed in one go e.g.::
+
+    require_packages(POSTGIS_1_5_PACKAGES + QGIS_BUILD_PACKAGES)
+
+Whenever a package is installed or removed through these helpers the cached
+facts are updated accordingly.
+
+The apt package index is only updated when it is older than
+``env.fg_apt_max_age`` seconds (a day by default) or when a source has been
+added since the last update, see :func:`update_index`. PPAs we commonly use
+are registered in :data:`KNOWN_PPAS` so that several can be added together
+followed by a single index update, e.g.::
+
+    require_ppas(['ubuntugis', 'developmentseed'])
+
+"""
+import time
+import fabtools
+from fabric.api import env, run, sudo, hide, settings, task, fastprint
+from .facts import get_facts, save_facts, invalidate_facts
+
+# Registry of PPAs used by fabgis tasks.
+KNOWN_PPAS = {
+    'ubuntugis': 'ppa:ubuntugis/ubuntugis-unstable',
+    'developmentseed': 'ppa:developmentseed/mapbox',
+    'dotcloud': 'ppa:dotcloud/lxc-docker',
+    'webupd8team': 'ppa:webupd8team/java',
+}
+
+env.fg_apt_max_age = 86400
+
+
+def index_is_stale():
+    """Check whether the apt package index needs to be updated.
+
+    :returns: True if the index is older than ``env.fg_apt_max_age`` seconds
+        or an apt source has been added since it was last updated.
+    :rtype: bool
+    """
+    facts = get_facts()
+    if facts.apt_sources_changed:
+        return True
+    return time.time() - facts.apt_updated > int(env.fg_apt_max_age)
+
+
+def update_index(force=False):
+    """Update the apt package index if it is stale.
+
+    :param force: Whether to update the index even if it is fresh.
+    :type force: bool
+    """
+    if not force and not index_is_stale():
+        return
+    # The stamp tells the next gathering of facts when we last updated
+    sudo('apt-get --quiet update && mkdir -p /var/lib/apt/periodic && '
+         'touch /var/lib/apt/periodic/update-success-stamp')
+    facts = get_facts()
+    facts.apt_updated = time.time()
+    facts.apt_sources_changed = 0
+    save_facts(facts)
+
+
+def require_ppas(names):
+    """Add any missing PPAs and then update the package index once.
+
+    :param names: PPA names as registered in :data:`KNOWN_PPAS` e.g.
+        'ubuntugis', or full PPA specifications e.g. 'ppa:foo/bar'.
+    :type names: list
+    """
+    facts = get_facts()
+    enabled = facts.apt_ppas.split()
+    missing = []
+    for name in names:
+        ppa = KNOWN_PPAS.get(name, name)
+        source = 'ppa.launchpad.net/%s' % ppa.replace('ppa:', '')
+        if source not in enabled:
+            missing.append(ppa)
+            enabled.append(source)
+    if missing:
+        require_packages(['software-properties-common'])
+        sudo(' && '.join(
+            ['add-apt-repository -y %s' % spec for spec in missing]))
+        facts.apt_ppas = ' '.join(enabled)
+        facts.apt_sources_changed = 1
+        save_facts(facts)
+    update_index()
+
+
+@task
+def add_ppas(*names):
+    """Add several PPAs followed by a single package index update e.g.::
+
+        fab -H foo add_ppas:ubuntugis,developmentseed,dotcloud
+
+    :param names: PPA names as registered in :data:`KNOWN_PPAS` or full PPA
+        specifications. If none are given, all known PPAs are added.
+    :type names: str
+    """
+    if not names:
+        names = sorted(KNOWN_PPAS)
+    require_ppas(names)
+    fastprint('PPAs available: %s\n' % ', '.join(names))
+
+
+def query_packages(names):
+    """Look up which of the given packages are installed with one dpkg-query.
+
+    :param names: Names of the deb packages.
+    :type names: list
+
+    :returns: Installed versions keyed by package name. Packages that are
+        not installed are not included.
+    :rtype: dict
+    """
+    with hide('running', 'output', 'warnings'), settings(warn_only=True):
+        output = run(
+            'dpkg-query -W -f=\'${Status} ${Package} ${Version}\\n\' '
+            '%s 2>/dev/null' % ' '.join(names))
+    installed = {}
+    for line in output.splitlines():
+        # e.g. install ok installed build-essential 11.5ubuntu2.1
+        parts = line.split()
+        if len(parts) >= 4 and parts[2] == 'installed':
+            installed[parts[3]] = ' '.join(parts[4:])
+    return installed
+
+
+def missing_packages(names):
+    """Determine which packages from a package set are not installed yet.
+
+    :param names: Names of the deb packages.
+    :type names: list
+
+    :returns: Names of the packages that are not installed, in the order
+        given. Duplicates are removed.
+    :rtype: list
+    """
+    facts = get_facts()
+    unique_names = []
+    for name in names:
+        if name not in unique_names:
+            unique_names.append(name)
+    unknown = [name for name in unique_names if name not in facts.packages]
+    if not unknown:
+        return []
+    installed = query_packages(unknown)
+    if installed:
+        facts.packages.update(installed)
+        save_facts(facts)
+    return [name for name in unknown if name not in installed]
+
+
+def require_packages(names, update=False):
+    """Require a set of deb packages, installing the missing ones at once.
+
+    :param names: Names of the deb packages.
+    :type names: list
+
+    :param update: Whether the package index should be updated before
+        installing missing packages even if it is fresh.
+    :type update: bool
+    """
+    missing = missing_packages(names)
+    if not missing:
+        return
+    update_index(force=update)
+    fabtools.deb.install(missing)
+    # We don't know the exact versions that were installed, but we do know
+    # that they are installed now.
+    facts = get_facts()
+    for name in missing:
+        facts.packages[name] = ''
+    save_facts(facts)
+
+
+def require_package(name):
+    """Require a single deb package.
+
+    :param name: Name of the deb package.
+    :type name: str
+    """
+    require_packages([name])
+
+
+def remove_packages(names, purge=False):
+    """Remove deb packages if they are installed.
+
+    :param names: Names of the deb packages to remove.
+    :type names: list
+
+    :param purge: Whether configuration files should be purged too.
+    :type purge: bool
+    """
+    facts = get_facts()
+    installed = [name for name in names if name in facts.packages]
+    if not installed:
+        return
+    fabtools.deb.uninstall(installed, purge=purge)
+    # Removing packages may also remove packages that depend on them
+    invalidate_facts()
@@ -0,0 +1,145 @@
+# coding=utf-8
+"""PgBouncer connection pooling in front of postgres.
+
+Every apache (mod_wsgi) process and thread, celery worker and mapserver
+cgi request opens its own postgres connection, which costs a fork on the
+server each time and quickly runs into ``max_connections``. PgBouncer
+listens on ``env.fg_pgbouncer_port`` (6432) and hands out connections from
+a small pool per database and user in transaction pooling mode, e.g.::
+
+    fab -H foo setup_pgbouncer
+    fab -H foo setup_pgbouncer:/home/web/foo/django_project/settings.py
+
+Clients authenticate against :file:`/etc/pgbouncer/userlist.txt`, which is
+generated from the login roles in postgres. It is refreshed by
+:func:`fabgis.postgres.require_postgres_user` whenever it creates a user
+on a host with pgbouncer installed.
+"""
+from fabric.api import env, task, sudo, hide, settings, warn, fastprint
+from fabric.colors import green, yellow
+from fabric.contrib.files import exists
+from .packages import require_packages
+from .facts import package_installed
+from .transfer import upload_content
+from .utilities import (
+    ensure_replacements, resource_path, upload_template_file)
+
+env.fg_pgbouncer_port = 6432
+env.fg_pgbouncer_pool_size = 20
+env.fg_pgbouncer_max_client_conn = 1000
+
+USERLIST_FILE = '/etc/pgbouncer/userlist.txt'
+
+
+def pgbouncer_userlist():
+    """Build the pgbouncer userlist from the login roles with a password.
+
+    :returns: Content for the userlist file.
+    :rtype: str
+    """
+    sql = (
+        'SELECT usename, passwd FROM pg_shadow '
+        'WHERE passwd IS NOT NULL ORDER BY usename;')
+    with hide('output', 'running'):
+        output = sudo('psql -At -F \' \' -c "%s"' % sql, user='postgres')
+    lines = []
+    for line in output.splitlines():
+        if ' ' not in line:
+            continue
+        user, password = line.split(' ', 1)
+        lines.append('"%s" "%s"\n' % (user, password))
+    return ''.join(lines)
+
+
+def update_pgbouncer_userlist():
+    """Refresh the userlist of pgbouncer and reload it if it changed.
+
+    Nothing is done on hosts without pgbouncer.
+
+    :returns: True if the userlist changed.
+    :rtype: bool
+    """
+    if not package_installed('pgbouncer'):
+        return False
+    changed = upload_content(
+        pgbouncer_userlist(), USERLIST_FILE, use_sudo=True, mode=0640)
+    if changed:
+        sudo('chown postgres:postgres %s' % USERLIST_FILE)
+        sudo('service pgbouncer reload')
+    return changed
+
+
+@task
+def setup_pgbouncer(*app_configs):
+    """Install pgbouncer in transaction pooling mode for all databases.
+
+    Only roles with a password can connect through pgbouncer. Roles that
+    rely on peer authentication should keep connecting to postgres
+    directly.
+
+    :param app_configs: Paths on the host of application configuration
+        files (django settings, mapfiles) to point at pgbouncer, see
+        :func:`repoint_to_pgbouncer`.
+    :type app_configs: str
+    """
+    require_packages(['pgbouncer'])
+    tokens = {
+        'PORT': str(env.fg_pgbouncer_port),
+        'POOL_SIZE': str(env.fg_pgbouncer_pool_size),
+        'MAX_CLIENT_CONN': str(env.fg_pgbouncer_max_client_conn),
+    }
+    changed = upload_template_file(
+        resource_path('server_config', 'pgbouncer', 'pgbouncer.ini.templ'),
+        '/etc/pgbouncer/pgbouncer.ini',
+        tokens,
+        use_sudo=True)
+    # Older packages only start pgbouncer once it is enabled here
+    if exists('/etc/default/pgbouncer'):
+        ensure_replacements(
+            '/etc/default/pgbouncer', [('^START=0', 'START=1')],
+            use_sudo=True, backup='')
+    if upload_content(
+            pgbouncer_userlist(), USERLIST_FILE, use_sudo=True, mode=0640):
+        changed = True
+    sudo('chown postgres:postgres /etc/pgbouncer/*')
+    if changed:
+        sudo('service pgbouncer restart')
+    else:
+        sudo('service pgbouncer start; true')
+    if app_configs:
+        repoint_to_pgbouncer(*app_configs)
+    fastprint(green('PgBouncer is listening on port %s\n' % (
+        env.fg_pgbouncer_port)))
+
+
+@task
+def repoint_to_pgbouncer(*app_configs):
+    """Point application configuration files at pgbouncer.
+
+    Handles libpq connection strings (``port=5432``, as used by mapfiles)
+    and django settings (``'PORT': '5432'`` or an empty ``'PORT'``).
+    Django settings with an empty ``'HOST'`` connect over the unix socket,
+    so their host is set to 127.0.0.1 too. A backup of each file is kept
+    with a .bak suffix. Restart the applications afterwards.
+
+    :param app_configs: Paths on the host of the configuration files.
+    :type app_configs: str
+    """
+    port = str(env.fg_pgbouncer_port)
+    # The quote characters are matched with ['"] rather than an escaped
+    # quote, which fabric's own escaping of double quotes would break.
+    replacements = [
+        (r'port=5432\b', 'port=%s' % port),
+        (r'''(['"]PORT['"]: *)['"](5432)?['"]''', r"\1'%s'" % port),
+        (r'''(['"]HOST['"]: *)['"]['"]''', r"\1'127.0.0.1'"),
+    ]
+    for app_config in app_configs:
+        ensure_replacements(app_config, replacements, use_sudo=True)
+        # Check that the file really was changed
+        with settings(hide('everything'), warn_only=True):
+            result = sudo('grep -q %s %s' % (port, app_config))
+        if result.failed:
+            warn('No postgres connection settings were changed in %s' %
+                 app_config)
+            continue
+        fastprint(yellow('%s now uses port %s\n' % (app_config, port)))
@@ -0,0 +1,420 @@
+# coding=utf-8
+"""Find the queries that keep postgres busy.
+
+:func:`enable_query_stats` loads the ``pg_stat_statements`` and
+``auto_explain`` modules, so that postgres counts the calls and time of
+every statement and logs the plan of every statement slower than a
+threshold. :func:`query_stats_report` then ranks the statements by total
+time, mean time and calls, attaches the logged plans and writes the
+result to :file:`fabgis_resources/reports/` as json and html.
+:func:`diff_query_stats` compares two such reports, e.g.::
+
+    fab -H foo enable_query_stats:min_duration_ms=250
+    fab -H foo query_stats_report
+    # ... a day later
+    fab -H foo query_stats_report
+    fab diff_query_stats:fabgis_resources/reports/query_stats-foo-....json,\
+fabgis_resources/reports/query_stats-foo-....json
+"""
+import cgi
+import hashlib
+import json
+import os
+import re
+import time
+from fabric.api import env, task, sudo, hide, fastprint
+from fabric.colors import green, yellow
+from .common import setup_env
+from .packages import require_packages
+from .pitr import postgres_settings
+from .spatial_index import REPORT_DIR, write_report
+from .sql import execute_sql, query_value
+from .transfer import upload_content
+from .utilities import as_bool, ensure_lines
+
+STATS_FILE = 'conf.d/fabgis.stats.conf'
+STATS_LIBRARIES = ['pg_stat_statements', 'auto_explain']
+
+# Log lines of auto_explain start with the duration and continue with
+# indented lines holding the query text and the plan.
+PLAN_AWK = (
+    '/duration: [0-9.]+ ms +plan:/ {plan = 1; print; next} '
+    'plan && /^[ \\t]/ {print; next} {plan = 0}')
+
+
+@task
+def enable_query_stats(min_duration_ms=500, log_analyze=False):
+    """Enable pg_stat_statements and auto_explain on the host.
+
+    The settings are written to :file:`conf.d/fabgis.stats.conf` next to
+    postgresql.conf, which includes it. Postgres is restarted when the
+    modules are not loaded yet, otherwise it is reloaded.
+
+    :param min_duration_ms: Plans of statements that take longer than this
+        many milliseconds are logged.
+    :type min_duration_ms: int
+
+    :param log_analyze: Whether to log actual row counts and timings in the
+        plans too. This slows down every statement, not only the logged
+        ones.
+    :type log_analyze: bool (default False)
+    """
+    setup_env()
+    pg_settings = postgres_settings(['config_file', 'server_version_num'])
+    version = int(pg_settings['server_version_num'])
+    if version < 100000:
+        # The modules are part of the server package from 10 on
+        require_packages(['postgresql-contrib-%i.%i' % (
+            version / 10000, version / 100 % 100)])
+    # May be empty or contain spaces, so not read with postgres_settings
+    preloaded = query_value(
+        'SELECT current_setting(\'shared_preload_libraries\')') or ''
+    libraries = [
+        library.strip() for library in preloaded.split(',')
+        if library.strip()]
+    needs_restart = False
+    for library in STATS_LIBRARIES:
+        if library not in libraries:
+            libraries.append(library)
+            needs_restart = True
+    lines = [
+        'shared_preload_libraries = \'%s\'' % ','.join(libraries),
+        'pg_stat_statements.max = 10000',
+        'pg_stat_statements.track = all',
+        'auto_explain.log_min_duration = %i' % int(min_duration_ms),
+        'auto_explain.log_analyze = %s' % (
+            'on' if as_bool(log_analyze) else 'off'),
+    ]
+    if version >= 90200:
+        lines.append('track_io_timing = on')
+    config_file = pg_settings['config_file']
+    config_dir = config_file[:config_file.rindex('/')]
+    stats_file = '%s/%s' % (config_dir, STATS_FILE)
+    sudo('mkdir -p %s/conf.d && chown postgres:postgres %s/conf.d' % (
+        config_dir, config_dir))
+    upload_content('\n'.join(lines) + '\n', stats_file, use_sudo=True)
+    sudo('chown postgres:postgres %s' % stats_file)
+    ensure_lines(config_file, ['include \'%s\'' % STATS_FILE], use_sudo=True)
+    if needs_restart:
+        sudo('service postgresql restart')
+    else:
+        sudo('service postgresql reload')
+    # The view is only needed in the database we read it from
+    execute_sql(
+        'CREATE EXTENSION IF NOT EXISTS pg_stat_statements',
+        database='postgres')
+    fastprint(green(
+        'Logging plans of statements slower than %sms\n' % min_duration_ms))
+
+
+def normalise_query(query):
+    """Reduce a query to a form that literal and normalised queries share.
+
+    pg_stat_statements replaces constants with $1, $2 (or ?) while the
+    plans logged by auto_explain show the original query.
+
+    :param query: SQL query.
+    :type query: str
+
+    :returns: Lower case query with constants replaced by ? and runs of
+        white space collapsed.
+    :rtype: str
+    """
+    query = re.sub(r"'(?:[^']|'')*'", '?', query)
+    query = re.sub(r'\$\d+', '?', query)
+    query = re.sub(r'\b\d+(\.\d+)?\b', '?', query)
+    return ' '.join(query.lower().split()).rstrip(';')
+
+
+def read_logged_plans(max_bytes=50000000):
+    """Read the plans logged by auto_explain from the end of the server log.
+
+    :param max_bytes: Only this many bytes at the end of the log are read.
+    :type max_bytes: int
+
+    :returns: The slowest logged plan of each normalised query, as dicts
+        with ``duration_ms``, ``query`` and ``plan``.
+    :rtype: dict
+    """
+    with hide('running', 'output'):
+        output = sudo(
+            'LOG=$(ls -t /var/log/postgresql/postgresql-*.log | head -n 1); '
+            'tail -c %i $LOG | awk %s; true' % (
+                int(max_bytes), "'%s'" % PLAN_AWK))
+    plans = {}
+    entries = re.split(
+        r'^.*duration: ([0-9.]+) ms +plan:\s*$', output.replace('\r', ''),
+        flags=re.MULTILINE)
+    # entries holds the text before the first plan, then duration and plan
+    # text pairs
+    for duration, text in zip(entries[1::2], entries[2::2]):
+        # Keep the indentation of the plan nodes
+        lines = [
+            re.sub(r'^\t', '', line.rstrip()) for line in text.splitlines()
+            if line.strip()]
+        if not lines or not lines[0].startswith('Query Text:'):
+            continue
+        query = lines[0][len('Query Text:'):].strip()
+        # Multi line queries continue until the first plan node, which is
+        # the first line with the estimated costs
+        plan_start = 1
+        for index, line in enumerate(lines[1:], 1):
+            if '(cost=' in line:
+                plan_start = index
+                break
+        query = ' '.join([query] + [
+            line.strip() for line in lines[1:plan_start]])
+        key = normalise_query(query)
+        if key in plans and plans[key]['duration_ms'] >= float(duration):
+            continue
+        plans[key] = {
+            'duration_ms': float(duration),
+            'query': query,
+            'plan': '\n'.join(lines[plan_start:])}
+    return plans
+
+
+@task
+def query_stats_report(top=25, reset=False):
+    """Write a report of the statements that take the most time.
+
+    :param top: Number of statements in each ranking.
+    :type top: int
+
+    :param reset: Whether to reset the statistics after reading them, so
+        that the next report only covers the time since this one.
+    :type reset: bool (default False)
+
+    :returns: Path to the json report, the html report is next to it.
+    :rtype: str
+    """
+    setup_env()
+    version = int(postgres_settings(['server_version_num'])[
+        'server_version_num'])
+    # total_time was split into planning and execution time in 13
+    total_time = 'total_exec_time' if version >= 130000 else 'total_time'
+    statements = [
+        'SELECT d.datname, r.rolname, s.query, s.calls, s.%s, s.rows, '
+        's.shared_blks_hit, s.shared_blks_read '
+        'FROM pg_stat_statements s '
+        'JOIN pg_database d ON d.oid = s.dbid '
+        'JOIN pg_roles r ON r.oid = s.userid' % total_time]
+    if as_bool(reset):
+        statements.append('SELECT pg_stat_statements_reset()')
+    rows = execute_sql(statements, database='postgres')[0]
+    plans = read_logged_plans()
+
+    entries = []
+    for database, role, query, calls, total, rows_count, hit, read in rows:
+        calls = int(calls)
+        entry = {
+            'key': hashlib.md5('%s\0%s\0%s' % (
+                database, role, query)).hexdigest(),
+            'database': database,
+            'role': role,
+            'query': query,
+            'calls': calls,
+            'total_ms': float(total),
+            'mean_ms': float(total) / max(calls, 1),
+            'rows': int(rows_count),
+            'hit_ratio': float(hit) / max(int(hit) + int(read), 1),
+            'plan': None}
+        plan = plans.get(normalise_query(query))
+        if plan:
+            entry['plan'] = plan
+        entries.append(entry)
+
+    top = int(top)
+    report = {
+        'host': env.host,
+        'database': 'all',
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'statements': entries,
+        'rankings': dict(
+            (ranking, [item['key'] for item in sorted(
+                entries, key=lambda item: -item[field])[:top]])
+            for ranking, field in [
+                ('total_time', 'total_ms'),
+                ('mean_time', 'mean_ms'),
+                ('calls', 'calls')])}
+    report_path = write_report(report, kind='query_stats')
+    html_path = '%s.html' % os.path.splitext(report_path)[0]
+    with open(html_path, 'w') as html_file:
+        html_file.write(report_html(report))
+    by_key = dict((entry['key'], entry) for entry in entries)
+    for key in report['rankings']['total_time'][:5]:
+        entry = by_key[key]
+        fastprint(yellow('%10.0fms %8i calls  %s\n' % (
+            entry['total_ms'], entry['calls'],
+            ' '.join(entry['query'].split())[:80])))
+    fastprint(green('Reports written to %s and %s\n' % (
+        report_path, html_path)))
+    return report_path
+
+
+def html_table(columns, rows):
+    """Render an html table.
+
+    :param columns: Column headings.
+    :type columns: list
+
+    :param rows: Rows of cell values, which are escaped. Queries and plans
+        are shown preformatted.
+    :type rows: list
+
+    :returns: html table.
+    :rtype: str
+    """
+    html = ['<table>', '<tr>%s</tr>' % ''.join(
+        '<th>%s</th>' % cgi.escape(column) for column in columns)]
+    for row in rows:
+        cells = []
+        for value in row:
+            if isinstance(value, float):
+                value = '%.1f' % value
+            if isinstance(value, str):
+                value = value.decode('utf-8', 'replace')
+            value = cgi.escape(unicode(value))
+            if '\n' in value or len(value) > 60:
+                value = '<pre>%s</pre>' % value
+            cells.append('<td>%s</td>' % value)
+        html.append('<tr>%s</tr>' % ''.join(cells))
+    html.append('</table>')
+    return '\n'.join(html)
+
+
+def html_page(title, sections):
+    """Render an html page.
+
+    :param title: Title of the page.
+    :type title: str
+
+    :param sections: (heading, html) tuples.
+    :type sections: list
+
+    :returns: html page.
+    :rtype: str
+    """
+    body = '\n'.join(
+        '<h2>%s</h2>\n%s' % (cgi.escape(heading), html)
+        for heading, html in sections)
+    return (
+        '<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+        '<title>%(title)s</title><style>'
+        'body {font-family: sans-serif} table {border-collapse: collapse} '
+        'td, th {border: 1px solid #ccc; padding: 4px; vertical-align: top}'
+        ' pre {margin: 0; white-space: pre-wrap}'
+        '</style></head><body><h1>%(title)s</h1>\n%(body)s\n'
+        '</body></html>\n' % {'title': cgi.escape(title), 'body': body}
+    ).encode('utf-8')
+
+
+def report_html(report):
+    """Render a query stats report as html.
+
+    :param report: Report made by :func:`query_stats_report`.
+    :type report: dict
+
+    :returns: html page.
+    :rtype: str
+    """
+    by_key = dict((entry['key'], entry) for entry in report['statements'])
+    columns = [
+        'Total ms', 'Calls', 'Mean ms', 'Rows', 'Hit ratio', 'Database',
+        'Query', 'Slowest logged plan']
+    sections = []
+    for ranking, heading in [
+            ('total_time', 'Most total time'),
+            ('mean_time', 'Slowest on average'),
+            ('calls', 'Most frequent')]:
+        rows = []
+        for key in report['rankings'][ranking]:
+            entry = by_key[key]
+            plan = entry['plan']
+            rows.append([
+                entry['total_ms'], entry['calls'], entry['mean_ms'],
+                entry['rows'], entry['hit_ratio'], entry['database'],
+                entry['query'],
+                '%.1fms\n%s' % (plan['duration_ms'], plan['plan'])
+                if plan else ''])
+        sections.append((heading, html_table(columns, rows)))
+    return html_page(
+        'Query statistics for %s at %s' % (report['host'], report['created']),
+        sections)
+
+
+@task
+def diff_query_stats(old_report, new_report, top=25):
+    """Compare two reports made by :func:`query_stats_report`.
+
+    The counters of pg_stat_statements keep growing until they are reset,
+    so the difference shows the work done between the two reports. If the
+    statistics were reset in between, the new counts are used as they are.
+
+    :param old_report: Path to the older json report.
+    :type old_report: str
+
+    :param new_report: Path to the newer json report.
+    :type new_report: str
+
+    :param top: Number of statements to show.
+    :type top: int
+
+    :returns: Path to the html diff, the json diff is next to it.
+    :rtype: str
+    """
+    with open(old_report) as report_file:
+        old = json.load(report_file)
+    with open(new_report) as report_file:
+        new = json.load(report_file)
+    old_entries = dict((entry['key'], entry) for entry in old['statements'])
+    changes = []
+    for entry in new['statements']:
+        previous = old_entries.get(entry['key'])
+        calls = entry['calls']
+        total_ms = entry['total_ms']
+        if previous and previous['calls'] <= calls:
+            calls -= previous['calls']
+            total_ms -= previous['total_ms']
+        if not calls:
+            continue
+        changes.append({
+            'key': entry['key'],
+            'database': entry['database'],
+            'query': entry['query'],
+            'new': previous is None,
+            'calls': calls,
+            'total_ms': total_ms,
+            'mean_ms': total_ms / calls,
+            'previous_mean_ms': previous['mean_ms'] if previous else None,
+            'plan': entry['plan']})
+    changes.sort(key=lambda item: -item['total_ms'])
+    changes = changes[:int(top)]
+
+    diff = {
+        'old': old_report,
+        'new': new_report,
+        'period': [old['created'], new['created']],
+        'statements': changes}
+    base_name = os.path.join(REPORT_DIR, 'query_stats_diff-%s-%s' % (
+        os.path.splitext(os.path.basename(old_report))[0].split('-')[-1],
+        os.path.splitext(os.path.basename(new_report))[0].split('-')[-1]))
+    with open('%s.json' % base_name, 'w') as diff_file:
+        json.dump(diff, diff_file, indent=2, sort_keys=True)
+    rows = [[
+        change['total_ms'], change['calls'], change['mean_ms'],
+        'new' if change['new'] else '%.1f' % change['previous_mean_ms'],
+        change['database'], change['query']] for change in changes]
+    with open('%s.html' % base_name, 'w') as html_file:
+        html_file.write(html_page(
+            'Query statistics from %s to %s' % tuple(diff['period']),
+            [('Most time spent in the period', html_table(
+                ['Total ms', 'Calls', 'Mean ms', 'Previous mean ms',
+                 'Database', 'Query'], rows))]))
+    for change in changes[:5]:
+        fastprint(yellow('%10.0fms %8i calls  %s%s\n' % (
+            change['total_ms'], change['calls'],
+            '(new) ' if change['new'] else '',
+            ' '.join(change['query'].split())[:70])))
+    fastprint(green('Diff written to %s.html\n' % base_name))
+    return '%s.html' % base_name
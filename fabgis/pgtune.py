@@ -0,0 +1,252 @@
+# coding=utf-8
+"""Tune postgres for the hardware of the host and its workload.
+
+The stock postgresql.conf is sized for a very small machine, so spatial
+joins and index builds spill to disk long before they need to. The
+:func:`tune_postgres` task derives memory, planner, checkpoint and WAL
+settings from the RAM, processor count and disk type of the host (see
+:mod:`fabgis.facts`) for one of the workload profiles in
+:data:`TUNING_PROFILES`, e.g.::
+
+    fab -H foo tune_postgres
+    fab -H foo tune_postgres:analytic
+
+The settings are written to :file:`conf.d/fabgis.tune.conf` next to
+postgresql.conf, which includes it, and the server is reloaded. Settings
+that only take effect on start up (e.g. ``shared_buffers``) restart the
+server when they change.
+"""
+from fabric.api import env, task, sudo, hide, abort, fastprint
+from fabric.colors import green, yellow
+from .common import setup_env
+from .pitr import postgres_settings
+from .utilities import as_bool, ensure_lines
+from .transfer import upload_content
+
+# Each profile sets:
+#   work_mem_share - how many work_mem sized sorts or hashes we allow for
+#       each connection when dividing the memory left over by shared_buffers
+#   maintenance_fraction - share of RAM for index builds and vacuum
+#   wal_mb - max_wal_size (checkpoint_segments before 9.5)
+#   parallel - share of the processors a single query may use
+#   statistics_target - default_statistics_target for the planner
+#   extra - profile specific settings
+TUNING_PROFILES = {
+    # Many short queries from a web application
+    'web': {
+        'work_mem_share': 3,
+        'maintenance_fraction': 16,
+        'wal_mb': 2048,
+        'parallel': 4,
+        'statistics_target': 100,
+        'extra': [],
+    },
+    # Few large spatial queries and joins
+    'analytic': {
+        'work_mem_share': 1,
+        'maintenance_fraction': 8,
+        'wal_mb': 8192,
+        'parallel': 2,
+        'statistics_target': 500,
+        'extra': [],
+    },
+    # Loading data and building indexes
+    'bulk': {
+        'work_mem_share': 2,
+        'maintenance_fraction': 4,
+        'wal_mb': 16384,
+        'parallel': 2,
+        'statistics_target': 100,
+        'extra': [
+            # Losing the last few transactions in a crash is fine when the
+            # load can be repeated, the database itself stays consistent.
+            ('synchronous_commit', 'off'),
+            ('checkpoint_timeout', '30min'),
+        ],
+    },
+}
+
+# Settings that only take effect when the server is restarted
+RESTART_SETTINGS = [
+    'shared_buffers', 'wal_buffers', 'max_worker_processes']
+
+TUNE_FILE = 'conf.d/fabgis.tune.conf'
+
+
+def tuning_settings(
+        ram_kb, cpu_count, rotational, version, max_connections, profile):
+    """Work out the settings for a host.
+
+    :param ram_kb: RAM of the host in kB.
+    :type ram_kb: int
+
+    :param cpu_count: Number of processors of the host.
+    :type cpu_count: int
+
+    :param rotational: Whether the host has spinning disks.
+    :type rotational: bool
+
+    :param version: Postgres version number e.g. 90111 for 9.1.11.
+    :type version: int
+
+    :param max_connections: The max_connections setting of the server.
+    :type max_connections: int
+
+    :param profile: Name of a profile in :data:`TUNING_PROFILES`.
+    :type profile: str
+
+    :returns: Names and values of the settings, in order.
+    :rtype: list
+    """
+    tuning = TUNING_PROFILES[profile]
+    ram_mb = ram_kb / 1024
+    cpu_count = max(cpu_count, 1)
+    shared_buffers = ram_mb / 4
+    parallel_workers = 0
+    if version >= 90600:
+        parallel_workers = min(
+            max(cpu_count / tuning['parallel'], 1), 8)
+    # Each parallel worker of a query may use work_mem of its own
+    work_mem = (ram_mb - shared_buffers) / (
+        max_connections * tuning['work_mem_share'] *
+        max(parallel_workers, 1))
+    settings = [
+        ('shared_buffers', '%iMB' % shared_buffers),
+        ('effective_cache_size', '%iMB' % (ram_mb * 3 / 4)),
+        ('work_mem', '%iMB' % max(work_mem, 4)),
+        # Larger values are not used by index builds before 9.4
+        ('maintenance_work_mem', '%iMB' % min(
+            ram_mb / tuning['maintenance_fraction'], 2048)),
+        ('wal_buffers', '16MB'),
+        ('checkpoint_completion_target', '0.9'),
+        ('default_statistics_target', str(tuning['statistics_target'])),
+    ]
+    if version >= 90500:
+        settings.append(('max_wal_size', '%iMB' % tuning['wal_mb']))
+        settings.append(('min_wal_size', '%iMB' % (tuning['wal_mb'] / 4)))
+    else:
+        # Each segment is 16MB and up to 3 times as many are kept
+        settings.append(
+            ('checkpoint_segments', str(tuning['wal_mb'] / 16 / 3)))
+    if rotational:
+        settings.append(('random_page_cost', '4'))
+        settings.append(('effective_io_concurrency', '2'))
+    else:
+        # Random reads cost little more than sequential ones on SSDs
+        settings.append(('random_page_cost', '1.1'))
+        settings.append(('effective_io_concurrency', '200'))
+    if version >= 90600:
+        settings.append(('max_worker_processes', str(cpu_count)))
+        settings.append(
+            ('max_parallel_workers_per_gather', str(parallel_workers)))
+    if version >= 100000:
+        settings.append(('max_parallel_workers', str(cpu_count)))
+    return settings + tuning['extra']
+
+
+def parse_settings(content):
+    """Parse name = value lines of a postgres configuration file.
+
+    :param content: Content of the file.
+    :type content: str
+
+    :returns: Values keyed by setting name.
+    :rtype: dict
+    """
+    settings = {}
+    for line in content.splitlines():
+        if '=' in line and not line.strip().startswith('#'):
+            name, value = line.split('=', 1)
+            settings[name.strip()] = value.strip()
+    return settings
+
+
+def shared_memory_settings(ram_kb):
+    """Get kernel settings that allow shared_buffers of a quarter of RAM.
+
+    Before 9.3 postgres allocates its shared memory in one System V segment,
+    which is limited to 32MB by default on older kernels.
+
+    :param ram_kb: RAM of the host in kB.
+    :type ram_kb: int
+
+    :returns: Lines for a sysctl configuration file.
+    :rtype: list
+    """
+    shmmax = ram_kb * 1024 / 2
+    return [
+        'kernel.shmmax = %i' % shmmax,
+        # In pages of 4kB
+        'kernel.shmall = %i' % (shmmax / 4096)]
+
+
+@task
+def tune_postgres(profile='web', restart=True):
+    """Tune postgres for the hardware of the host and a workload.
+
+    :param profile: Workload profile, one of web (many short queries),
+        analytic (large spatial queries and joins) or bulk (loading data).
+    :type profile: str
+
+    :param restart: Whether to restart the server when a setting that
+        only takes effect on start up changed. If False those settings are
+        applied at the next restart.
+    :type restart: bool (default True)
+
+    :returns: The names and values of the settings.
+    :rtype: list
+    """
+    if profile not in TUNING_PROFILES:
+        abort('Unknown tuning profile %s, use one of %s' % (
+            profile, ', '.join(sorted(TUNING_PROFILES))))
+    restart = as_bool(restart)
+    setup_env()
+    facts = env.fg.facts
+    pg_settings = postgres_settings(
+        ['config_file', 'server_version_num', 'max_connections'])
+    version = int(pg_settings['server_version_num'])
+    settings = tuning_settings(
+        facts.ram_kb or 1024 * 1024,
+        facts.cpu_count or 1,
+        facts.disk_rotational,
+        version,
+        int(pg_settings['max_connections']),
+        profile)
+    config_file = pg_settings['config_file']
+    config_dir = config_file[:config_file.rindex('/')]
+    tune_file = '%s/%s' % (config_dir, TUNE_FILE)
+    with hide('output'):
+        previous = parse_settings(sudo(
+            'mkdir -p %s/conf.d && chown postgres:postgres %s/conf.d && '
+            'cat %s 2>/dev/null; true' % (config_dir, config_dir, tune_file)))
+    content = '# Written by fabgis for the %s profile\n' % profile
+    content += ''.join(
+        '%s = %s\n' % (name, value) for name, value in settings)
+    upload_content(content, tune_file, use_sudo=True)
+    sudo('chown postgres:postgres %s' % tune_file)
+    ensure_lines(config_file, ['include \'%s\'' % TUNE_FILE], use_sudo=True)
+    if version < 90300:
+        sysctl_file = '/etc/sysctl.d/30-postgresql-shm.conf'
+        if upload_content(
+                '\n'.join(shared_memory_settings(facts.ram_kb)) + '\n',
+                sysctl_file,
+                use_sudo=True):
+            sudo('sysctl -p %s' % sysctl_file)
+
+    changed = [
+        name for name, value in settings if previous.get(name) != value]
+    # Settings of the previous profile that are no longer set
+    changed += [
+        name for name in previous if name not in dict(settings)]
+    needs_restart = [name for name in changed if name in RESTART_SETTINGS]
+    if needs_restart and restart:
+        sudo('service postgresql restart')
+    else:
+        sudo('service postgresql reload')
+        if needs_restart:
+            fastprint(yellow(
+                '%s will change when postgres is restarted\n' %
+                ', '.join(needs_restart)))
+    fastprint(green('Postgres tuned for the %s profile (%i changes)\n' % (
+        profile, len(changed))))
+    return settings
@@ -0,0 +1,220 @@
+# coding=utf-8
+"""Point in time recovery (PITR) for postgres.
+
+Instead of dumping every database every night, postgres continuously copies
+each completed write ahead log (WAL) segment to an archive directory and a
+cron job takes a ``pg_basebackup`` of the whole cluster every week (by
+default). Any point in time since the oldest kept base backup can then be
+restored by replaying the archived WAL on top of a base backup, e.g.::
+
+    fab -H foo setup_pitr_backups
+    fab -H foo restore_to_timestamp:'2013-11-20 14:30:00'
+
+Only the newest ``keep`` base backups are kept, together with the WAL
+needed to recover from the oldest of them.
+"""
+import time
+from fabric.api import task, sudo, hide, abort, fastprint
+from fabric.colors import green
+from .common import setup_env
+from .utilities import (
+    ensure_lines, resource_path, upload_template_file)
+from .transfer import upload_content
+
+ARCHIVE_DIR = '/var/lib/postgresql/wal_archive'
+BASE_BACKUP_DIR = '/var/lib/postgresql/base_backups'
+
+# Settings written to the fabgis.pitr.conf file included by postgresql.conf
+PITR_SETTINGS = [
+    'wal_level = archive',
+    'archive_mode = on',
+    'max_wal_senders = 3',
+    # Archive a segment at least every 5 minutes on a quiet server
+    'archive_timeout = 300',
+]
+
+
+def postgres_settings(names=None):
+    """Get the location of the cluster's files and its version.
+
+    :param names: Names of the settings to get instead, their values may not
+        contain spaces.
+    :type names: list
+
+    :returns: The ``config_file``, ``hba_file``, ``data_directory`` and
+        ``server_version_num`` settings of the server.
+    :rtype: dict
+    """
+    if names is None:
+        names = [
+            'config_file', 'hba_file', 'data_directory',
+            'server_version_num']
+    sql = 'SELECT %s;' % ', '.join(
+        'current_setting(\'%s\')' % name for name in names)
+    with hide('output'):
+        output = sudo(
+            'psql -At -F \' \' -c "%s"' % sql, user='postgres')
+    return dict(zip(names, output.split()))
+
+
+@task
+def setup_wal_archiving(archive_dir=ARCHIVE_DIR):
+    """Configure postgres to archive every completed WAL segment.
+
+    The settings are written to :file:`fabgis.pitr.conf` next to
+    postgresql.conf, which includes it, and a replication entry for the
+    postgres user is added to pg_hba.conf so that ``pg_basebackup`` can
+    connect. Postgres is restarted if anything changed.
+
+    :param archive_dir: Directory on the host that WAL is archived to.
+    :type archive_dir: str
+    """
+    pg_settings = postgres_settings()
+    config_file = pg_settings['config_file']
+    sudo('mkdir -p %s && chown postgres:postgres %s && chmod 700 %s' % (
+        archive_dir, archive_dir, archive_dir))
+    lines = PITR_SETTINGS + [
+        'archive_command = \'test ! -f %s/%%f && cp %%p %s/%%f\'' % (
+            archive_dir, archive_dir)]
+    changed = upload_content(
+        '\n'.join(lines) + '\n',
+        config_file.replace('postgresql.conf', 'fabgis.pitr.conf'),
+        use_sudo=True)
+    if ensure_lines(
+            config_file, ['include \'fabgis.pitr.conf\''], use_sudo=True):
+        changed = True
+    if ensure_lines(
+            pg_settings['hba_file'],
+            ['local   replication     postgres                peer'],
+            use_sudo=True):
+        changed = True
+    if changed:
+        # archive_mode and wal_level only take effect after a restart
+        sudo('service postgresql restart')
+
+
+@task
+def setup_pitr_backups(
+        archive_dir=ARCHIVE_DIR,
+        backup_dir=BASE_BACKUP_DIR,
+        keep=4,
+        schedule='weekly'):
+    """Set up WAL archiving and periodic base backups.
+
+    :param archive_dir: Directory on the host that WAL is archived to.
+    :type archive_dir: str
+
+    :param backup_dir: Directory on the host for the base backups.
+    :type backup_dir: str
+
+    :param keep: Number of base backups to keep. Older base backups, and
+        the WAL only they need, are removed after each new base backup.
+    :type keep: int
+
+    :param schedule: How often to take a base backup, one of hourly, daily,
+        weekly or monthly.
+    :type schedule: str
+    """
+    setup_env()
+    setup_wal_archiving(archive_dir)
+    my_tokens = {
+        'ARCHIVE_DIR': archive_dir,
+        'BACKUP_DIR': backup_dir,
+        'KEEP': str(keep),
+    }
+    script = '/etc/cron.%s/pg_basebackup' % schedule
+    upload_template_file(
+        resource_path('server_config', 'cron', 'pg_basebackup.templ'),
+        script,
+        my_tokens,
+        use_sudo=True,
+        mode=0755)
+    if not list_base_backups(backup_dir):
+        # Recovery needs at least one base backup to start from
+        sudo(script)
+
+
+@task
+def take_base_backup(schedule='weekly'):
+    """Take a base backup now using the script installed by
+    :func:`setup_pitr_backups`.
+
+    :param schedule: Schedule the script was installed with.
+    :type schedule: str
+    """
+    sudo('/etc/cron.%s/pg_basebackup' % schedule)
+
+
+def list_base_backups(backup_dir=BASE_BACKUP_DIR):
+    """List the complete base backups on the host, oldest first.
+
+    :param backup_dir: Directory on the host with the base backups.
+    :type backup_dir: str
+
+    :returns: Names of the base backup directories e.g.
+        base-20131120020000.
+    :rtype: list
+    """
+    with hide('output'):
+        output = sudo(
+            'for DIR in %s/base-*; do [ -f $DIR/complete ] && '
+            'basename $DIR; done; true' % backup_dir)
+    return sorted(
+        line.strip() for line in output.splitlines()
+        if line.strip().startswith('base-'))
+
+
+@task
+def restore_to_timestamp(
+        target_time,
+        archive_dir=ARCHIVE_DIR,
+        backup_dir=BASE_BACKUP_DIR):
+    """Restore the whole cluster to its state at a point in time.
+
+    The newest base backup taken before the target time is unpacked into a
+    fresh data directory and postgres replays the archived WAL up to the
+    target time on start up. The current data directory is kept next to it
+    with a .fabgis-<timestamp> suffix.
+
+    Tablespaces other than the default ones are not restored.
+
+    :param target_time: Time to recover to, in the server's time zone
+        unless one is given e.g. '2013-11-20 14:30:00'.
+    :type target_time: str
+
+    :param archive_dir: Directory on the host that WAL is archived to.
+    :type archive_dir: str
+
+    :param backup_dir: Directory on the host with the base backups.
+    :type backup_dir: str
+    """
+    setup_env()
+    # e.g. 2013-11-20 14:30:00 -> 20131120143000
+    target_stamp = ''.join(
+        character for character in target_time if character.isdigit())[:14]
+    backups = [
+        backup for backup in list_base_backups(backup_dir)
+        if backup[len('base-'):] <= target_stamp]
+    if not backups:
+        abort('There is no base backup from before %s' % target_time)
+    backup = '%s/%s' % (backup_dir, backups[-1])
+    fastprint(green('Restoring %s to %s\n' % (backup, target_time)))
+
+    data_dir = postgres_settings()['data_directory']
+    moved_dir = '%s.fabgis-%s' % (data_dir, time.strftime('%Y%m%d%H%M%S'))
+    sudo('service postgresql stop')
+    sudo(
+        'mv %(data)s %(moved)s && mkdir %(data)s && '
+        'tar -xzf %(backup)s/data/base.tar.gz -C %(data)s && '
+        'rm -rf %(data)s/pg_xlog && mkdir -p %(data)s/pg_xlog/archive_status'
+        % {'data': data_dir, 'moved': moved_dir, 'backup': backup})
+    recovery = (
+        'restore_command = \'cp %s/%%f "%%p"\'\n'
+        'recovery_target_time = \'%s\'\n' % (archive_dir, target_time))
+    upload_content(recovery, '%s/recovery.conf' % data_dir, use_sudo=True)
+    sudo('chown -R postgres:postgres %s && chmod 700 %s' % (
+        data_dir, data_dir))
+    sudo('service postgresql start')
+    fastprint(green(
+        'Postgres is replaying WAL up to %s. The previous data directory '
+        'was kept in %s\n' % (target_time, moved_dir)))
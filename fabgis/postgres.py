@@ -1,12 +1,59 @@
 # coding=utf-8
 """Postgres related fabric tasks and helpers."""
 import os
+import re
+import shutil
+import time
 import fabtools
-from fabric.contrib.files import exists
 from fabtools.postgres import create_user
-from fabric.api import run, cd, env, task, sudo, get, put
+from fabric.api import (
+    run, cd, env, task, sudo, local, hide, settings, fastprint, abort)
+from fabric.colors import green, yellow
 from .common import setup_env, show_environment, add_ubuntugis_ppa
-from .utilities import replace_tokens
+from .utilities import as_bool, resource_path, upload_template_file
+from .packages import require_packages
+from .pitr import setup_pitr_backups
+from .pgbouncer import update_pgbouncer_userlist
+from .sql import (
+    execute_sql,
+    sql_literal,
+    sql_identifier,
+    database_exists,
+    user_exists,
+    create_user_sql,
+    create_database_sql)
+from .dedup import ChunkStore
+from .transfer import (
+    STREAM_COMPRESSORS,
+    sync_file,
+    download_file,
+    download_directory,
+    upload_directory,
+    stream_compressor,
+    path_compressor,
+    ssh_command,
+    stream_from_host,
+    stream_to_host)
+
+POSTGIS_2_PACKAGES = [
+    'build-essential',
+    'postgresql-9.1-postgis-2.0',
+    'postgresql-9.1-postgis-2.0-scripts',
+    'postgresql-server-dev-all']
+
+# Packages needed to build postgis 1.5 from source
+POSTGIS_1_5_PACKAGES = [
+    'postgresql-server-dev-all',
+    'build-essential',
+    'libxml2-dev',
+    'libgeos-dev',
+    'libgdal1-dev',
+    'libproj-dev']
+
+# Local deduplicating store for dumps, see fabgis.dedup
+DEDUP_STORE = os.path.join('fabgis_resources', 'sql', 'store')
+# Where setup_nightly_backups installs fabgis/dedup.py on the host
+REMOTE_DEDUP_SCRIPT = '/usr/local/lib/fabgis/dedup.py'
 
 
 @task
@@ -19,18 +66,11 @@ def require_postgres_user(user, password='', createdb=False):
     """
     #sudo('apt-get upgrade')
     # wsgi user needs pg access to the db
-    if not fabtools.postgres.user_exists(user):
-        # noinspection PyArgumentEqualDefault
-        fabtools.postgres.create_user(
-            name=user,
-            password=password,
-            superuser=False,
-            createdb=createdb,
-            createrole=False,
-            inherit=True,
-            login=True,
-            connection_limit=None,
-            encrypted_password=False)
+    if not user_exists(user):
+        execute_sql(create_user_sql(
+            user, password=password, createdb=createdb))
+        # Let the new user connect through pgbouncer too
+        update_pgbouncer_userlist()
 
 
 def setup_postgres_superuser(user, password=''):
@@ -39,48 +79,90 @@ def setup_postgres_superuser(user, password=''):
     :param user: User name for new super user.
     :param password:  Password for new user.
     """
-    if not fabtools.postgres.user_exists(user):
-        fabtools.postgres.create_user(
-            user,
-            password=password,
-            createdb=True,
-            createrole=True,
-            superuser=True,
-            connection_limit=20)
+    if not user_exists(user):
+        execute_sql(superuser_sql(user, password))
+
+
+def superuser_sql(user, password=''):
+    """Get the statement creating a super user for postgresql.
+
+    :param user: User name for new super user.
+    :param password:  Password for new user.
+    """
+    return create_user_sql(
+        user,
+        password=password,
+        createdb=True,
+        createrole=True,
+        superuser=True,
+        connection_limit=20)
+
+
+def missing_objects(databases=None, users=None):
+    """Find out which of some databases and roles do not exist yet.
+
+    :param databases: Names of databases.
+    :type databases: list
+
+    :param users: Names of roles.
+    :type users: list
+
+    :returns: The names of the databases and the names of the roles that
+        do not exist, checked in one query.
+    :rtype: tuple
+    """
+    databases = databases or []
+    users = users or []
+    checks = [
+        'SELECT count(*) FROM pg_database WHERE datname = %s' %
+        sql_literal(name) for name in databases]
+    checks += [
+        'SELECT count(*) FROM pg_roles WHERE rolname = %s' %
+        sql_literal(name) for name in users]
+    counts = execute_sql('SELECT %s' % ', '.join(
+        '(%s)' % check for check in checks))[0][0]
+    return (
+        [name for name, count in zip(databases, counts) if count == '0'],
+        [name for name, count in zip(users, counts[len(databases):])
+         if count == '0'])
+
+
+def create_postgis_template(sql_path):
+    """Create the template_postgis database in one psql session.
+
+    The super user for the login user is created first if needed.
+
+    :param sql_path: Directory on the host with postgis.sql and
+        spatial_ref_sys.sql.
+    :type sql_path: str
+    """
+    databases, users = missing_objects(['template_postgis'], [env.user])
+    if not databases:
+        return
+    statements = [superuser_sql(user) for user in users]
+    statements += [
+        create_database_sql('template_postgis', env.user),
+        'UPDATE pg_database SET datistemplate = TRUE '
+        'WHERE datname = \'template_postgis\'',
+        '\\c template_postgis',
+        '\\i %s/postgis.sql' % sql_path,
+        '\\i %s/spatial_ref_sys.sql' % sql_path,
+        'GRANT ALL ON geometry_columns, geography_columns, spatial_ref_sys '
+        'TO PUBLIC']
+    execute_sql(statements)
 
 
 @task
 def create_postgis_2_template():
     """Create the postgis 2 template db."""
-    if not fabtools.postgres.database_exists('template_postgis'):
-        setup_postgres_superuser(env.user)
-        # noinspection PyArgumentEqualDefault
-        fabtools.require.postgres.database(
-            'template_postgis',
-            owner='%s' % env.user,
-            encoding='UTF8')
-        sql = ('UPDATE pg_database SET datistemplate = TRUE WHERE datname = '
-               '\'template_postgis\';')
-        run('psql template1 -c "%s"' % sql)
-        sql_path = '/usr/share/postgresql/9.1/contrib/postgis-2.0/'
-        run('psql template_postgis -f %s/postgis.sql' % sql_path)
-        run('psql template_postgis -f %s/spatial_ref_sys.sql' % sql_path)
-        grant_sql = 'GRANT ALL ON geometry_columns TO PUBLIC;'
-        run('psql template_postgis -c "%s"' % grant_sql)
-        grant_sql = 'GRANT ALL ON geography_columns TO PUBLIC;'
-        run('psql template_postgis -c "%s"' % grant_sql)
-        grant_sql = 'GRANT ALL ON spatial_ref_sys TO PUBLIC;'
-        run('psql template_postgis -c "%s"' % grant_sql)
+    create_postgis_template('/usr/share/postgresql/9.1/contrib/postgis-2.0')
 
 
 @task
 def setup_postgis_2():
     """Set up postgis 2.0 from packages in ubuntugis."""
     add_ubuntugis_ppa()
-    fabtools.require.deb.package('build-essential')
-    fabtools.require.deb.package('postgresql-9.1-postgis-2.0')
-    fabtools.require.deb.package('postgresql-9.1-postgis-2.0-scripts')
-    fabtools.require.deb.package('postgresql-server-dev-all')
+    require_packages(POSTGIS_2_PACKAGES)
     create_postgis_2_template()
 
 
@@ -97,19 +179,13 @@ def setup_postgis_1_5():
     pg_file = '/usr/share/postgresql/9.1/contrib/postgis-1.5/postgis.sql'
     if not fabtools.files.is_file(pg_file):
         add_ubuntugis_ppa()
-        fabtools.require.deb.package('postgresql-server-dev-all')
-        fabtools.require.deb.package('build-essential')
+        require_packages(POSTGIS_1_5_PACKAGES)
 
         # Note - no postgis installation from package as we want to build 1.5
         # from source
         fabtools.require.postgres.server()
 
         # Now get and install postgis 1.5 if needed
-
-        fabtools.require.deb.package('libxml2-dev')
-        fabtools.require.deb.package('libgeos-dev')
-        fabtools.require.deb.package('libgdal1-dev')
-        fabtools.require.deb.package('libproj-dev')
         source_url = ('http://download.osgeo.org/postgis/source/'
                       'postgis-1.5.8.tar.gz')
         source = 'postgis-1.5.8'
@@ -127,26 +203,7 @@ def setup_postgis_1_5():
 @task
 def create_postgis_1_5_template():
     """Create the postgis template db."""
-    if not fabtools.postgres.database_exists('template_postgis'):
-        setup_postgres_superuser(env.user)
-        # noinspection PyArgumentEqualDefault
-        fabtools.require.postgres.database(
-            'template_postgis',
-            owner='%s' % env.user,
-            encoding='UTF8')
-        sql = ('UPDATE pg_database SET datistemplate = TRUE WHERE datname = '
-               '\'template_postgis\';')
-        run('psql template1 -c "%s"' % sql)
-        run('psql template_postgis -f /usr/share/postgresql/'
-            '9.1/contrib/postgis-1.5/postgis.sql')
-        run('psql template_postgis -f /usr/share/postgresql/9'
-            '.1/contrib/postgis-1.5/spatial_ref_sys.sql')
-        grant_sql = 'GRANT ALL ON geometry_columns TO PUBLIC;'
-        run('psql template_postgis -c "%s"' % grant_sql)
-        grant_sql = 'GRANT ALL ON geography_columns TO PUBLIC;'
-        run('psql template_postgis -c "%s"' % grant_sql)
-        grant_sql = 'GRANT ALL ON spatial_ref_sys TO PUBLIC;'
-        run('psql template_postgis -c "%s"' % grant_sql)
+    create_postgis_template('/usr/share/postgresql/9.1/contrib/postgis-1.5')
 
 
 @task
@@ -156,25 +213,118 @@ def create_postgis_1_5_db(dbname, user):
     :param user: User who should own the created db
     """
     setup_postgis_1_5()
-    setup_postgres_superuser(env.user)
-    require_postgres_user(user)
-    fabtools.require.postgres.database(
-        '%s' % dbname, owner='%s' % user, template='template_postgis')
-
-    grant_sql = 'GRANT ALL ON schema public to %s;' % user
-    # assumption is env.repo_alias is also database name
-    run('psql %s -c "%s"' % (dbname, grant_sql))
-    grant_sql = (
-        'GRANT ALL ON ALL TABLES IN schema public to %s;' % user)
+    databases, users = missing_objects([dbname], [env.user, user])
+    statements = []
+    if env.user in users:
+        statements.append(superuser_sql(env.user))
+    if user in users and user != env.user:
+        statements.append(create_user_sql(user))
+    if databases:
+        statements.append(
+            create_database_sql(dbname, user, template='template_postgis'))
     # assumption is env.repo_alias is also database name
-    run('psql %s -c "%s"' % (dbname, grant_sql))
-    grant_sql = (
-        'GRANT ALL ON ALL SEQUENCES IN schema public to %s;' % user)
-    run('psql %s -c "%s"' % (dbname, grant_sql))
+    statements.append('\\c %s' % dbname)
+    for objects in [
+            'schema public',
+            'ALL TABLES IN schema public',
+            'ALL SEQUENCES IN schema public']:
+        statements.append(
+            'GRANT ALL ON %s to %s' % (objects, sql_identifier(user)))
+    execute_sql(statements)
+    if user in users and user != env.user:
+        # Let the new user connect through pgbouncer too
+        update_pgbouncer_userlist()
+
+
+def local_dump_path(file_name):
+    """Get the local path for a dump of the current host.
+
+    When a task runs against more than one host, the dumps of each host are
+    kept in their own sub directory so that hosts can not overwrite each
+    other's dumps.
+
+    :param file_name: File name of the dump (without any path).
+    :type file_name: str
+
+    :returns: Path relative to the fabfile directory e.g.
+        fabgis_resources/sql/dumps/<file_name>.
+    :rtype: str
+    """
+    dump_dir = os.path.join('fabgis_resources', 'sql', 'dumps')
+    if len(env.all_hosts) > 1:
+        dump_dir = os.path.join(dump_dir, env.host)
+        if not os.path.exists(dump_dir):
+            os.makedirs(dump_dir)
+    return os.path.join(dump_dir, file_name)
+
+
+def dump_jobs():
+    """Get the number of parallel workers to use for dumps of the host.
+
+    We use one worker per processor, but no more than two on hosts with
+    spinning disks where more concurrent readers mostly add seeking.
+
+    :returns: Number of workers.
+    :rtype: int
+    """
+    facts = env.fg.facts
+    jobs = facts.cpu_count or 1
+    if facts.disk_rotational:
+        jobs = min(jobs, 2)
+    return jobs
+
+
+def pg_dump_version():
+    """Get the version of pg_dump on the host.
+
+    :returns: Version number e.g. 90200 for 9.2.
+    :rtype: int
+    """
+    with hide('output'):
+        output = run('pg_dump --version')
+    version = re.search(r'(\d+)\.(\d+)', output)
+    return int(version.group(1)) * 10000 + int(version.group(2)) * 100
+
+
+def parallel_dump_jobs(dbname, jobs):
+    """Limit the number of dump workers to what the host's postgres supports.
+
+    pg_dump supports parallel workers from version 9.3 and they need a 9.2
+    or newer server to share a consistent snapshot. With older versions we
+    fall back to a single worker.
+
+    :param dbname: Name of the database that will be dumped.
+    :type dbname: str
+
+    :param jobs: Number of workers we would like to use.
+    :type jobs: int
+
+    :returns: Number of workers that can be used.
+    :rtype: int
+    """
+    if jobs <= 1:
+        return 1
+    with hide('output'):
+        server_version = int(
+            run('psql -Atc "SHOW server_version_num" %s' % dbname))
+    if pg_dump_version() < 90300 or server_version < 90200:
+        fastprint(yellow(
+            'Parallel dumps need pg_dump 9.3 and a 9.2 server, '
+            'dumping with a single worker.\n'))
+        return 1
+    return jobs
 
 
 @task
-def get_postgres_dump(dbname, ignore_permissions=False, file_name=None):
+def get_postgres_dump(
+        dbname,
+        ignore_permissions=False,
+        file_name=None,
+        directory=False,
+        jobs=None,
+        stream=False,
+        compression=None,
+        dedup=False):
     """Get a dump of the database from the server.
 
     :param dbname: name of the database to restore the dump into.
@@ -189,24 +339,235 @@ def get_postgres_dump(dbname, ignore_permissions=False, file_name=None):
         fabgis_resources/sql/dumps/<dbname>->date>.dmp
         where date is in the form dd-mm-yyyy. This is the default naming
         convention used by the :func:`restore_postgres_dump` function below.
+        When run against more than one host, dumps are written to
+        fabgis_resources/sql/dumps/<host>/ instead.
     :type file_name: str
+
+    :param directory: whether to make a directory format dump rather than a
+        single custom format file. Directory format dumps are made by
+        several workers in parallel and are downloaded as one tar stream.
+        The default name of the dump directory ends in .dir rather than
+        .dmp.
+    :type directory: bool (default False)
+
+    :param jobs: number of parallel workers for directory format dumps.
+        Defaults to the number of processors on the host, limited to two
+        for hosts with spinning disks.
+    :type jobs: int
+
+    :param stream: whether to stream the dump straight into the local dump
+        file over ssh rather than writing it to /tmp on the host and then
+        downloading it. Ignored for directory format dumps.
+    :type stream: bool (default False)
+
+    :param compression: compressor for streamed dumps, one of gzip, zstd or
+        lz4, if it is available locally and on the host. The dump is stored
+        compressed with the compressor's extension (e.g. .dmp.zst) added to
+        the default file name. Without it pg_dump's own compression is used.
+    :type compression: str
+
+    :param dedup: whether to also add the dump to the local deduplicating
+        store in fabgis_resources/sql/store as a snapshot named
+        <host>-<dbname>, see :mod:`fabgis.dedup`. The dump is made without
+        compression so that it deduplicates well against earlier dumps.
+        Ignored for directory format dumps.
+    :type dedup: bool (default False)
+
+    :returns: The snapshot when the dump was added to the store.
+    :rtype: dict
     """
     setup_env()
-
+    directory = as_bool(directory)
+    stream = as_bool(stream)
+    dedup = as_bool(dedup)
+
+    if directory:
+        extension = 'dir'
+        stream = False
+        dedup = False
+    else:
+        extension = 'dmp'
+    if dedup:
+        # Compressed dumps change completely after small changes
+        compression = None
+    if stream:
+        compression = stream_compressor(compression)
+        if compression:
+            extension += STREAM_COMPRESSORS[compression]
     if file_name is None or file_name == '':
         date = run('date +%d-%B-%Y')
-        my_file = '%s-%s.dmp' % (dbname, date)
+        my_file = '%s-%s.%s' % (dbname, date, extension)
     else:
         my_file = os.path.split(file_name)[1]
-        put(file_name, '/tmp/%s' % my_file)
 
     if not ignore_permissions:
         extra_args = ''
     else:
         extra_args = '-x -O'
+    if dedup:
+        extra_args += ' -Z 0'
+
+    if directory:
+        if jobs is None:
+            jobs = dump_jobs()
+        jobs = parallel_dump_jobs(dbname, int(jobs))
+        if jobs > 1:
+            extra_args += ' -j %i' % jobs
+        remote_dir = '/tmp/%s' % my_file
+        run('rm -rf %s && pg_dump %s -Fd -f %s %s' % (
+            remote_dir, extra_args, remote_dir, dbname))
+        local_dir = local_dump_path(my_file)
+        if os.path.exists(local_dir):
+            shutil.rmtree(local_dir)
+        # The table files are already compressed by the dump workers
+        download_directory(remote_dir, local_dir)
+        run('rm -rf %s' % remote_dir)
+        return
+
+    if stream:
+        if compression:
+            # Let the stream compressor do all of the compression
+            extra_args += ' -Z 0'
+        stream_from_host(
+            'pg_dump %s -Fc %s' % (extra_args, dbname),
+            local_dump_path(my_file),
+            compression)
+    else:
+        run('pg_dump %s -Fc -f /tmp/%s %s' % (extra_args, my_file, dbname))
+        download_file('/tmp/%s' % my_file, local_dump_path(my_file))
+    if dedup:
+        return ingest_dump(local_dump_path(my_file), dbname)
 
-    run('pg_dump %s -Fc -f /tmp/%s %s' % (extra_args, my_file, dbname))
-    get('/tmp/%s' % my_file, 'fabgis_resources/sql/dumps/%s' % my_file)
+
+def ingest_dump(file_name, dbname):
+    """Add a dump of the current host to the local deduplicating store.
+
+    Snapshots are named <host>-<dbname> so dumps of one database on
+    several hosts (e.g. replicas) share their chunks.
+
+    :param file_name: Local path of the dump.
+    :type file_name: str
+
+    :param dbname: Name of the dumped database.
+    :type dbname: str
+
+    :returns: The new snapshot.
+    :rtype: dict
+    """
+    store = ChunkStore(DEDUP_STORE)
+    try:
+        snapshot = store.ingest(file_name, '%s-%s' % (env.host, dbname))
+    finally:
+        store.close()
+    fastprint(yellow('Stored %s, %i of %i bytes were new\n' % (
+        snapshot['id'], snapshot['added'], snapshot['size'])))
+    return snapshot
+
+
+@task
+def dedup_store_stats():
+    """Show the snapshots and the dedup ratio of the local dump store."""
+    store = ChunkStore(DEDUP_STORE)
+    try:
+        snapshots = store.snapshots()
+        stats = store.stats()
+    finally:
+        store.close()
+    for snapshot in snapshots:
+        fastprint('%s %i\n' % (snapshot['id'], snapshot['size']))
+    fastprint(yellow(
+        '%(snapshots)i snapshots of %(logical_size)i bytes stored in '
+        '%(stored_size)i bytes, a dedup ratio of %(ratio).1f\n' % stats))
+
+
+@task
+def restore_dedup_snapshot(snapshot_id, dbname, user=None, parallel=False):
+    """Restore a snapshot from the local dump store into a database.
+
+    The dump is rebuilt in fabgis_resources/sql/dumps and then restored with
+    :func:`restore_postgres_dump`.
+
+    :param snapshot_id: Id of the snapshot as listed by
+        :func:`dedup_store_stats` e.g. foo.com-gis.20131120020000.
+    :type snapshot_id: str
+
+    :param dbname: name of the database to restore the dump into.
+    :type dbname: str
+
+    :param user: user that the db should be restored for.
+    :type user: str
+
+    :param parallel: whether to restore with parallel workers into a
+        temporary database that is swapped in when done.
+    :type parallel: bool (default False)
+    """
+    store = ChunkStore(DEDUP_STORE)
+    try:
+        file_name = local_dump_path(
+            store.load_snapshot(snapshot_id)['file_name'])
+        store.restore(snapshot_id, file_name)
+    finally:
+        store.close()
+    restore_postgres_dump(
+        dbname, user=user, file_name=file_name, parallel=as_bool(parallel))
+
+
+def server_version_num():
+    """Get the version of the postgres server on the host.
+
+    :returns: Version number e.g. 90111 for 9.1.11.
+    :rtype: int
+    """
+    with hide('output'):
+        return int(run('psql -Atc "SHOW server_version_num" template1'))
+
+
+def swap_databases(dbname, new_dbname):
+    """Replace a database with another one by renaming it.
+
+    New connections to the existing database are refused and open ones are
+    terminated. Both renames then happen in one transaction so clients see
+    either the old or the new database, never none. The old database is
+    dropped afterwards.
+
+    :param dbname: Name of the database to replace. It need not exist.
+    :type dbname: str
+
+    :param new_dbname: Name of the database that should take its place.
+    :type new_dbname: str
+    """
+    old_dbname = '%s_fabgis_old' % dbname
+    if database_exists(old_dbname):
+        run('dropdb %s' % old_dbname)
+    if not database_exists(dbname):
+        run('psql template1 -c "ALTER DATABASE %s RENAME TO %s;"' % (
+            new_dbname, dbname))
+        return
+    if server_version_num() < 90200:
+        pid_column = 'procpid'
+    else:
+        pid_column = 'pid'
+    terminate_sql = (
+        'UPDATE pg_database SET datallowconn = FALSE '
+        'WHERE datname = \'%(db)s\'; '
+        'SELECT pg_terminate_backend(%(pid)s) FROM pg_stat_activity '
+        'WHERE datname = \'%(db)s\' AND %(pid)s <> pg_backend_pid(); '
+        # Give the terminated backends a moment to exit
+        'SELECT pg_sleep(1);' % {'db': dbname, 'pid': pid_column})
+    rename_sql = (
+        'ALTER DATABASE %s RENAME TO %s; '
+        'ALTER DATABASE %s RENAME TO %s;' % (
+            dbname, old_dbname, new_dbname, dbname))
+    run('psql template1 -c "%s"' % terminate_sql)
+    with settings(warn_only=True):
+        # Several statements in one -c run as a single transaction
+        result = run('psql template1 -c "%s"' % rename_sql)
+    if result.failed:
+        run('psql template1 -c "UPDATE pg_database SET datallowconn = TRUE '
+            'WHERE datname = \'%s\';"' % dbname)
+        abort('Could not swap %s into place, %s was left untouched.' % (
+            new_dbname, dbname))
+    run('dropdb %s' % old_dbname)
 
 
 @task
@@ -215,9 +576,21 @@ def restore_postgres_dump(
         user=None,
         password='',
         ignore_permissions=False,
-        file_name=None):
+        file_name=None,
+        parallel=False,
+        jobs=None,
+        stream=False):
     """Upload dump to host, remove existing db, recreate then restore dump.
 
+    In parallel mode the dump is instead restored with several pg_restore
+    workers into an empty temporary database created from template0, while
+    the existing database stays online. Postgis is created by the dump
+    itself. When the restore has finished the temporary database is renamed
+    over the existing one, so the database is only unavailable for the
+    duration of the rename. If pg_restore reports errors other than
+    objects that already exist, the temporary database is dropped and the
+    restore is aborted.
+
     :param dbname: name of the database to restore the dump into.
     :type dbname: str
 
@@ -238,22 +611,88 @@ def restore_postgres_dump(
         fabgis_resources/sql/dumps/<dbname>->date>.dmp
         where date is in the form dd-mm-yyyy. This is the default naming
         convention used by the :func:`get_postgres_dump` function above.
+        Directory format dumps (see :func:`get_postgres_dump`) are restored
+        in parallel mode.
     :type file_name: str
+
+    :param parallel: whether to restore with parallel workers into a
+        temporary database that is swapped in when done.
+    :type parallel: bool (default False)
+
+    :param jobs: number of parallel restore workers. Defaults to the number
+        of processors on the host, limited to two for hosts with spinning
+        disks.
+    :type jobs: int
+
+    :param stream: whether to stream the dump over ssh straight into
+        pg_restore rather than uploading it to /tmp on the host first.
+        Streamed dumps are restored by a single worker. Dumps compressed
+        by :func:`get_postgres_dump` (e.g. .dmp.zst) are always streamed.
+    :type stream: bool (default False)
     """
     setup_env()
+    ignore_permissions = as_bool(ignore_permissions)
+    parallel = as_bool(parallel)
+    stream = as_bool(stream)
     if user is None:
         user = env.fg.user
     show_environment()
     require_postgres_user(user, password=password)
     if file_name is None or file_name == '':
         date = run('date +%d-%B-%Y')
-        my_file = '%s-%s.dmp' % (dbname, date)
-        put('fabgis_resources/sql/dumps/%s' % my_file, '/tmp/%s' % my_file)
+        extensions = ['dmp', 'dir'] + [
+            'dmp' + extension for extension in STREAM_COMPRESSORS.values()]
+        for extension in extensions:
+            my_file = '%s-%s.%s' % (dbname, date, extension)
+            file_name = local_dump_path(my_file)
+            if os.path.exists(file_name):
+                break
     else:
-        my_file = os.path.split(file_name)[1]
-        put(file_name, '/tmp/%s' % my_file)
+        my_file = os.path.split(file_name.rstrip('/'))[1]
+    if os.path.isdir(file_name):
+        run('rm -rf /tmp/%s' % my_file)
+        upload_directory(file_name, '/tmp/%s' % my_file)
+        parallel = True
+        stream = False
+    elif path_compressor(file_name):
+        stream = True
+    elif not stream:
+        sync_file(file_name, '/tmp/%s' % my_file)
 
-    if fabtools.postgres.database_exists(dbname):
+    if not ignore_permissions:
+        extra_args = ''
+    else:
+        extra_args = '-x -O'
+
+    if parallel:
+        if jobs is None:
+            jobs = dump_jobs()
+        temp_dbname = '%s_fabgis_restore' % dbname
+        if database_exists(temp_dbname):
+            run('dropdb %s' % temp_dbname)
+        # An empty database, postgis comes with the dump. Restoring into a
+        # copy of template_postgis would fail on the existing functions.
+        execute_sql(create_database_sql(temp_dbname, user))
+        # pg_restore exits with an error for any failed statement, so its
+        # errors are logged and checked by restore_errors instead
+        log_file = '/tmp/%s.log' % temp_dbname
+        if stream:
+            stream_to_host(
+                file_name, 'pg_restore %s -d %s 2> %s; true' % (
+                    extra_args, temp_dbname, log_file))
+        else:
+            # Data is loaded and indexes are built by several workers at once
+            run('pg_restore %s -j %i -d %s /tmp/%s 2> %s; true' % (
+                extra_args, int(jobs), temp_dbname, my_file, log_file))
+        errors = restore_errors(log_file)
+        if errors:
+            run('dropdb %s' % temp_dbname)
+            abort('Restoring %s failed, %s was left untouched:\n%s' % (
+                file_name, dbname, '\n'.join(errors[:20])))
+        swap_databases(dbname, temp_dbname)
+        return
+
+    if database_exists(dbname):
         run('dropdb %s' % dbname)
 
     # noinspection PyArgumentEqualDefault
@@ -263,44 +702,304 @@ def restore_postgres_dump(
         template='template_postgis',
         encoding='UTF8')
 
-    if not ignore_permissions:
-        extra_args = ''
+    if stream:
+        # Through psql like an uploaded dump, which carries on past the
+        # postgis objects that template_postgis already has
+        stream_to_host(
+            file_name, 'pg_restore %s | psql %s' % (extra_args, dbname))
     else:
-        extra_args = '-x -O'
-    run('pg_restore %s /tmp/%s | psql %s' % (extra_args, my_file, dbname))
+        run('pg_restore %s /tmp/%s | psql %s' % (
+            extra_args, my_file, dbname))
+
+
+def restore_errors(log_file):
+    """Get the unexpected errors from the log of a pg_restore run.
+
+    Objects that are already in the database (e.g. the public schema) are
+    reported as errors by pg_restore but are harmless. The log is removed.
+
+    :param log_file: Path on the host of the standard error of pg_restore.
+    :type log_file: str
+
+    :returns: The lines of the log that report other errors.
+    :rtype: list
+    """
+    with hide('output'):
+        output = run(
+            'grep -E "ERROR|error:|could not" %s | '
+            'grep -v "already exists"; rm -f %s; true' % (
+                log_file, log_file))
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
+def abandon_clone(temp_dbname, errors, ignore_permissions):
+    """Drop a half built clone on the current host and abort.
+
+    :param temp_dbname: Name of the database the clone was restored into.
+    :type temp_dbname: str
+
+    :param errors: Errors reported by pg_restore.
+    :type errors: list
+
+    :param ignore_permissions: Whether the clone was made without
+        ownership and permissions.
+    :type ignore_permissions: bool
+    """
+    run('dropdb %s' % temp_dbname)
+    message = 'Cloning failed and %s was dropped.' % temp_dbname
+    if errors:
+        message += '\n%s' % '\n'.join(errors[:20])
+    if not as_bool(ignore_permissions):
+        message += (
+            '\nIf roles of the source database are missing, create them on '
+            'the target host first or clone with ignore_permissions=True.')
+    abort(message)
+
+
+def copy_database(dbname, new_dbname, owner, terminate=True):
+    """Copy a database on the same cluster with CREATE DATABASE TEMPLATE.
+
+    Postgres copies the files of the database directly, which is much
+    faster than a dump and restore, but it needs the source database to
+    have no other connections while it copies.
+
+    :param dbname: Name of the database to copy.
+    :type dbname: str
+
+    :param new_dbname: Name of the new database.
+    :type new_dbname: str
+
+    :param owner: Role that will own the new database.
+    :type owner: str
+
+    :param terminate: Whether to refuse new connections to the source
+        database and terminate the open ones for the duration of the copy.
+        Otherwise the copy fails if anyone is connected.
+    :type terminate: bool (default True)
+    """
+    allow_sql = 'UPDATE pg_database SET datallowconn = %s WHERE datname = %s'
+    create_sql = 'CREATE DATABASE %s OWNER %s TEMPLATE %s' % (
+        sql_identifier(new_dbname), sql_identifier(owner),
+        sql_identifier(dbname))
+    if not terminate:
+        execute_sql(create_sql)
+        return
+    if server_version_num() < 90200:
+        pid_column = 'procpid'
+    else:
+        pid_column = 'pid'
+    try:
+        # Each statement commits on its own, so that no new connections are
+        # accepted by the time the open ones are terminated
+        execute_sql([
+            allow_sql % ('FALSE', sql_literal(dbname)),
+            'SELECT pg_terminate_backend(%(pid)s) FROM pg_stat_activity '
+            'WHERE datname = %(db)s AND %(pid)s <> pg_backend_pid()' % {
+                'db': sql_literal(dbname), 'pid': pid_column},
+            # Give the terminated backends a moment to exit
+            'SELECT pg_sleep(1)',
+            create_sql], transaction=False)
+    finally:
+        execute_sql(allow_sql % ('TRUE', sql_literal(dbname)))
 
 
 @task
-def setup_nightly_backups():
+def clone_postgres_db(
+        dbname,
+        new_dbname,
+        target_host=None,
+        user=None,
+        terminate=True,
+        ignore_permissions=False,
+        jobs=None,
+        compress=False):
+    """Clone a database, e.g. a copy of production for staging.
+
+    On the same host the database is copied with ``CREATE DATABASE ...
+    TEMPLATE``, which takes minutes where a dump and restore takes hours.
+    Connections to the source database are refused and terminated while
+    it is copied, see :func:`copy_database`.
+
+    To another host the output of pg_dump is piped over ssh (through the
+    machine running fabric) straight into pg_restore, nothing is written
+    to disk on either side. pg_restore can only restore in parallel from a
+    file, so the schema and data are streamed and then the indexes and
+    constraints, which are the slow part, are built by several workers
+    from a small post-data dump. Servers older than 9.2 can not dump
+    sections and are restored by a single worker.
+
+    In both cases the clone is made under a temporary name and renamed
+    into place when done, so an existing database of that name stays
+    available until then (see :func:`swap_databases`).
+
+    :param dbname: Name of the database to clone.
+    :type dbname: str
+
+    :param new_dbname: Name of the clone.
+    :type new_dbname: str
+
+    :param target_host: Host string of the host to clone to. Defaults to
+        the current host.
+    :type target_host: str
+
+    :param user: Role that will own the clone. Defaults to the login user
+        of the target host, which is created if needed.
+    :type user: str
+
+    :param terminate: Whether connections to the source database may be
+        terminated for a same host clone.
+    :type terminate: bool (default True)
+
+    :param ignore_permissions: whether ownership and permissions of the
+        source database should be dropped when cloning to another host.
+    :type ignore_permissions: bool (default False)
+
+    :param jobs: number of workers building indexes on the target host.
+        Defaults to the number of processors on the target host, limited to
+        two for hosts with spinning disks.
+    :type jobs: int
+
+    :param compress: whether ssh should compress the stream between the
+        hosts. Worth it when they are far apart.
+    :type compress: bool (default False)
+    """
+    setup_env()
+    if not database_exists(dbname):
+        abort('There is no database %s to clone.' % dbname)
+    if target_host in (None, '', env.host_string, env.host):
+        if new_dbname == dbname:
+            abort('A database can not be cloned onto itself.')
+        if user is None:
+            user = env.fg.user
+        require_postgres_user(user)
+        temp_dbname = '%s_fabgis_clone' % new_dbname
+        if database_exists(temp_dbname):
+            run('dropdb %s' % temp_dbname)
+        copy_database(dbname, temp_dbname, user, as_bool(terminate))
+        swap_databases(new_dbname, temp_dbname)
+        fastprint(green('Cloned %s to %s\n' % (dbname, new_dbname)))
+        return
+
+    # pg_dump can dump sections from 9.2, whatever the server version
+    sections = pg_dump_version() >= 90200
+    extra_args = '-x -O' if as_bool(ignore_permissions) else ''
+    if sections:
+        dump_command = (
+            'pg_dump -Fc -Z0 %s --section=pre-data --section=data %s' % (
+                extra_args, dbname))
+    else:
+        dump_command = 'pg_dump -Fc -Z0 %s %s' % (extra_args, dbname)
+    post_data_command = 'pg_dump -Fc --section=post-data %s %s' % (
+        extra_args, dbname)
+    source_ssh = ssh_command(dump_command, compress=False)
+    post_data_ssh = ssh_command(post_data_command, compress=False)
+
+    post_data_file = '/tmp/%s-post-data.dmp' % new_dbname
+    with settings(host_string=target_host):
+        setup_env()
+        if user is None:
+            user = env.fg.user
+        if jobs is None:
+            jobs = dump_jobs()
+        require_postgres_user(user)
+        temp_dbname = '%s_fabgis_clone' % new_dbname
+        if database_exists(temp_dbname):
+            run('dropdb %s' % temp_dbname)
+        # An empty database, postgis comes with the dump. Restoring into a
+        # copy of template_postgis would fail on the existing functions.
+        execute_sql(create_database_sql(temp_dbname, user))
+        compress = as_bool(compress)
+        # pg_restore exits with an error for any failed statement, so its
+        # errors are logged and checked by restore_errors instead
+        log_file = '/tmp/%s.log' % temp_dbname
+        start = time.time()
+        with settings(warn_only=True):
+            result = local(
+                'set -o pipefail; %s | %s' % (source_ssh, ssh_command(
+                    'pg_restore %s -d %s 2> %s; true' % (
+                        extra_args, temp_dbname, log_file),
+                    compress=compress)),
+                shell='/bin/bash')
+        errors = restore_errors(log_file)
+        if result.failed or errors:
+            abandon_clone(temp_dbname, errors, ignore_permissions)
+        fastprint(yellow('Schema and data copied in %.0fs\n' % (
+            time.time() - start)))
+        if sections:
+            start = time.time()
+            with settings(warn_only=True):
+                result = local(
+                    'set -o pipefail; %s | %s' % (post_data_ssh, ssh_command(
+                        'cat > %s' % post_data_file, compress=compress)),
+                    shell='/bin/bash')
+            if result.succeeded:
+                run('pg_restore %s -j %i -d %s %s 2> %s; rm -f %s' % (
+                    extra_args, int(jobs), temp_dbname, post_data_file,
+                    log_file, post_data_file))
+            errors = restore_errors(log_file)
+            if result.failed or errors:
+                abandon_clone(temp_dbname, errors, ignore_permissions)
+            fastprint(yellow('Indexes and constraints built in %.0fs\n' % (
+                time.time() - start)))
+        swap_databases(new_dbname, temp_dbname)
+    # Point env.fg back at the source host
+    setup_env()
+    fastprint(green('Cloned %s to %s on %s\n' % (
+        dbname, new_dbname, target_host)))
+
+
+@task
+def setup_nightly_backups(mode='dump', jobs=None, dedup=False):
     """Setup nightly backups for all postgresql databases.
 
-    The template script :file:`fabgis_resources/server_config/cron/pg_backups`
+    The template script
+    :file:`fabgis_resources/server_config/cron/pg_backups.py.templ`
     will place the last 21 days of backups in the remote user's Dropbox
     directory and will maintain 6 months of backups in their home directory.
+    Several databases are dumped at the same time and databases that have
+    not changed since their last backup are skipped.
 
     .. seealso:: fabgis.dropbox for help on setting up dropbox on your server.
+
+    :param mode: 'dump' for nightly dumps of every database or 'pitr' for
+        continuous WAL archiving with weekly base backups instead, see
+        :mod:`fabgis.pitr`.
+    :type mode: str
+
+    :param jobs: number of databases to dump at the same time. Defaults to
+        the number of processors on the host, limited to two for hosts with
+        spinning disks.
+    :type jobs: int
+
+    :param dedup: whether to keep the 6 months of backups in a deduplicating
+        store (see :mod:`fabgis.dedup`) rather than as separate dumps. Plain
+        dumps are then only kept for 7 days and the store is mirrored to
+        Dropbox instead of the dumps.
+    :type dedup: bool (default False)
     """
+    if mode == 'pitr':
+        setup_pitr_backups()
+        return
     setup_env()
+    dedup = as_bool(dedup)
     setup_postgres_superuser(env.fg.user)
-    with cd('/etc/cron.daily/'):
-        if exists('pg_backups'):
-            sudo('rm pg_backups')
-
-        local_dir = os.path.dirname(__file__)
-        local_file = os.path.abspath(os.path.join(
-            local_dir,
-            '..',
-            '../fabgis_resources',
-            'server_config',
-            'cron',
-            'pg_backups.templ'))
-        put(local_file,
-            '/etc/cron.daily/pg_backups',
+    if jobs is None:
+        jobs = dump_jobs()
+    if dedup:
+        sudo('mkdir -p %s' % os.path.dirname(REMOTE_DEDUP_SCRIPT))
+        sync_file(
+            os.path.join(os.path.dirname(__file__), 'dedup.py'),
+            REMOTE_DEDUP_SCRIPT,
             use_sudo=True)
-
-        my_tokens = {'USER': env.fg.user, }
-        replace_tokens('/etc/cron.daily/pg_backups', my_tokens)
-
-    sudo('chmod +x /etc/cron.daily/pg_backups')
+    my_tokens = {
+        'USER': env.fg.user,
+        'JOBS': str(jobs),
+        'DEDUP': '1' if dedup else '0'}
+    upload_template_file(
+        resource_path('server_config', 'cron', 'pg_backups.py.templ'),
+        '/etc/cron.daily/pg_backups',
+        my_tokens,
+        use_sudo=True,
+        mode=0755)
     # Run once to verify it works
     sudo('/etc/cron.daily/pg_backups')
@@ -1,13 +1,13 @@
 # coding=utf-8
 """Helpers for installing proj4"""
 
-import fabtools
 from fabric.contrib.files import exists
 from fabric.api import fastprint, run, cd, env, task, sudo, settings
 
 from .system import setup_ccache
 from .common import setup_env
 from .utilities import append_if_not_present
+from .packages import require_package
 
 
 @task
@@ -20,7 +20,7 @@ def build_proj4(version='4.8.0'):
     :type version: str
     """
     setup_env()
-    fabtools.require.deb.package('build-essential')
+    require_package('build-essential')
     setup_ccache()
 
     code_base = '%s/cpp' % env.fg.workspace
@@ -36,7 +36,7 @@ def build_proj4(version='4.8.0'):
             run('wget %s' % source_url)
             run('tar xfz %s.tar.gz' % filename)
 
-    processor_count = run('cat /proc/cpuinfo | grep processor | wc -l')
+    processor_count = env.fg.facts.cpu_count
 
     with cd(code_path):
         # Dont fail if make clean does not work
@@ -9,6 +9,25 @@ from .git import update_git_checkout
 from .system import setup_ccache
 from .gdal import build_gdal
 from .postgres import create_postgis_1_5_db
+from .postgres import POSTGIS_1_5_PACKAGES
+from .packages import require_package, require_packages
+from .facts import invalidate_facts
+
+# Packages needed to build any version of QGIS (in addition to build-dep)
+QGIS_BUILD_PACKAGES = [
+    'cmake-curses-gui',
+    'grass-dev',
+    'grass',
+    'git',
+    'python-gdal',
+    'libfcgi-dev']
+
+# Extra packages needed to build QGIS 2 and master
+QGIS2_PACKAGES = [
+    'python-psycopg2',
+    'python-qscintilla2',
+    'libqscintilla2-dev',
+    'libspatialindex-dev']
 
 
 @task
@@ -23,7 +42,7 @@ def clone_qgis(branch='master', delete_local_branches=False):
     :type delete_local_branches: bool
     """
     setup_env()
-    fabtools.require.deb.package('git')
+    require_package('git')
     # Add this to the users git config so that we don't get repeated
     # authentication requests when using ssl
     #run('git config --global credential.helper \'cache --timeout=3600\'')
@@ -61,12 +80,7 @@ def compile_qgis(build_path, build_prefix, gdal_from_source=False):
     :type gdal_from_source: bool
     """
 
-    fabtools.require.deb.package('cmake-curses-gui')
-    fabtools.require.deb.package('grass-dev')
-    fabtools.require.deb.package('grass')
-    fabtools.require.deb.package('git')
-    fabtools.require.deb.package('python-gdal')
-    fabtools.require.deb.package('libfcgi-dev')
+    require_packages(QGIS_BUILD_PACKAGES)
     # Ensure we always have a clean build dir
     if exists(build_path):
         run('rm -rf %s' % build_path)
@@ -76,8 +90,7 @@ def compile_qgis(build_path, build_prefix, gdal_from_source=False):
             build_prefix,
             use_sudo=True,
             owner=env.fg.user)
-        os_version = run('cat /etc/issue.net')
-        os_version = float(os_version.split(' ')[1])
+        os_version = float(env.fg.facts.os_version)
 
         if os_version > 13:
             extra = '-DPYTHON_LIBRARY=/usr/lib/x86_64-linux-gnu/libpython2.7.so'
@@ -98,8 +111,7 @@ def compile_qgis(build_path, build_prefix, gdal_from_source=False):
                  '%s'
                  % (build_prefix, extra))
         run('cmake .. %s' % cmake)
-        processor_count = run('cat /proc/cpuinfo | grep processor | wc -l')
-        run('time make -j %s install' % processor_count)
+        run('time make -j %s install' % env.fg.facts.cpu_count)
 
 
 @task
@@ -117,6 +129,7 @@ def install_qgis1_8(gdal_from_source=False):
     add_ubuntugis_ppa()
     setup_ccache()
     sudo('apt-get build-dep -y qgis')
+    invalidate_facts()
     clone_qgis(branch='release-1_8')
     workspace = '%s/cpp' % env.fg.workspace
     code_path = '%s/QGIS' % workspace
@@ -140,12 +153,10 @@ def install_qgis2(gdal_from_source=False):
     setup_ccache()
     add_ubuntugis_ppa()
     sudo('apt-get build-dep -y qgis')
+    invalidate_facts()
 
-    #fabtools.require.deb.package('python-pyspatialite')
-    fabtools.require.deb.package('python-psycopg2')
-    fabtools.require.deb.package('python-qscintilla2')
-    fabtools.require.deb.package('libqscintilla2-dev')
-    fabtools.require.deb.package('libspatialindex-dev')
+    # python-pyspatialite is not yet packaged for all releases
+    require_packages(QGIS2_PACKAGES + QGIS_BUILD_PACKAGES)
 
     clone_qgis(branch='release-2_0')
     workspace = '%s/cpp' % env.fg.workspace
@@ -170,12 +181,10 @@ def install_master(gdal_from_source=False):
     setup_ccache()
     add_ubuntugis_ppa()
     sudo('apt-get build-dep -y qgis')
+    invalidate_facts()
 
-    #fabtools.require.deb.package('python-pyspatialite')
-    fabtools.require.deb.package('python-psycopg2')
-    fabtools.require.deb.package('python-qscintilla2')
-    fabtools.require.deb.package('libqscintilla2-dev')
-    fabtools.require.deb.package('libspatialindex-dev')
+    # python-pyspatialite is not yet packaged for all releases
+    require_packages(QGIS2_PACKAGES + QGIS_BUILD_PACKAGES)
 
     clone_qgis(branch='master')
     workspace = '%s/cpp' % env.fg.workspace
@@ -189,6 +198,13 @@ def install_master(gdal_from_source=False):
 def setup_qgis2_and_postgis():
     """
     Install qgis2 and postgis 1.5 as a fully working setup
+
+    The package sets of both parts are merged and installed in one go before
+    either part is set up.
     """
+    setup_env()
+    add_ubuntugis_ppa()
+    require_packages(
+        POSTGIS_1_5_PACKAGES + QGIS2_PACKAGES + QGIS_BUILD_PACKAGES)
     create_postgis_1_5_db('gis', env.user)
     install_qgis2()
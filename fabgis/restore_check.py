@@ -0,0 +1,465 @@
+# coding=utf-8
+"""Check that a dump restores completely and measure how long it takes.
+
+:func:`verify_postgres_restore` restores a dump into a scratch database on
+the host, one phase at a time (schema, data, indexes, constraints) so that
+the time of each phase is known. It then compares the row count and the
+spatial extent of every table with the database the dump was taken from,
+e.g.::
+
+    fab -H foo verify_postgres_restore:gis
+    fab -H foo verify_postgres_restore:gis,nightly=True
+
+Each run writes a json report to :file:`fabgis_resources/reports/` and
+adds a line to :file:`fabgis_resources/reports/restore_history.csv`, which
+shows how the restore time grows with the data. A run that is much slower
+than the previous one for the same database is pointed out.
+
+The source database keeps changing after the dump was taken, so some
+difference in row counts is expected for older dumps.
+"""
+import csv
+import os
+import re
+import time
+from fabric.api import env, task, run, settings, hide, abort, fastprint
+from fabric.colors import green, yellow, red
+from .common import setup_env
+from .postgres import dump_jobs, local_dump_path
+from .spatial_index import (
+    REPORT_DIR, SPATIAL_COLUMNS_SQL, qualified_name, write_report)
+from .sql import (
+    execute_sql, sql_identifier, database_exists, create_database_sql)
+from .transfer import (
+    path_compressor, stream_to_host, sync_file, upload_content,
+    upload_directory)
+from .utilities import as_bool
+
+HISTORY_FILE = os.path.join(REPORT_DIR, 'restore_history.csv')
+HISTORY_FIELDS = [
+    'date', 'host', 'database', 'dump', 'dump_bytes', 'jobs', 'transfer',
+    'schema', 'data', 'indexes', 'constraints', 'total', 'tables',
+    'mismatches', 'errors']
+
+# Restore phases in the order they run, with the types of the table of
+# contents entries of pg_restore -l that belong to each. Everything else
+# belongs to the schema phase.
+PHASES = ['schema', 'data', 'indexes', 'constraints']
+PHASE_TYPES = {
+    'data': [
+        'TABLE DATA', 'SEQUENCE SET', 'BLOBS', 'BLOB', 'LARGE OBJECT',
+        'MATERIALIZED VIEW DATA'],
+    'indexes': ['INDEX', 'INDEX ATTACH'],
+    'constraints': [
+        'CONSTRAINT', 'FK CONSTRAINT', 'CHECK CONSTRAINT', 'TRIGGER', 'RULE',
+        'EVENT TRIGGER', 'POLICY'],
+}
+
+# A run this much slower than the previous one is pointed out
+SLOWDOWN_WARNING = 1.2
+
+TABLES_SQL = """
+SELECT n.nspname, c.relname
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind = 'r' AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+    AND n.nspname NOT LIKE 'pg_toast%' AND n.nspname NOT LIKE 'pg_temp%'
+ORDER BY 1, 2
+"""
+
+GEOMETRY_COLUMNS_SQL = (
+    'SELECT count(*) FROM pg_class WHERE relname = \'geometry_columns\'')
+
+
+def toc_phase(line):
+    """Get the restore phase of a table of contents entry.
+
+    :param line: Line of the output of pg_restore -l e.g.
+        ``2345; 0 16390 TABLE DATA public roads postgres``.
+    :type line: str
+
+    :returns: Name of the phase, or None for comments and blank lines.
+    :rtype: str
+    """
+    match = re.match(r'^\d+; \d+ \d+ (.*)$', line.strip())
+    if not match:
+        return None
+    entry = match.group(1)
+    candidates = []
+    for phase, types in PHASE_TYPES.items():
+        candidates += [(entry_type, phase) for entry_type in types]
+    # BLOBS before BLOB, FK CONSTRAINT before CONSTRAINT etc.
+    for entry_type, phase in sorted(
+            candidates, key=lambda item: -len(item[0])):
+        if entry.startswith(entry_type + ' '):
+            return phase
+    return 'schema'
+
+
+def database_tables(dbname):
+    """List the tables of a database with their spatial columns.
+
+    :param dbname: Name of the database.
+    :type dbname: str
+
+    :returns: Dict of quoted table names and lists of their spatial columns
+        as (column, type) tuples.
+    :rtype: dict
+    """
+    table_rows, postgis = execute_sql(
+        [TABLES_SQL, GEOMETRY_COLUMNS_SQL], database=dbname)
+    tables = dict(
+        (qualified_name(schema_name, table_name), [])
+        for schema_name, table_name in table_rows)
+    if postgis[0][0] != '0':
+        for row in execute_sql(SPATIAL_COLUMNS_SQL, database=dbname)[0]:
+            table = qualified_name(row[0], row[1])
+            if table in tables:
+                tables[table].append((row[2], row[3]))
+    return tables
+
+
+def table_statistics(dbname, tables):
+    """Count the rows and get the spatial extents of tables.
+
+    All tables are read in one transaction, so the numbers are consistent.
+
+    :param dbname: Name of the database.
+    :type dbname: str
+
+    :param tables: Dict of quoted table names and lists of their spatial
+        columns as returned by :func:`database_tables`.
+    :type tables: dict
+
+    :returns: Dict of table names and dicts with ``rows`` and ``extents``
+        (dict of column names and ST_Extent as text).
+    :rtype: dict
+    """
+    names = sorted(tables)
+    statements = []
+    for name in names:
+        columns = ['count(*)'] + [
+            'ST_Extent(%s::geometry)::text' % sql_identifier(column)
+            for column, _ in tables[name]]
+        statements.append('SELECT %s FROM %s' % (', '.join(columns), name))
+    statistics = {}
+    for name, rows in zip(names, execute_sql(statements, database=dbname)):
+        values = rows[0]
+        statistics[name] = {
+            'rows': int(values[0]),
+            'extents': dict(
+                (column, value or None) for (column, _), value in zip(
+                    tables[name], values[1:]))}
+    return statistics
+
+
+def compare_statistics(source, restored):
+    """Compare the tables of the source and the restored database.
+
+    :param source: Statistics of the source database, see
+        :func:`table_statistics`.
+    :type source: dict
+
+    :param restored: Statistics of the restored database.
+    :type restored: dict
+
+    :returns: Mismatches as dicts with ``table``, ``problem``, ``source``
+        and ``restored``.
+    :rtype: list
+    """
+    mismatches = []
+    for name in sorted(set(source) | set(restored)):
+        if name not in restored:
+            mismatches.append({
+                'table': name, 'problem': 'missing',
+                'source': source[name], 'restored': None})
+        elif name not in source:
+            mismatches.append({
+                'table': name, 'problem': 'extra',
+                'source': None, 'restored': restored[name]})
+        elif source[name]['rows'] != restored[name]['rows']:
+            mismatches.append({
+                'table': name, 'problem': 'rows',
+                'source': source[name]['rows'],
+                'restored': restored[name]['rows']})
+        elif source[name]['extents'] != restored[name]['extents']:
+            mismatches.append({
+                'table': name, 'problem': 'extent',
+                'source': source[name]['extents'],
+                'restored': restored[name]['extents']})
+    return mismatches
+
+
+def put_dump(file_name):
+    """Get a local dump onto the host.
+
+    :param file_name: Path to a local dump file or directory format dump.
+    :type file_name: str
+
+    :returns: Path to the dump on the host.
+    :rtype: str
+    """
+    remote_name = '/tmp/%s' % os.path.split(file_name.rstrip('/'))[1]
+    if os.path.isdir(file_name):
+        run('rm -rf %s' % remote_name)
+        upload_directory(file_name, remote_name)
+        return remote_name
+    compression = path_compressor(file_name)
+    if compression:
+        # pg_restore -j needs a file it can seek in, not a pipe
+        remote_name = remote_name[:-len(os.path.splitext(remote_name)[1])]
+        stream_to_host(file_name, 'cat > %s' % remote_name)
+    else:
+        sync_file(file_name, remote_name)
+    return remote_name
+
+
+def latest_local_dump(dbname):
+    """Find the newest dump of a database in fabgis_resources/sql/dumps.
+
+    :param dbname: Name of the database.
+    :type dbname: str
+
+    :returns: Path to the dump.
+    :rtype: str
+    """
+    dump_dir = os.path.dirname(local_dump_path('x'))
+    dumps = []
+    if os.path.isdir(dump_dir):
+        # Skip transfers that did not finish (.part) and their chunk lists
+        dumps = [
+            os.path.join(dump_dir, name) for name in os.listdir(dump_dir)
+            if name.startswith('%s-' % dbname) and
+            not re.search(r'\.part(\.|$)', name)]
+    if not dumps:
+        abort('There is no dump of %s in %s' % (dbname, dump_dir))
+    return max(dumps, key=os.path.getmtime)
+
+
+def latest_nightly_dump(dbname):
+    """Find the newest nightly backup of a database on the host.
+
+    :param dbname: Name of the database.
+    :type dbname: str
+
+    :returns: Path to the backup on the host.
+    :rtype: str
+    """
+    # Newest first by modification time. ls -t would list the current
+    # directory when find matches nothing. Dumps still being written end
+    # in .part.
+    with hide('output'):
+        path = run(
+            'find /home/%s/sql_backups -name "PG_%s.*" -not -name "*.part" '
+            '-not -path "*/store/*" -printf "%%T@ %%p\\n" 2>/dev/null | '
+            'sort -rn | head -n 1 | cut -d" " -f2-; true' % (
+                env.fg.user, dbname)).strip()
+    if not path:
+        abort('There is no nightly backup of %s on the host' % dbname)
+    return path
+
+
+def restore_phase(dump_path, list_path, scratch_dbname, jobs):
+    """Restore the entries of one phase of a dump.
+
+    :param dump_path: Path to the dump on the host.
+    :type dump_path: str
+
+    :param list_path: Path to the table of contents of the phase on the
+        host.
+    :type list_path: str
+
+    :param scratch_dbname: Name of the database to restore into.
+    :type scratch_dbname: str
+
+    :param jobs: Number of parallel pg_restore workers.
+    :type jobs: int
+
+    :returns: The number of seconds it took and the number of errors.
+    :rtype: tuple
+    """
+    start = time.time()
+    with settings(warn_only=True):
+        result = run('pg_restore -j %i -L %s -d %s %s' % (
+            jobs, list_path, scratch_dbname, dump_path))
+    seconds = time.time() - start
+    errors = 0
+    if result.failed:
+        match = re.search(r'errors ignored on restore: (\d+)', result)
+        errors = int(match.group(1)) if match else 1
+    return seconds, errors
+
+
+def previous_restore(host, dbname):
+    """Get the last restore of a database recorded in the history file.
+
+    :param host: Host of the restore.
+    :type host: str
+
+    :param dbname: Name of the database.
+    :type dbname: str
+
+    :returns: The history row, or None.
+    :rtype: dict
+    """
+    if not os.path.exists(HISTORY_FILE):
+        return None
+    previous = None
+    with open(HISTORY_FILE) as history_file:
+        for row in csv.DictReader(history_file):
+            if row['host'] == host and row['database'] == dbname:
+                previous = row
+    return previous
+
+
+def record_restore(row):
+    """Add a restore to the history file.
+
+    :param row: Values for :data:`HISTORY_FIELDS`.
+    :type row: dict
+    """
+    if not os.path.exists(REPORT_DIR):
+        os.makedirs(REPORT_DIR)
+    new_file = not os.path.exists(HISTORY_FILE)
+    with open(HISTORY_FILE, 'ab') as history_file:
+        writer = csv.DictWriter(history_file, HISTORY_FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+@task
+def verify_postgres_restore(
+        dbname,
+        file_name=None,
+        nightly=False,
+        jobs=None,
+        compare=True,
+        keep=False):
+    """Restore a dump into a scratch database, time it and check it.
+
+    :param dbname: Name of the database the dump was taken from.
+    :type dbname: str
+
+    :param file_name: Local dump to restore. Defaults to the newest dump of
+        the database in fabgis_resources/sql/dumps (see
+        :func:`fabgis.postgres.get_postgres_dump`).
+    :type file_name: str
+
+    :param nightly: Whether to restore the newest nightly backup on the host
+        instead (see :func:`fabgis.postgres.setup_nightly_backups`).
+    :type nightly: bool (default False)
+
+    :param jobs: Number of parallel pg_restore workers. Defaults to the
+        number of processors on the host, limited to two for hosts with
+        spinning disks.
+    :type jobs: int
+
+    :param compare: Whether to compare row counts and spatial extents with
+        the database on the host. This reads every table of both databases.
+    :type compare: bool (default True)
+
+    :param keep: Whether to keep the scratch database afterwards.
+    :type keep: bool (default False)
+
+    :returns: Path to the local report.
+    :rtype: str
+    """
+    setup_env()
+    jobs = int(jobs or dump_jobs())
+    start = time.time()
+    if as_bool(nightly):
+        dump_path = latest_nightly_dump(dbname)
+    else:
+        if not file_name:
+            file_name = latest_local_dump(dbname)
+        dump_path = put_dump(file_name)
+    transfer_seconds = time.time() - start
+    with hide('output'):
+        dump_bytes = int(run('du -sb %s | cut -f1' % dump_path))
+        toc = run('pg_restore -l %s' % dump_path)
+
+    scratch_dbname = '%s_fabgis_verify' % dbname
+    if database_exists(scratch_dbname):
+        run('dropdb %s' % scratch_dbname)
+    execute_sql(create_database_sql(scratch_dbname, env.fg.user))
+    phase_lines = dict((phase, []) for phase in PHASES)
+    for line in toc.splitlines():
+        phase = toc_phase(line)
+        if phase:
+            phase_lines[phase].append(line.strip())
+    phases = {}
+    for phase in PHASES:
+        list_path = '/tmp/%s-%s.list' % (scratch_dbname, phase)
+        upload_content('\n'.join(phase_lines[phase]) + '\n', list_path)
+        seconds, errors = restore_phase(
+            dump_path, list_path, scratch_dbname, jobs)
+        phases[phase] = {
+            'entries': len(phase_lines[phase]),
+            'seconds': round(seconds, 2),
+            'errors': errors}
+        fastprint(yellow('%-12s %8.1fs %6i entries %4i errors\n' % (
+            phase, seconds, len(phase_lines[phase]), errors)))
+    run('rm -f /tmp/%s-*.list' % scratch_dbname)
+    restore_seconds = sum(phase['seconds'] for phase in phases.values())
+
+    restored = table_statistics(
+        scratch_dbname, database_tables(scratch_dbname))
+    mismatches = []
+    if as_bool(compare) and database_exists(dbname):
+        source = table_statistics(dbname, database_tables(dbname))
+        mismatches = compare_statistics(source, restored)
+        for mismatch in mismatches:
+            fastprint(red('%(table)s: %(problem)s (%(source)s restored as '
+                          '%(restored)s)\n' % mismatch))
+    elif as_bool(compare):
+        fastprint(yellow('There is no database %s on the host to compare '
+                         'with\n' % dbname))
+    if not as_bool(keep):
+        run('dropdb %s' % scratch_dbname)
+
+    report = {
+        'host': env.host,
+        'database': dbname,
+        'dump': file_name or dump_path,
+        'dump_bytes': dump_bytes,
+        'jobs': jobs,
+        'started': time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(start)),
+        'transfer_seconds': round(transfer_seconds, 2),
+        'phases': phases,
+        'restore_seconds': round(restore_seconds, 2),
+        'tables': restored,
+        'mismatches': mismatches}
+    report_path = write_report(report, kind='restore_verify')
+    previous = previous_restore(env.host, dbname)
+    row = {
+        'date': report['started'],
+        'host': env.host,
+        'database': dbname,
+        'dump': os.path.basename(report['dump'].rstrip('/')),
+        'dump_bytes': dump_bytes,
+        'jobs': jobs,
+        'transfer': report['transfer_seconds'],
+        'total': report['restore_seconds'],
+        'tables': len(restored),
+        'mismatches': len(mismatches),
+        'errors': sum(phase['errors'] for phase in phases.values())}
+    for phase in PHASES:
+        row[phase] = phases[phase]['seconds']
+    record_restore(row)
+
+    if previous and float(previous['total']) > 0:
+        change = restore_seconds / float(previous['total'])
+        message = 'Restore took %.0fs, %.0fs on %s (%+.0f%%)\n' % (
+            restore_seconds, float(previous['total']), previous['date'],
+            (change - 1) * 100)
+        fastprint(
+            red(message) if change > SLOWDOWN_WARNING else green(message))
+    if mismatches or row['errors']:
+        fastprint(red('%i tables differ and %i restore errors, see %s\n' % (
+            len(mismatches), row['errors'], report_path)))
+    else:
+        fastprint(green('%i tables restored in %.0fs, report in %s\n' % (
+            len(restored), restore_seconds, report_path)))
+    return report_path
@@ -0,0 +1,351 @@
+# coding=utf-8
+"""Audit and maintain the spatial indexes of a postgis database.
+
+A geometry column without a GiST index makes every bounding box query (and
+so every WMS GetMap request) scan the whole table.
+:func:`audit_spatial_indexes` finds the columns listed in
+``geometry_columns`` and ``geography_columns`` that have no valid GiST
+index, the large spatial tables and the tables with many dead rows, in one
+round trip. :func:`maintain_spatial_indexes` then fixes
+what the audit found, e.g.::
+
+    fab -H foo audit_spatial_indexes:gis
+    fab -H foo maintain_spatial_indexes:gis,cluster=True
+
+Missing indexes are built with ``CREATE INDEX CONCURRENTLY`` so that the
+tables stay writable, several at a time. ``CLUSTER`` (optional, it locks
+the table while it rewrites it) and ``VACUUM ANALYZE`` of the tables with
+many dead rows use the same pool of workers. Each run writes a json report
+to :file:`fabgis_resources/reports/`.
+"""
+import base64
+import json
+import os
+import time
+from fabric.api import env, task, sudo, settings, fastprint
+from fabric.colors import green, yellow, red
+from .common import setup_env
+from .postgres import dump_jobs
+from .sql import execute_sql, sql_identifier
+from .utilities import as_bool
+
+REPORT_DIR = os.path.join('fabgis_resources', 'reports')
+
+# Spatial columns with the size of their table and the name of their GiST
+# index, if there is a valid one. Columns of tables that no longer exist
+# are skipped since geometry_columns is not kept up to date by postgis 1.5.
+SPATIAL_COLUMNS_SQL = """
+SELECT c.schema_name, c.table_name, c.column_name, c.column_type,
+    pg_total_relation_size(t.oid),
+    (SELECT ic.relname FROM pg_index i
+        JOIN pg_class ic ON ic.oid = i.indexrelid
+        JOIN pg_am am ON am.oid = ic.relam
+        JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = t.oid AND am.amname = 'gist'
+        AND a.attname = c.column_name AND i.indisvalid
+        ORDER BY ic.relname LIMIT 1)
+FROM (
+    SELECT f_table_schema::text AS schema_name,
+        f_table_name::text AS table_name,
+        f_geometry_column::text AS column_name, 'geometry' AS column_type
+    FROM geometry_columns
+    UNION
+    SELECT f_table_schema::text, f_table_name::text,
+        f_geography_column::text, 'geography'
+    FROM geography_columns) c
+JOIN pg_namespace n ON n.nspname = c.schema_name
+JOIN pg_class t ON t.relnamespace = n.oid AND t.relname = c.table_name
+    AND t.relkind = 'r'
+ORDER BY 1, 2, 3
+"""
+
+# Invalid indexes are left behind by a CREATE INDEX CONCURRENTLY that failed
+INVALID_INDEXES_SQL = """
+SELECT n.nspname, ic.relname
+FROM pg_index i
+JOIN pg_class ic ON ic.oid = i.indexrelid
+JOIN pg_namespace n ON n.oid = ic.relnamespace
+JOIN pg_am am ON am.oid = ic.relam
+WHERE NOT i.indisvalid AND am.amname = 'gist'
+"""
+
+DEAD_TUPLES_SQL = """
+SELECT schemaname, relname, n_live_tup, n_dead_tup
+FROM pg_stat_user_tables
+WHERE n_dead_tup > %(minimum)i AND n_dead_tup > %(ratio)s * n_live_tup
+ORDER BY n_dead_tup DESC
+"""
+
+
+def index_name(table_name, column_name):
+    """Get the name for a new spatial index.
+
+    :param table_name: Name of the table.
+    :type table_name: str
+
+    :param column_name: Name of the spatial column.
+    :type column_name: str
+
+    :returns: Index name, shortened to the 63 characters postgres allows.
+    :rtype: str
+    """
+    suffix = '_%s_gist' % column_name
+    return '%s%s' % (table_name[:63 - len(suffix)], suffix)
+
+
+def qualified_name(schema_name, name):
+    """Quote a schema qualified name.
+
+    :param schema_name: Name of the schema.
+    :type schema_name: str
+
+    :param name: Name of the table or index.
+    :type name: str
+
+    :returns: The quoted name e.g. "public"."roads".
+    :rtype: str
+    """
+    return '%s.%s' % (sql_identifier(schema_name), sql_identifier(name))
+
+
+@task
+def audit_spatial_indexes(dbname, dead_ratio=0.1, dead_minimum=1000):
+    """Find spatial columns without an index and tables needing a vacuum.
+
+    :param dbname: Name of the database to audit.
+    :type dbname: str
+
+    :param dead_ratio: Tables with more dead rows than this share of their
+        live rows need a vacuum.
+    :type dead_ratio: float
+
+    :param dead_minimum: Tables with fewer dead rows than this are left
+        alone.
+    :type dead_minimum: int
+
+    :returns: The audit, with ``columns`` (spatial columns with their
+        ``index`` or None), ``missing`` (columns without an index),
+        ``invalid`` (names of invalid GiST indexes) and ``dead`` (tables
+        with many dead rows).
+    :rtype: dict
+    """
+    columns_rows, invalid_rows, dead_rows = execute_sql([
+        SPATIAL_COLUMNS_SQL,
+        INVALID_INDEXES_SQL,
+        DEAD_TUPLES_SQL % {
+            'minimum': int(dead_minimum),
+            'ratio': float(dead_ratio)}],
+        database=dbname)
+    audit = {'columns': [], 'missing': [], 'invalid': [], 'dead': []}
+    for schema_name, table_name, column_name, column_type, size, index in (
+            columns_rows):
+        column = {
+            'schema': schema_name,
+            'table': table_name,
+            'column': column_name,
+            'type': column_type,
+            'size': int(size),
+            'index': index or None}
+        audit['columns'].append(column)
+        if not index:
+            audit['missing'].append(column)
+    audit['invalid'] = [
+        qualified_name(schema_name, name)
+        for schema_name, name in invalid_rows]
+    for schema_name, table_name, live, dead in dead_rows:
+        audit['dead'].append({
+            'schema': schema_name,
+            'table': table_name,
+            'live': int(live),
+            'dead': int(dead)})
+    for column in audit['missing']:
+        fastprint(red('No spatial index on %(schema)s.%(table)s.%(column)s '
+                      '(%(size)i bytes)\n' % column))
+    fastprint(green(
+        '%i spatial columns, %i without an index, %i tables need a vacuum\n'
+        % (len(audit['columns']), len(audit['missing']),
+           len(audit['dead']))))
+    return audit
+
+
+def run_sql_pool(dbname, statements, jobs):
+    """Run statements in separate psql sessions, several at a time.
+
+    Every statement runs on its own, outside of a transaction block, so
+    this works for CREATE INDEX CONCURRENTLY, CLUSTER and VACUUM.
+
+    :param dbname: Name of the database.
+    :type dbname: str
+
+    :param statements: SQL statements.
+    :type statements: list
+
+    :param jobs: Number of statements to run at the same time.
+    :type jobs: int
+
+    :returns: The number of seconds it took and whether all statements
+        succeeded.
+    :rtype: tuple
+    """
+    if not statements:
+        return 0.0, True
+    # The statements are passed to xargs null separated and base64 encoded,
+    # so they need no shell quoting.
+    encoded = base64.b64encode(''.join(
+        '%s\0' % statement for statement in statements))
+    start = time.time()
+    with settings(warn_only=True):
+        result = sudo(
+            'echo %s | base64 -d | xargs -0 -n 1 -P %i '
+            'psql -X -q -v ON_ERROR_STOP=1 -d %s -c' % (
+                encoded, max(int(jobs), 1), dbname),
+            user='postgres')
+    return time.time() - start, result.succeeded
+
+
+@task
+def maintain_spatial_indexes(
+        dbname,
+        jobs=None,
+        cluster=False,
+        cluster_mb=100,
+        vacuum=True,
+        dead_ratio=0.1,
+        dead_minimum=1000):
+    """Build missing spatial indexes and vacuum or cluster tables.
+
+    :param dbname: Name of the database.
+    :type dbname: str
+
+    :param jobs: Number of statements to run at the same time. Defaults to
+        the number of processors on the host, limited to two for hosts with
+        spinning disks.
+    :type jobs: int
+
+    :param cluster: Whether to CLUSTER the large spatial tables on their
+        spatial index, so that features that are close together are stored
+        together. CLUSTER locks each table while it rewrites it.
+    :type cluster: bool (default False)
+
+    :param cluster_mb: Tables smaller than this (in MB) are not clustered.
+    :type cluster_mb: int
+
+    :param vacuum: Whether to VACUUM ANALYZE the tables with many dead
+        rows.
+    :type vacuum: bool (default True)
+
+    :param dead_ratio: Tables with more dead rows than this share of their
+        live rows need a vacuum.
+    :type dead_ratio: float
+
+    :param dead_minimum: Tables with fewer dead rows than this are left
+        alone.
+    :type dead_minimum: int
+
+    :returns: Path to the local report.
+    :rtype: str
+    """
+    setup_env()
+    if jobs is None:
+        jobs = dump_jobs()
+    jobs = int(jobs)
+    audit = audit_spatial_indexes(dbname, dead_ratio, dead_minimum)
+    report = {
+        'host': env.host,
+        'database': dbname,
+        'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'jobs': jobs,
+        'audit': audit,
+        'phases': {}}
+
+    if audit['invalid']:
+        # Left over from failed concurrent builds, they slow down writes
+        # without ever being used
+        execute_sql(
+            ['DROP INDEX %s' % name for name in audit['invalid']],
+            database=dbname)
+    statements = []
+    for column in audit['missing']:
+        column['index'] = index_name(column['table'], column['column'])
+        statements.append(
+            'CREATE INDEX CONCURRENTLY %s ON %s USING gist (%s)' % (
+                sql_identifier(column['index']),
+                qualified_name(column['schema'], column['table']),
+                sql_identifier(column['column'])))
+    report['phases']['index'] = run_phase(dbname, statements, jobs)
+
+    clustered = []
+    if as_bool(cluster):
+        for column in audit['columns']:
+            table = qualified_name(column['schema'], column['table'])
+            if (column['size'] < int(cluster_mb) * 1024 * 1024 or
+                    not column['index'] or
+                    table in [name for name, _ in clustered]):
+                continue
+            clustered.append((table, column['index']))
+    statements = [
+        'CLUSTER %s USING %s' % (name, sql_identifier(index))
+        for name, index in clustered]
+    report['phases']['cluster'] = run_phase(dbname, statements, jobs)
+
+    statements = []
+    if as_bool(vacuum):
+        statements = [
+            'VACUUM ANALYZE %s' % qualified_name(
+                dead['schema'], dead['table'])
+            for dead in audit['dead']]
+    # Clustered tables need fresh statistics too
+    statements += ['ANALYZE %s' % name for name, _ in clustered]
+    report['phases']['vacuum'] = run_phase(dbname, statements, jobs)
+
+    # Check what is still missing, e.g. when a build failed
+    report['remaining'] = audit_spatial_indexes(
+        dbname, dead_ratio, dead_minimum)['missing']
+    report_path = write_report(report)
+    fastprint(green('Report written to %s\n' % report_path))
+    return report_path
+
+
+def run_phase(dbname, statements, jobs):
+    """Run one phase of the maintenance and describe it for the report.
+
+    :param dbname: Name of the database.
+    :type dbname: str
+
+    :param statements: SQL statements of the phase.
+    :type statements: list
+
+    :param jobs: Number of statements to run at the same time.
+    :type jobs: int
+
+    :returns: The statements, the time taken and whether they succeeded.
+    :rtype: dict
+    """
+    seconds, succeeded = run_sql_pool(dbname, statements, jobs)
+    if statements and not succeeded:
+        fastprint(yellow('Some statements failed, see the output above\n'))
+    return {
+        'statements': statements,
+        'seconds': round(seconds, 2),
+        'succeeded': succeeded}
+
+
+def write_report(report, kind='spatial_index'):
+    """Write a report to fabgis_resources/reports.
+
+    :param report: The report, including the ``database`` it is about.
+    :type report: dict
+
+    :param kind: Kind of report, used as the start of the file name.
+    :type kind: str
+
+    :returns: Path to the report.
+    :rtype: str
+    """
+    if not os.path.exists(REPORT_DIR):
+        os.makedirs(REPORT_DIR)
+    path = os.path.join(REPORT_DIR, '%s-%s-%s-%s.json' % (
+        kind, env.host, report['database'], time.strftime('%Y%m%d%H%M%S')))
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    return path
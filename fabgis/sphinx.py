@@ -1,19 +1,20 @@
 # coding=utf-8
 """Tasks for setting up sphinx."""
-import fabtools
 from fabric.api import task, sudo, fastprint
 from fabric.colors import green, blue
-from fabtools.deb import is_installed
+from .packages import require_packages, remove_packages
+
+LATEX_PACKAGES = [
+    'texlive-latex-extra',
+    'texinfo',
+    'texlive-fonts-recommended']
 
 
 @task
 def setup_latex():
     """Install latex and friends needed to generate sphinx PDFs."""
     fastprint(blue('Setting up LaTeX\n'))
-    fabtools.deb.update_index(quiet=True)
-    fabtools.require.deb.package('texlive-latex-extra')
-    fabtools.require.deb.package('texinfo')
-    fabtools.require.deb.package('texlive-fonts-recommended')
+    require_packages(LATEX_PACKAGES)
     fastprint(green('Setting up LaTeX completed\n'))
 
 
@@ -25,12 +26,7 @@ def setup_sphinx():
     To build the Documentation we also need to check and update the
     subjacent docutils installation"""
     fastprint(blue('Setting up Sphinx\n'))
-    if is_installed('docutils-common'):
-        sudo('apt-get remove docutils-common')
-    if is_installed('docutils-doc'):
-        sudo('apt-get remove docutils-doc')
-    if is_installed('python-docutils'):
-        sudo('apt-get remove python-docutils')
+    remove_packages(['docutils-common', 'docutils-doc', 'python-docutils'])
     sudo('pip install --upgrade docutils==0.10')
     sudo('pip install sphinx')
     fastprint(green('Setting up Sphinx completed\n'))
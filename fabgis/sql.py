@@ -0,0 +1,287 @@
+# coding=utf-8
+"""Run SQL on the host in a single psql session.
+
+Each ``run('psql ... -c "..."')`` costs an SSH exec and a new postgres
+backend, and interpolating SQL into a double quoted shell string breaks as
+soon as the SQL contains quotes or dollar signs. :func:`execute_sql` sends
+a whole list of statements to one ``psql`` process instead, e.g.::
+
+    from fabgis.sql import execute_sql
+
+    results = execute_sql([
+        'SELECT datname, datistemplate FROM pg_database',
+        'GRANT ALL ON spatial_ref_sys TO PUBLIC',
+    ], database='template_postgis')
+    for name, is_template in results[0]:
+        print name, is_template
+
+Besides SQL statements the list may contain psql meta-commands such as
+``\\c other_database`` to switch databases or ``\\i /path/file.sql`` to run
+a file on the host. Consecutive statements run in one transaction, which
+is committed at meta-commands and around statements that can not run in
+a transaction block (e.g. ``CREATE DATABASE`` or ``VACUUM``). Execution
+stops at the first error and the open transaction is rolled back.
+
+The script is passed to psql base64 encoded, so the SQL needs no shell
+escaping.
+"""
+import base64
+import re
+import uuid
+from fabric.api import run, sudo, hide
+
+# Statements that postgres refuses to run inside a transaction block
+NON_TRANSACTIONAL = re.compile(
+    r'^\s*((CREATE|DROP)\s+(DATABASE|TABLESPACE)\b|VACUUM\b|'
+    r'(CREATE|DROP)\s+INDEX\s+CONCURRENTLY\b|REINDEX\s+(DATABASE|SYSTEM)\b|'
+    r'ALTER\s+SYSTEM\b|CLUSTER\s*;?\s*$)',
+    re.IGNORECASE)
+
+# Fields and records of query results are separated by the ascii unit and
+# record separators, which do not occur in normal text values.
+FIELD_SEPARATOR = '\x1f'
+RECORD_SEPARATOR = '\x1e'
+
+
+def sql_literal(value):
+    """Quote a value as an SQL string literal.
+
+    :param value: Value to quote.
+    :type value: str
+
+    :returns: The quoted value e.g. 'O''Brien'.
+    :rtype: str
+    """
+    return '\'%s\'' % str(value).replace('\'', '\'\'')
+
+
+def sql_identifier(name):
+    """Quote a name as an SQL identifier.
+
+    :param name: Name of a database, role, table etc.
+    :type name: str
+
+    :returns: The quoted name e.g. "my db".
+    :rtype: str
+    """
+    return '"%s"' % name.replace('"', '""')
+
+
+def sql_script(statements, marker, transaction=True):
+    """Build the psql script for a list of statements.
+
+    :param statements: SQL statements and psql meta-commands.
+    :type statements: list
+
+    :param marker: Marker printed before the output of each statement.
+    :type marker: str
+
+    :param transaction: Whether to group statements into transactions.
+    :type transaction: bool
+
+    :returns: Script for psql.
+    :rtype: str
+    """
+    lines = [
+        '\\set ON_ERROR_STOP on',
+        '\\pset fieldsep \'\\%03o\'' % ord(FIELD_SEPARATOR),
+        '\\pset recordsep \'\\%03o\'' % ord(RECORD_SEPARATOR),
+    ]
+    in_transaction = False
+    for index, statement in enumerate(statements):
+        statement = statement.strip()
+        meta_command = statement.startswith('\\')
+        if in_transaction and (
+                meta_command or NON_TRANSACTIONAL.match(statement)):
+            lines.append('COMMIT;')
+            in_transaction = False
+        if transaction and not in_transaction and not (
+                meta_command or NON_TRANSACTIONAL.match(statement)):
+            lines.append('BEGIN;')
+            in_transaction = True
+        lines.append('\\echo %s_%i' % (marker, index))
+        if not meta_command and not statement.endswith(';'):
+            statement += ';'
+        lines.append(statement)
+    if in_transaction:
+        lines.append('COMMIT;')
+    return '\n'.join(lines) + '\n'
+
+
+def parse_sql_output(text, marker):
+    """Split the output of a psql script into per statement results.
+
+    :param text: Output of psql.
+    :type text: str
+
+    :param marker: Marker printed before the output of each statement.
+    :type marker: str
+
+    :returns: One list of row tuples for each statement that was run.
+    :rtype: list
+    """
+    results = []
+    sections = re.split(r'%s_\d+\r?\n' % marker, text)
+    # Anything before the first marker is not the output of a statement
+    for section in sections[1:]:
+        section = section.rstrip('\r\n').rstrip(RECORD_SEPARATOR)
+        if not section:
+            results.append([])
+            continue
+        results.append([
+            tuple(record.strip('\r\n').split(FIELD_SEPARATOR))
+            for record in section.split(RECORD_SEPARATOR)])
+    return results
+
+
+def execute_sql(
+        statements, database='template1', user='postgres', transaction=True):
+    """Run statements in one psql session on the host.
+
+    :param statements: SQL statements and psql meta-commands, or a single
+        statement.
+    :type statements: list
+
+    :param database: Database to connect to first.
+    :type database: str
+
+    :param user: System user to run psql as with sudo, using peer
+        authentication. None runs psql as the login user.
+    :type user: str
+
+    :param transaction: Whether to run consecutive statements in one
+        transaction.
+    :type transaction: bool (default True)
+
+    :returns: One list of row tuples for each statement, holding the
+        values as strings. Statements without results give empty lists.
+    :rtype: list
+    """
+    if isinstance(statements, basestring):
+        statements = [statements]
+    marker = '__fabgis_sql_%s' % uuid.uuid4().hex[:8]
+    script = sql_script(statements, marker, transaction)
+    command = 'echo %s | base64 -d | psql -X -q -A -t -d %s' % (
+        base64.b64encode(script), database)
+    with hide('running', 'stdout'):
+        if user is None:
+            output = run(command, pty=False)
+        else:
+            output = sudo(command, user=user, pty=False)
+    return parse_sql_output(output, marker)
+
+
+def query_value(sql, database='template1'):
+    """Get the first value of the first row of a query.
+
+    :param sql: Query e.g. SELECT count(*) FROM pg_database.
+    :type sql: str
+
+    :param database: Database to run the query in.
+    :type database: str
+
+    :returns: The value, or None if the query returned no rows.
+    :rtype: str
+    """
+    rows = execute_sql([sql], database=database)[0]
+    if not rows:
+        return None
+    return rows[0][0]
+
+
+def database_exists(name):
+    """Check whether a database exists on the host.
+
+    :param name: Name of the database.
+    :type name: str
+
+    :returns: True if the database exists.
+    :rtype: bool
+    """
+    return query_value(
+        'SELECT count(*) FROM pg_database WHERE datname = %s' %
+        sql_literal(name)) != '0'
+
+
+def user_exists(name):
+    """Check whether a postgres role exists on the host.
+
+    :param name: Name of the role.
+    :type name: str
+
+    :returns: True if the role exists.
+    :rtype: bool
+    """
+    return query_value(
+        'SELECT count(*) FROM pg_roles WHERE rolname = %s' %
+        sql_literal(name)) != '0'
+
+
+def create_user_sql(
+        name,
+        password='',
+        superuser=False,
+        createdb=False,
+        createrole=False,
+        connection_limit=None):
+    """Get the statement creating a login role.
+
+    The options match those of ``fabtools.postgres.create_user``.
+
+    :param name: Name of the role.
+    :type name: str
+
+    :param password: Password of the role.
+    :type password: str
+
+    :param superuser: Whether the role is a superuser.
+    :type superuser: bool
+
+    :param createdb: Whether the role may create databases.
+    :type createdb: bool
+
+    :param createrole: Whether the role may create roles.
+    :type createrole: bool
+
+    :param connection_limit: Maximum number of connections of the role.
+    :type connection_limit: int
+
+    :returns: The CREATE USER statement.
+    :rtype: str
+    """
+    options = [
+        'SUPERUSER' if superuser else 'NOSUPERUSER',
+        'CREATEDB' if createdb else 'NOCREATEDB',
+        'CREATEROLE' if createrole else 'NOCREATEROLE',
+        'INHERIT',
+        'LOGIN',
+    ]
+    if connection_limit is not None:
+        options.append('CONNECTION LIMIT %i' % connection_limit)
+    options.append('UNENCRYPTED PASSWORD %s' % sql_literal(password))
+    return 'CREATE USER %s %s' % (sql_identifier(name), ' '.join(options))
+
+
+def create_database_sql(name, owner, template='template0'):
+    """Get the statement creating a UTF8 database.
+
+    The encoding and locale match those of
+    ``fabtools.postgres.create_database``.
+
+    :param name: Name of the database.
+    :type name: str
+
+    :param owner: Role that owns the database.
+    :type owner: str
+
+    :param template: Database to copy.
+    :type template: str
+
+    :returns: The CREATE DATABASE statement.
+    :rtype: str
+    """
+    return (
+        'CREATE DATABASE %s OWNER %s TEMPLATE %s ENCODING \'UTF8\' '
+        'LC_COLLATE \'en_US.UTF-8\' LC_CTYPE \'en_US.UTF-8\'' % (
+            sql_identifier(name), sql_identifier(owner),
+            sql_identifier(template)))
@@ -4,23 +4,56 @@
 from getpass import getpass
 
 from fabric.api import cd, fastprint, prompt
-from fabric.contrib.files import contains, exists, append, sed
+from fabric.contrib.files import contains, exists, sed
 from fabric.colors import red
-from fabric.api import env, task, sudo, local, reboot
+from fabric.api import env, task, serial, sudo, local, reboot
 import fabtools
-from .utilities import append_if_not_present
+from .utilities import ensure_lines, ensure_replacements
+from .facts import get_facts, invalidate_facts
+from .packages import require_package, require_packages, update_index
+from .firewall import apply_firewall
+
+# Kernel network settings applied to /etc/sysctl.conf by harden.
+SYSCTL_SETTINGS = [
+    '# IP Spoofing protection',
+    'net.ipv4.conf.all.rp_filter = 1',
+    'net.ipv4.conf.default.rp_filter = 1',
+    '# Ignore ICMP broadcast requests',
+    'net.ipv4.icmp_echo_ignore_broadcasts = 1',
+    '# Disable source packet routing',
+    'net.ipv4.conf.all.accept_source_route = 0',
+    'net.ipv6.conf.all.accept_source_route = 0',
+    'net.ipv4.conf.default.accept_source_route = 0',
+    'net.ipv6.conf.default.accept_source_route = 0',
+    '# Ignore send redirects',
+    'net.ipv4.conf.all.send_redirects = 0',
+    'net.ipv4.conf.default.send_redirects = 0',
+    '# Block SYN attacks',
+    'net.ipv4.tcp_syncookies = 1',
+    'net.ipv4.tcp_max_syn_backlog = 2048',
+    'net.ipv4.tcp_synack_retries = 2',
+    'net.ipv4.tcp_syn_retries = 5',
+    '# Log Martians',
+    'net.ipv4.conf.all.log_martians = 1',
+    'net.ipv4.icmp_ignore_bogus_error_responses = 1',
+    '# Ignore ICMP redirects',
+    'net.ipv4.conf.all.accept_redirects = 0',
+    'net.ipv6.conf.all.accept_redirects = 0',
+    'net.ipv4.conf.default.accept_redirects = 0',
+    'net.ipv6.conf.default.accept_redirects = 0',
+    '# Ignore Directed pings',
+    'net.ipv4.icmp_echo_ignore_all = 1',
+]
 
 
 def setup_developer_tools():
     """Install various useful tools needed for developers."""
-    fabtools.require.deb.package('qtcreator')
-    fabtools.require.deb.package('qt4-designer')
-    fabtools.require.deb.package('qt4-linguist-tools')
+    require_packages(['qtcreator', 'qt4-designer', 'qt4-linguist-tools'])
 
 
 def setup_ccache():
     """Setup ccache."""
-    fabtools.require.deb.package('ccache')
+    require_package('ccache')
     sudo('ln -fs /usr/bin/ccache /usr/local/bin/gcc')
     sudo('ln -fs /usr/bin/ccache /usr/local/bin/g++')
     sudo('ln -fs /usr/bin/ccache /usr/local/bin/cc')
@@ -31,7 +64,7 @@ def install_modxsend():
     """
     Download, compile and activate mod_xsendfile
     """
-    fabtools.require.deb.package('apache2-threaded-dev')
+    require_package('apache2-threaded-dev')
     with cd('/tmp'):
         sudo('wget https://tn123.org/mod_xsendfile/mod_xsendfile.c')
         sudo('apxs2 -cia mod_xsendfile.c')
@@ -47,10 +80,12 @@ def install_elasticsearch():
         'wget https://download.elasticsearch.org/elasticsearch/'
         'elasticsearch/elasticsearch-0.90.2.deb')
     sudo('sudo dpkg -i elasticsearch-0.90.2.deb')
+    invalidate_facts()
     fabtools.require.service.restarted('elasticsearch')
 
 
 @task
+@serial
 def create_user(user, password=None):
     """Create a user on the remote system matching the user running this task.
 
@@ -82,16 +117,14 @@ def setup_mosh():
     """
     mosh_file = '/etc/ufw/applications.d/mosh'
     if not exists(mosh_file):
-        sudo('touch %s' % mosh_file)
-
-        append(mosh_file, '[mosh]', use_sudo=True)
-        append(mosh_file, ('title=Mobile shell that supports roaming and '
-                           'intelligent local echo.'), use_sudo=True)
-        append(mosh_file, ('description=The mosh provides alternative remote '
-                           'shell that supports roaming and intelligent local '
-                           'echo.'), use_sudo=True)
-        append(mosh_file, 'ports=60000:61000/udp', use_sudo=True)
-    fabtools.require.deb.package('mosh')
+        ensure_lines(mosh_file, [
+            '[mosh]',
+            ('title=Mobile shell that supports roaming and intelligent '
+             'local echo.'),
+            ('description=The mosh provides alternative remote shell that '
+             'supports roaming and intelligent local echo.'),
+            'ports=60000:61000/udp'], use_sudo=True)
+    require_package('mosh')
 
 
 def get_ip_address():
@@ -100,13 +133,11 @@ def get_ip_address():
     :returns: Ip address of the remote host.
     :rtype: str
     """
-    host_ip = sudo(
-        "ifconfig eth0 | grep 'inet addr:'| "
-        "cut -d: -f2 | awk '{print $1}'")
-    return host_ip
+    return get_facts().ip_address
 
 
 @task
+@serial
 def harden(ssh_port=22):
     """Harden the server a little.
 
@@ -132,66 +163,26 @@ def harden(ssh_port=22):
     sudo('usermod -a -G admin %s' % user)
     sudo('dpkg-statoverride --update --add root admin 4750 /bin/su')
 
-    fabtools.deb.update_index(quiet=True)
+    update_index()
 
     # Set up ufw and mosh
-    fabtools.require.deb.package('ufw')
+    require_packages(['ufw', 'denyhosts', 'byobu'])
     setup_mosh()
 
-    sudo('ufw default deny incoming')
-    sudo('ufw default allow outgoing')
-    sudo('ufw allow 8697')
-    sudo('ufw allow http')
-    sudo('ufw allow ssh')
-    sudo('ufw allow mosh')
-    sudo('ufw allow 25')  # mail
-    #Irc freenode
-    sudo('ufw allow from 127.0.0.1/32 to 78.40.125.4 port 6667')
-    sudo('ufw allow from 127.0.0.1/32 to any port 22')
-    sudo('ufw allow 443')
-    sudo('ufw allow 53/udp')  # dns
-    sudo('ufw allow 53/tcp')
-    sudo('ufw allow 1053')  # dns client
-
-    sed('/etc/ssh/sshd_config', 'Port 22', 'Port 8697', use_sudo=True)
-    sed('/etc/ssh/sshd_config', 'PermitRootLogin yes',
-        'PermitRootLogin no', use_sudo=True)
-    sed('/etc/ssh/sshd_config', '#PasswordAuthentication yes',
-        'PasswordAuthentication no', use_sudo=True)
-    sed('/etc/ssh/sshd_config', 'X11Forwarding yes',
-        'X11Forwarding no', use_sudo=True)
-    sudo('ufw enable')
-
-    append_if_not_present(
-        '/etc/ssh/sshd_config', 'Banner /etc/issue.net', use_sudo=True)
-
-    append_if_not_present(
-        '/etc/sysctl.conf',
-        'net.ipv4.conf.default.rp_filter=1', use_sudo=True)
-    append_if_not_present(
-        '/etc/sysctl.conf',
-        'net.ipv4.conf.setup_env.rp_filter=1', use_sudo=True)
-    append_if_not_present(
-        '/etc/sysctl.conf',
-        'net.ipv4.conf.setup_env.accept_redirects = 0', use_sudo=True)
-    append_if_not_present(
-        '/etc/sysctl.conf',
-        'net.ipv4.conf.setup_env.send_redirects = 0', use_sudo=True)
-    append_if_not_present(
-        '/etc/sysctl.conf',
-        'net.ipv4.conf.setup_env.accept_source_route = 0', use_sudo=True)
-    append_if_not_present(
-        '/etc/sysctl.conf',
-        'net.ipv4.icmp_echo_ignore_broadcasts = 1', use_sudo=True)
-    append_if_not_present(
-        '/etc/sysctl.conf',
-        'net.ipv4.icmp_ignore_bogus_error_responses = 1', use_sudo=True)
-
-    fabtools.require.deb.package('denyhosts')
+    ensure_replacements('/etc/ssh/sshd_config', [
+        ('Port 22', 'Port 8697'),
+        ('PermitRootLogin yes', 'PermitRootLogin no'),
+        ('#PasswordAuthentication yes', 'PasswordAuthentication no'),
+        ('X11Forwarding yes', 'X11Forwarding no')], use_sudo=True)
+    # Rules and policies are declared in fabgis.firewall
+    apply_firewall()
+
+    ensure_lines(
+        '/etc/ssh/sshd_config', ['Banner /etc/issue.net'], use_sudo=True)
+
     # Must come before mailutils
     fabtools.require.postfix.server(env.host)
-    fabtools.require.deb.package('mailutils')
-    fabtools.require.deb.package('byobu')
+    require_package('mailutils')
     fabtools.service.restart('ssh')
 
     # Some hints and tips from:
@@ -200,75 +191,8 @@ def harden(ssh_port=22):
     secure_tmp = (
         'tmpfs     /dev/shm     tmpfs     defaults,noexec,'
         'nosuid     0     0')
-    append_if_not_present('/etc/fstab', secure_tmp, use_sudo=True)
-
-    sysctl = '/etc/sysctl.conf'
-
-    append_if_not_present(
-        sysctl, '# IP Spoofing protection', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.conf.setup_env.rp_filter = 1', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.conf.default.rp_filter = 1', use_sudo=True)
-
-    append_if_not_present(
-        sysctl, '# Ignore ICMP broadcast requests', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.icmp_echo_ignore_broadcasts = 1', use_sudo=True)
-
-    append_if_not_present(
-        sysctl, '# Disable source packet routing', use_sudo=True)
-    append_if_not_present(
-        sysctl,
-        'net.ipv4.conf.setup_env.accept_source_route = 0', use_sudo=True)
-    append_if_not_present(
-        sysctl,
-        'net.ipv6.conf.setup_env.accept_source_route = 0', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.conf.default.accept_source_route = 0', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv6.conf.default.accept_source_route = 0', use_sudo=True)
-
-    append_if_not_present(
-        sysctl, '# Ignore send redirects', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.conf.setup_env.send_redirects = 0', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.conf.default.send_redirects = 0', use_sudo=True)
-
-    append_if_not_present(
-        sysctl, '# Block SYN attacks', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.tcp_syncookies = 1', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.tcp_max_syn_backlog = 2048', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.tcp_synack_retries = 2', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.tcp_syn_retries = 5', use_sudo=True)
-
-    append_if_not_present(
-        sysctl, '# Log Martians', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.conf.setup_env.log_martians = 1', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.icmp_ignore_bogus_error_responses = 1', use_sudo=True)
-
-    append_if_not_present(
-        sysctl, '# Ignore ICMP redirects', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.conf.setup_env.accept_redirects = 0', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv6.conf.setup_env.accept_redirects = 0', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.conf.default.accept_redirects = 0', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv6.conf.default.accept_redirects = 0', use_sudo=True)
-
-    append_if_not_present(
-        sysctl, '# Ignore Directed pings', use_sudo=True)
-    append_if_not_present(
-        sysctl, 'net.ipv4.icmp_echo_ignore_all = 1', use_sudo=True)
+    ensure_lines('/etc/fstab', [secure_tmp], use_sudo=True)
+    ensure_lines('/etc/sysctl.conf', SYSCTL_SETTINGS, use_sudo=True)
 
     sudo('sysctl -p')
     reboot()
@@ -285,17 +209,18 @@ def setup_bridge():
     if not contains(interfaces_file, 'eth0 inet static'):
         sed(interfaces_file, 'iface eth0 inet dhcp',
             '#iface eth0 inet dhcp', use_sudo=True)
-        append(interfaces_file, 'auto eth0', use_sudo=True)
-        append(interfaces_file, 'iface eth0 inet static', use_sudo=True)
-        append(interfaces_file, 'address 192.168.2.1', use_sudo=True)
-        append(interfaces_file, 'netmask 255.255.255.0', use_sudo=True)
-        append(interfaces_file, 'network 192.168.2.0', use_sudo=True)
-        append(interfaces_file, 'broadcast 192.168.2.255', use_sudo=True)
-        append(interfaces_file, 'gateway 192.168.2.1', use_sudo=True)
+        ensure_lines(interfaces_file, [
+            'auto eth0',
+            'iface eth0 inet static',
+            'address 192.168.2.1',
+            'netmask 255.255.255.0',
+            'network 192.168.2.0',
+            'broadcast 192.168.2.255',
+            'gateway 192.168.2.1'], use_sudo=True)
         sudo('ifdown eth0')
         sudo('ifup eth0')
 
-    fabtools.require.deb.package('dhcp3-server')
+    require_package('dhcp3-server')
 
 
 @task
@@ -310,5 +235,4 @@ def masquerade():
     rule_2 = 'echo 1 > /proc/sys/net/ipv4/ip_forward'
     if not contains(rc_file, rule_1):
         sed(rc_file, '^exit 0', '#exit 0', use_sudo=True)
-        append(rc_file, rule_1, use_sudo=True)
-        append(rc_file, rule_2, use_sudo=True)
+        ensure_lines(rc_file, [rule_1, rule_2], use_sudo=True)
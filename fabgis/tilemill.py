@@ -8,19 +8,16 @@
 .. seealso:: :file:`tilestream.py`
 
 """
-import fabtools
 from fabric.api import fastprint, task, sudo, run
 from .common import setup_env
 from .system import get_ip_address
+from .packages import require_packages, require_ppas
 
 
 @task
 def add_developmentseed_ppa():
     """Ensure we have development seed ppa (makers of mapbox, tilemill etc.."""
-    fabtools.deb.update_index(quiet=True)
-    fabtools.require.deb.ppa(
-        #'ppa:developmentseed/mapbox', auto_yes=True)
-        'ppa:developmentseed/mapbox')
+    require_ppas(['developmentseed'])
 
 
 @task
@@ -29,11 +26,9 @@ def setup_tilemill():
     # Note raring seems not to be supported yet...
     setup_env()
     add_developmentseed_ppa()
-    fabtools.require.deb.package('tilemill')
-    fabtools.require.deb.package('libmapnik')
-    # TODO: switch to using nodeenv
+    # TODO: switch to using nodeenv for nodejs
     # SEE: https://github.com/ekalinin/nodeenv
-    fabtools.require.deb.package('nodejs')
+    require_packages(['tilemill', 'libmapnik', 'nodejs'])
     fastprint('Now you can log in and use tilemill like this:')
     fastprint('vagrant ssh -- -X')
     fastprint('/usr/bin/nodejs /usr/share/tilemill/index.js')
@@ -10,12 +10,25 @@
 """
 import os
 
-from fabric.api import fastprint, task, sudo, run, cd, env, put
+from fabric.api import fastprint, task, sudo, run, cd, env
 from fabtools.files import exists
 from fabtools import require
 from .common import setup_env
-from .utilities import replace_tokens
+from .utilities import resource_path, upload_template_file
 from .system import get_ip_address
+from .packages import require_packages
+
+TILESTREAM_PACKAGES = [
+    'curl',
+    'build-essential',
+    'libssl-dev',
+    'libsqlite3-0',
+    'libsqlite3-dev',
+    'git-core',
+    'nodejs',
+    'nodejs-dev',
+    'npm',
+    'python-pip']
 
 
 @task
@@ -35,14 +48,7 @@ def setup_tilestream():
         nodeenv env --node=0.8.15
     """
     setup_env()
-    require.deb.package('curl')
-    require.deb.package('build-essential')
-    require.deb.package('libssl-dev')
-    require.deb.package('libsqlite3-0')
-    require.deb.package('libsqlite3-dev')
-    require.deb.package('git-core')
-    require.deb.package('nodejs nodejs-dev npm')
-    require.deb.package('python-pip')
+    require_packages(TILESTREAM_PACKAGES)
 
     sudo('pip install nodeenv')
 
@@ -76,10 +82,10 @@ def setup_tilestream_daemon(
 
     :param tile_dir: Optional directory on the remote tile_host that holds one
         or more mbtiles files to be published. If ommitted the default of
-        `~/Documents/MapBox/tiles` will be used by tilestream. Be sure to
-        escape and paths given here. e.g.::
+        `~/Documents/MapBox/tiles` will be used by tilestream. Paths are
+        used as is, no escaping is needed e.g.::
 
-            fab vagrant setup_tilestream_daemon:tile_dir='\/vagrant'
+            fab vagrant setup_tilestream_daemon:tile_dir=/vagrant
 
     :type tile_dir: str
 
@@ -98,18 +104,6 @@ def setup_tilestream_daemon(
     """
     setup_env()
     params = _build_parameters(tile_host, tile_dir, tiles_port, ui_port)
-    template_file = 'tilestream.templ'
-    template_path = os.path.abspath(os.path.join(
-        os.path.dirname(__file__),
-        os.path.pardir,
-        '../fabgis_resources',
-        'server_config',
-        'tilestream',
-        '%s' % template_file
-    ))
-    remote_path = '/tmp/%s' % template_file
-    fastprint(template_path, remote_path)
-    put(template_path, remote_path)
     binary = 'index.js'
     if not tile_host:
         tile_host = get_ip_address()
@@ -121,9 +115,12 @@ def setup_tilestream_daemon(
         'TILES_PORT': tiles_port,
         'UI_PORT': ui_port,
         'HOST': tile_host}
-    replace_tokens(remote_path, tokens)
-    sudo('mv /tmp/tilestream /etc/init.d/')
-    sudo('chmod 755 /etc/init.d/tilestream')
+    upload_template_file(
+        resource_path('server_config', 'tilestream', 'tilestream.templ'),
+        '/etc/init.d/tilestream',
+        tokens,
+        use_sudo=True,
+        mode=0755)
     sudo('/etc/init.d/tilestream start')
     sudo('sysv -rc-conf --level 2345 tilestream on')
 
@@ -0,0 +1,728 @@
+# coding=utf-8
+"""Idempotent file transfers.
+
+:func:`sync_file` uploads a local file only when the remote copy differs
+from it. The local sha256 checksum is compared with the output of
+``sha256sum`` on the host so that re-running a converged task moves next to
+no data, e.g.::
+
+    from fabgis.transfer import sync_file
+    sync_file('fabgis_resources/sql/dumps/gis.dmp', '/tmp/gis.dmp')
+
+Large files that do differ are sent with rsync's delta transfer algorithm
+(when rsync is available locally and on the host) so that only the changed
+parts of the file go over the wire. Files of at least
+``env.fg_delta_threshold`` bytes (1MB by default) use delta transfer
+automatically.
+
+Every transfer reports how many bytes were saved compared to a plain
+upload and the totals per host are kept in ``env.fg_transfer_stats``.
+
+Large downloads, such as directory format database dumps, are streamed
+with tar over a separate ssh connection (see :func:`ssh_command` and
+:func:`download_directory`) rather than fetched file by file with ``get``.
+The output of a remote command can also be streamed straight into a local
+file, optionally compressed on the wire, and a local file into a remote
+command (see :func:`stream_from_host` and :func:`stream_to_host`) so that
+nothing is staged on the host's disk.
+
+Large files that have to be sent whole, such as database dumps, are moved
+in fixed size chunks of ``env.fg_chunk_size`` bytes (see
+:func:`chunked_upload` and :func:`chunked_download`). Every chunk is
+verified with its own sha256 checksum and recorded in a state file next to
+the partial file, so an interrupted transfer resumes from the chunks that
+already arrived intact. Chunks can be sent over ``env.fg_transfer_jobs``
+ssh connections in parallel, e.g.::
+
+    fab --set fg_transfer_jobs=4 -H foo restore_postgres_dump:gis
+"""
+import hashlib
+import os
+import pipes
+import re
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from fabric.api import (
+    env, run, sudo, put, get, hide, settings, local, fastprint, abort)
+from fabric.colors import green, yellow
+from fabric.contrib.project import rsync_project
+from fabric.network import normalize, key_filenames
+
+# Stream compressors and the file extensions they use
+STREAM_COMPRESSORS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+    'lz4': '.lz4',
+}
+
+env.fg_delta_threshold = 1024 * 1024
+env.fg_chunk_threshold = 256 * 1024 * 1024
+env.fg_chunk_size = 64 * 1024 * 1024
+env.fg_transfer_jobs = 1
+env.fg_transfer_stats = {}
+
+
+def local_sha256(path):
+    """Get the sha256 checksum of a local file without reading it at once.
+
+    :param path: Path to the local file.
+    :type path: str
+
+    :returns: Hex digest of the file.
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as local_file:
+        for block in iter(lambda: local_file.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def count_transfer(size, sent):
+    """Add a transfer to the per host totals.
+
+    :param size: Size of the file in bytes.
+    :type size: int
+
+    :param sent: Number of bytes of file data actually sent.
+    :type sent: int
+    """
+    stats = env.fg_transfer_stats.setdefault(
+        env.host_string, {'files': 0, 'size': 0, 'sent': 0})
+    stats['files'] += 1
+    stats['size'] += size
+    stats['sent'] += sent
+
+
+def record_transfer(path, size, sent):
+    """Report a transfer and add it to the per host totals.
+
+    :param path: Remote path of the file that was synced.
+    :type path: str
+
+    :param size: Size of the file in bytes.
+    :type size: int
+
+    :param sent: Number of bytes of file data actually sent.
+    :type sent: int
+    """
+    count_transfer(size, sent)
+    fastprint(green('%s: sent %i of %i bytes (%i bytes saved)\n' % (
+        path, sent, size, size - sent)))
+
+
+def remote_sha256(path, use_sudo=False):
+    """Get the sha256 checksum of a remote file.
+
+    :param path: Path to the remote file.
+    :type path: str
+
+    :param use_sudo: Run the command as sudo.
+    :type use_sudo: bool
+
+    :returns: Hex digest of the file or None if it does not exist.
+    :rtype: str, None
+    """
+    func = sudo if use_sudo else run
+    with hide('everything'), settings(warn_only=True):
+        result = func('sha256sum %s' % path)
+    if result.failed or not result:
+        return None
+    return result.split()[0]
+
+
+def upload_content(content, remote_path, use_sudo=False, mode=None):
+    """Upload content to a remote file unless the file already has it.
+
+    The remote file's checksum is compared with that of the content first
+    so that converged files are not uploaded again.
+
+    :param content: Content for the remote file.
+    :type content: str
+
+    :param remote_path: Path to the remote file.
+    :type remote_path: str
+
+    :param use_sudo: Whether the upload needs sudo rights.
+    :type use_sudo: bool
+
+    :param mode: Optional file mode for the remote file e.g. 0755.
+    :type mode: int
+
+    :returns: True if the file was uploaded, False if it was up to date.
+    :rtype: bool
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    if remote_sha256(remote_path, use_sudo) == digest:
+        fastprint('%s is up to date\n' % remote_path)
+        record_transfer(remote_path, len(content), 0)
+        return False
+    put(StringIO(content), remote_path, use_sudo=use_sudo, mode=mode)
+    record_transfer(remote_path, len(content), len(content))
+    return True
+
+
+def rsync_available():
+    """Check whether rsync can be used for delta transfers to the host.
+
+    :returns: True if rsync is installed both locally and on the host.
+    :rtype: bool
+    """
+    with hide('everything'), settings(warn_only=True):
+        if local('which rsync', capture=True).failed:
+            return False
+        return run('which rsync').succeeded
+
+
+def rsync_file(local_path, remote_path, use_sudo=False):
+    """Send a file using rsync's delta transfer algorithm.
+
+    :param local_path: Path to the local file.
+    :type local_path: str
+
+    :param remote_path: Path to the remote file.
+    :type remote_path: str
+
+    :param use_sudo: Write the remote file as root. This requires sudo on
+        the host not to ask for a password.
+    :type use_sudo: bool
+
+    :returns: Number of bytes of file data that had to be sent, as reported
+        by rsync, or None if rsync did not report it.
+    :rtype: int, None
+    """
+    extra_opts = '--stats --partial'
+    if use_sudo:
+        extra_opts += ' --rsync-path="sudo rsync"'
+    with hide('running', 'output'):
+        output = rsync_project(
+            remote_path, local_path, extra_opts=extra_opts, capture=True)
+    match = re.search(r'Literal data: ([\d,]+)', output)
+    if match is None:
+        return None
+    return int(match.group(1).replace(',', ''))
+
+
+def sync_file(local_path, remote_path, use_sudo=False, mode=None, delta=None):
+    """Upload a local file unless the remote file already has its content.
+
+    :param local_path: Path to the local file.
+    :type local_path: str
+
+    :param remote_path: Path to the remote file.
+    :type remote_path: str
+
+    :param use_sudo: Whether the upload needs sudo rights.
+    :type use_sudo: bool
+
+    :param mode: Optional file mode for the remote file e.g. 0755.
+    :type mode: int
+
+    :param delta: Whether to use rsync delta transfer if the remote file
+        exists but differs. Defaults to doing so for files of at least
+        ``env.fg_delta_threshold`` bytes.
+    :type delta: bool
+
+    :returns: True if the file was transferred, False if it was up to date.
+    :rtype: bool
+    """
+    size = os.path.getsize(local_path)
+    remote_digest = remote_sha256(remote_path, use_sudo)
+    if remote_digest == local_sha256(local_path):
+        fastprint('%s is up to date\n' % remote_path)
+        record_transfer(remote_path, size, 0)
+        return False
+    if delta is None:
+        delta = size >= int(env.fg_delta_threshold)
+    sent = None
+    # Delta transfer only helps if there is something to compare against
+    if delta and remote_digest is not None and rsync_available():
+        sent = rsync_file(local_path, remote_path, use_sudo)
+        if mode is not None:
+            func = sudo if use_sudo else run
+            func('chmod %o %s' % (mode, remote_path))
+    elif size >= int(env.fg_chunk_threshold):
+        chunked_upload(local_path, remote_path, use_sudo, mode)
+        return True
+    else:
+        put(local_path, remote_path, use_sudo=use_sudo, mode=mode)
+    if sent is None:
+        sent = size
+    record_transfer(remote_path, size, sent)
+    return True
+
+
+def ssh_command(command, compress=False):
+    """Build a local ssh command line that runs a command on the current host.
+
+    The ssh connection uses the same user, port and keys as fabric so that
+    the output of the remote command can be piped into local commands.
+
+    :param command: Shell command to run on the host.
+    :type command: str
+
+    :param compress: Whether ssh should compress the stream.
+    :type compress: bool
+
+    :returns: Command line to pass to ``local``.
+    :rtype: str
+    """
+    user, host, port = normalize(env.host_string)
+    options = ['-p %s' % port]
+    for key in key_filenames():
+        options.append('-i %s' % pipes.quote(key))
+    if compress:
+        options.append('-C')
+    return 'ssh %s %s@%s %s' % (
+        ' '.join(options), user, host, pipes.quote(command))
+
+
+def download_directory(remote_dir, local_dir, compress=False):
+    """Stream the contents of a remote directory to a local directory.
+
+    The directory is sent as a single tar stream over one ssh connection,
+    which is much faster than fetching many files one by one.
+
+    :param remote_dir: Path to the remote directory.
+    :type remote_dir: str
+
+    :param local_dir: Local directory to extract the files into. It is
+        created if needed.
+    :type local_dir: str
+
+    :param compress: Whether ssh should compress the stream. Leave this off
+        for content that is already compressed, such as pg_dump output.
+    :type compress: bool
+
+    :returns: Number of bytes received.
+    :rtype: int
+    """
+    if not os.path.exists(local_dir):
+        os.makedirs(local_dir)
+    command = ssh_command('tar -C %s -cf - .' % remote_dir, compress)
+    local(
+        'set -o pipefail; %s | tar -C %s -xf -' % (
+            command, pipes.quote(local_dir)),
+        shell='/bin/bash')
+    size = 0
+    for path, _, file_names in os.walk(local_dir):
+        for file_name in file_names:
+            size += os.path.getsize(os.path.join(path, file_name))
+    record_transfer(local_dir, size, size)
+    return size
+
+
+def upload_directory(local_dir, remote_dir, compress=False):
+    """Stream the contents of a local directory to a remote directory.
+
+    This is the reverse of :func:`download_directory`.
+
+    :param local_dir: Local directory to send.
+    :type local_dir: str
+
+    :param remote_dir: Path to the remote directory. It is created if needed
+        and existing files in it are overwritten.
+    :type remote_dir: str
+
+    :param compress: Whether ssh should compress the stream.
+    :type compress: bool
+
+    :returns: Number of bytes sent.
+    :rtype: int
+    """
+    command = ssh_command(
+        'mkdir -p %s && tar -C %s -xf -' % (remote_dir, remote_dir), compress)
+    local(
+        'set -o pipefail; tar -C %s -cf - . | %s' % (
+            pipes.quote(local_dir), command),
+        shell='/bin/bash')
+    size = 0
+    for path, _, file_names in os.walk(local_dir):
+        for file_name in file_names:
+            size += os.path.getsize(os.path.join(path, file_name))
+    record_transfer(remote_dir, size, size)
+    return size
+
+
+def stream_compressor(compression):
+    """Check whether a stream compressor can be used with the host.
+
+    :param compression: Name of a compressor in :data:`STREAM_COMPRESSORS`
+        or None for no compression.
+    :type compression: str
+
+    :returns: The name of the compressor if it is installed both locally and
+        on the host, otherwise None.
+    :rtype: str, None
+    """
+    if not compression:
+        return None
+    if compression not in STREAM_COMPRESSORS:
+        abort('Unknown compression %s, use one of %s' % (
+            compression, ', '.join(sorted(STREAM_COMPRESSORS))))
+    with hide('everything'), settings(warn_only=True):
+        available = (
+            local('which %s' % compression, capture=True).succeeded and
+            run('which %s' % compression).succeeded)
+    if not available:
+        fastprint(yellow(
+            '%s is not available, streaming without compression\n' %
+            compression))
+        return None
+    return compression
+
+
+def path_compressor(path):
+    """Get the compressor used for a file from its extension.
+
+    :param path: Path to the file.
+    :type path: str
+
+    :returns: Name of a compressor in :data:`STREAM_COMPRESSORS` or None.
+    :rtype: str, None
+    """
+    for compression, extension in STREAM_COMPRESSORS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+
+def report_throughput(path, sent, seconds, size=None):
+    """Report the throughput of a stream and add it to the per host totals.
+
+    :param path: Path of the file that was streamed.
+    :type path: str
+
+    :param sent: Number of bytes streamed.
+    :type sent: int
+
+    :param seconds: Duration of the stream.
+    :type seconds: float
+
+    :param size: Size of the file if only part of it was streamed.
+    :type size: int
+    """
+    if size is None:
+        size = sent
+    count_transfer(size, sent)
+    megabytes = sent / 1024.0 / 1024.0
+    fastprint(green('%s: %.1f MB in %.1f s (%.1f MB/s)\n' % (
+        path, megabytes, seconds, megabytes / max(seconds, 0.001))))
+
+
+def stream_from_host(command, local_path, compression=None):
+    """Stream the output of a remote command into a local file.
+
+    The output goes straight through the ssh channel into the local file,
+    nothing is written to the host's disk. The file is written under a
+    temporary name and only renamed once the command has succeeded.
+
+    :param command: Shell command to run on the host.
+    :type command: str
+
+    :param local_path: Path to the local file to write.
+    :type local_path: str
+
+    :param compression: Name of a compressor in :data:`STREAM_COMPRESSORS`
+        to compress the stream with on the host. The local file is stored
+        compressed.
+    :type compression: str
+
+    :returns: Number of bytes received.
+    :rtype: int
+    """
+    if compression:
+        # Without pipefail a failing command would look like a short but
+        # successful dump, since only the compressor's exit code counts
+        command = 'bash -o pipefail -c %s' % pipes.quote(
+            '%s | %s -c' % (command, compression))
+    partial_path = '%s.part' % local_path
+    start = time.time()
+    local(
+        'set -o pipefail; %s > %s' % (
+            ssh_command(command), pipes.quote(partial_path)),
+        shell='/bin/bash')
+    os.rename(partial_path, local_path)
+    size = os.path.getsize(local_path)
+    report_throughput(local_path, size, time.time() - start)
+    return size
+
+
+def stream_to_host(local_path, command):
+    """Stream a local file into a remote command.
+
+    Files compressed with one of :data:`STREAM_COMPRESSORS`, judging by
+    their extension, are sent compressed and decompressed on the host.
+
+    :param local_path: Path to the local file.
+    :type local_path: str
+
+    :param command: Shell command on the host that reads the file from its
+        standard input.
+    :type command: str
+
+    :returns: Number of bytes sent.
+    :rtype: int
+    """
+    compression = path_compressor(local_path)
+    if compression:
+        command = '%s -dc | %s' % (compression, command)
+    start = time.time()
+    local(
+        'set -o pipefail; %s < %s' % (
+            ssh_command(command), pipes.quote(local_path)),
+        shell='/bin/bash')
+    size = os.path.getsize(local_path)
+    report_throughput(local_path, size, time.time() - start)
+    return size
+
+
+def chunk_digests(path, chunk_size):
+    """Get the sha256 checksums of a local file and of each of its chunks.
+
+    :param path: Path to the local file.
+    :type path: str
+
+    :param chunk_size: Size of the chunks in bytes.
+    :type chunk_size: int
+
+    :returns: A tuple of the checksum of the whole file and a list with the
+        checksum of each chunk.
+    :rtype: tuple
+    """
+    digest = hashlib.sha256()
+    digests = []
+    with open(path, 'rb') as local_file:
+        while True:
+            chunk_digest = hashlib.sha256()
+            remaining = chunk_size
+            while remaining:
+                block = local_file.read(min(remaining, 1024 * 1024))
+                if not block:
+                    break
+                digest.update(block)
+                chunk_digest.update(block)
+                remaining -= len(block)
+            if remaining == chunk_size:
+                break
+            digests.append(chunk_digest.hexdigest())
+            if remaining:
+                break
+    return digest.hexdigest(), digests
+
+
+def run_chunk_jobs(function, jobs):
+    """Run chunk transfers, several at a time if configured.
+
+    :param function: Function transferring a single chunk, called with the
+        chunk index. It returns True if the chunk arrived intact.
+    :type function: function
+
+    :param jobs: Indexes of the chunks to transfer.
+    :type jobs: list
+
+    :returns: Indexes of the chunks that could not be transferred.
+    :rtype: list
+    """
+    workers = max(1, int(env.fg_transfer_jobs))
+    if workers == 1:
+        results = [function(index) for index in jobs]
+    else:
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(function, jobs)
+        finally:
+            pool.close()
+    return [index for index, ok in zip(jobs, results) if not ok]
+
+
+def chunked_upload(local_path, remote_path, use_sudo=False, mode=None):
+    """Upload a large file in verified chunks, resuming earlier attempts.
+
+    The file is assembled in ``<remote_path>.part``. Verified chunks are
+    listed in ``<remote_path>.part.chunks`` so that running the upload again
+    after an interruption only sends the chunks that are missing. The
+    complete file is checked once more before it is moved into place.
+
+    :param local_path: Path to the local file.
+    :type local_path: str
+
+    :param remote_path: Path to the remote file.
+    :type remote_path: str
+
+    :param use_sudo: Whether moving the file into place needs sudo rights.
+        The partial file is written as the ssh user, so its directory must
+        be writable by that user.
+    :type use_sudo: bool
+
+    :param mode: Optional file mode for the remote file e.g. 0755.
+    :type mode: int
+
+    :returns: Number of bytes sent.
+    :rtype: int
+    """
+    chunk_size = int(env.fg_chunk_size)
+    size = os.path.getsize(local_path)
+    digest, digests = chunk_digests(local_path, chunk_size)
+    partial_path = '%s.part' % remote_path
+    state_path = '%s.chunks' % partial_path
+    with hide('everything'), settings(warn_only=True):
+        state = run('cat %s' % state_path)
+    verified = set()
+    for line in state.splitlines():
+        # chunk size, index and checksum of every verified chunk
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == str(chunk_size):
+            index = int(parts[1])
+            if index < len(digests) and digests[index] == parts[2]:
+                verified.add(index)
+    missing = [
+        chunk for chunk in range(len(digests)) if chunk not in verified]
+    fastprint('%s: %i of %i chunks to send\n' % (
+        remote_path, len(missing), len(digests)))
+
+    def send_chunk(index):
+        """Send one chunk and check it on arrival."""
+        check = (
+            'dd of=%(part)s bs=%(size)i seek=%(index)i conv=notrunc '
+            '2>/dev/null && [ "$(dd if=%(part)s bs=%(size)i skip=%(index)i '
+            'count=1 2>/dev/null | sha256sum | cut -d \' \' -f 1)" = '
+            '%(digest)s ] && echo %(size)i %(index)i %(digest)s >> '
+            '%(state)s' % {
+                'part': partial_path,
+                'state': state_path,
+                'size': chunk_size,
+                'index': index,
+                'digest': digests[index]})
+        command = 'dd if=%s bs=%i skip=%i count=1 2>/dev/null | %s' % (
+            pipes.quote(local_path), chunk_size, index, ssh_command(check))
+        return subprocess.call(
+            ['/bin/bash', '-o', 'pipefail', '-c', command]) == 0
+
+    start = time.time()
+    failed = run_chunk_jobs(send_chunk, missing)
+    if failed:
+        abort('Chunks %s of %s could not be sent, run the task again to '
+              'resume the upload.' % (
+                  ', '.join(str(index) for index in failed), remote_path))
+    func = sudo if use_sudo else run
+    with hide('output'):
+        result = run('truncate -s %i %s && sha256sum %s' % (
+            size, partial_path, partial_path))
+    if result.split()[0] != digest:
+        run('rm -f %s %s' % (partial_path, state_path))
+        abort('%s did not arrive intact, run the task again.' % remote_path)
+    func('mv %s %s' % (partial_path, remote_path))
+    run('rm -f %s' % state_path)
+    if mode is not None:
+        func('chmod %o %s' % (mode, remote_path))
+    sent = min(size, len(missing) * chunk_size)
+    report_throughput(remote_path, sent, time.time() - start, size)
+    return sent
+
+
+def chunked_download(remote_path, local_path):
+    """Download a large file in verified chunks, resuming earlier attempts.
+
+    This is the reverse of :func:`chunked_upload`. The file is assembled in
+    ``<local_path>.part`` with the verified chunks listed in
+    ``<local_path>.part.chunks``.
+
+    :param remote_path: Path to the remote file.
+    :type remote_path: str
+
+    :param local_path: Path to the local file.
+    :type local_path: str
+
+    :returns: Number of bytes received.
+    :rtype: int
+    """
+    chunk_size = int(env.fg_chunk_size)
+    # Checksums of the whole file and of each chunk in one round trip
+    with hide('output'):
+        output = run(
+            'size=$(stat -c %%s %(path)s) && sha256sum %(path)s && '
+            'i=0; while [ $((i * %(chunk)i)) -lt $size ]; do '
+            'dd if=%(path)s bs=%(chunk)i skip=$i count=1 2>/dev/null | '
+            'sha256sum; i=$((i + 1)); done; echo size $size' % {
+                'path': remote_path, 'chunk': chunk_size})
+    lines = output.splitlines()
+    digest = lines[0].split()[0]
+    digests = [line.split()[0] for line in lines[1:-1]]
+    size = int(lines[-1].split()[1])
+    partial_path = '%s.part' % local_path
+    state_path = '%s.chunks' % partial_path
+    verified = set()
+    if os.path.exists(state_path):
+        with open(state_path) as state_file:
+            for line in state_file:
+                parts = line.split()
+                if len(parts) == 3 and parts[0] == str(chunk_size):
+                    index = int(parts[1])
+                    if index < len(digests) and digests[index] == parts[2]:
+                        verified.add(index)
+    if not os.path.exists(partial_path):
+        open(partial_path, 'wb').close()
+        verified = set()
+    missing = [
+        chunk for chunk in range(len(digests)) if chunk not in verified]
+    fastprint('%s: %i of %i chunks to fetch\n' % (
+        remote_path, len(missing), len(digests)))
+
+    def fetch_chunk(index):
+        """Fetch one chunk and check it on arrival."""
+        command = (
+            '%s | dd of=%s bs=%i seek=%i conv=notrunc 2>/dev/null' % (
+                ssh_command('dd if=%s bs=%i skip=%i count=1 2>/dev/null' % (
+                    remote_path, chunk_size, index)),
+                pipes.quote(partial_path), chunk_size, index))
+        if subprocess.call(
+                ['/bin/bash', '-o', 'pipefail', '-c', command]) != 0:
+            return False
+        chunk_digest = hashlib.sha256()
+        with open(partial_path, 'rb') as partial_file:
+            partial_file.seek(index * chunk_size)
+            chunk_digest.update(partial_file.read(chunk_size))
+        if chunk_digest.hexdigest() != digests[index]:
+            return False
+        with open(state_path, 'a') as state_file:
+            state_file.write('%i %i %s\n' % (
+                chunk_size, index, digests[index]))
+        return True
+
+    start = time.time()
+    failed = run_chunk_jobs(fetch_chunk, missing)
+    if failed:
+        abort('Chunks %s of %s could not be fetched, run the task again to '
+              'resume the download.' % (
+                  ', '.join(str(index) for index in failed), remote_path))
+    with open(partial_path, 'r+b') as partial_file:
+        partial_file.truncate(size)
+    if chunk_digests(partial_path, chunk_size)[0] != digest:
+        os.remove(partial_path)
+        os.remove(state_path)
+        abort('%s did not arrive intact, run the task again.' % remote_path)
+    os.rename(partial_path, local_path)
+    os.remove(state_path)
+    received = min(size, len(missing) * chunk_size)
+    report_throughput(local_path, received, time.time() - start, size)
+    return received
+
+
+def download_file(remote_path, local_path):
+    """Download a file, in resumable chunks if it is large.
+
+    :param remote_path: Path to the remote file.
+    :type remote_path: str
+
+    :param local_path: Path to the local file.
+    :type local_path: str
+    """
+    with hide('everything'), settings(warn_only=True):
+        size = run('stat -c %%s %s' % remote_path)
+    if size.succeeded and int(size) >= int(env.fg_chunk_threshold):
+        chunked_download(remote_path, local_path)
+    else:
+        get(remote_path, local_path)
@@ -8,7 +8,7 @@ import os
 from fabric.api import task, fastprint
 from fabric.colors import cyan
 from fabric.contrib.files import contains, append
-from fabtools import fabtools
+from .packages import require_package
 
 
 @task
@@ -17,7 +17,7 @@ def setup_mapserver():
     fastprint(cyan('Setting up UMN Mapserver\n'))
     # Clone and replace tokens in mapserver map file
     # Clone and replace tokens in mapserver conf
-    fabtools.require.deb.package('cgi-mapserver')
+    require_package('cgi-mapserver')
     # We also need to append 900913 epsg code to the proj epsg list
     epsg_path = '/usr/share/proj/epsg'
     epsg_code = (
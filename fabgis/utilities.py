@@ -1,8 +1,110 @@
 # coding=utf-8
 """General utilities."""
 import os
-from fabric.api import cd, sudo
+import re
+from StringIO import StringIO
+from fabric.api import sudo, run, get, hide, settings
 from fabric.contrib.files import contains, append
+from .transfer import upload_content
+
+
+def resource_path(*parts):
+    """Get the local path of a file in the fabgis_resources directory.
+
+    :param parts: Path components under fabgis_resources e.g.
+        ``'server_config', 'cron', 'pg_backups.py.templ'``.
+    :type parts: str
+
+    :returns: Absolute path to the resource.
+    :rtype: str
+    """
+    return os.path.abspath(os.path.join(
+        os.path.dirname(__file__),
+        '..',
+        '../fabgis_resources',
+        *parts))
+
+
+def render_tokens(text, tokens):
+    """Replace [TOKEN] style tokens in some text in a single pass.
+
+    Values are inserted literally, so unlike the sed based
+    :func:`replace_tokens` they need no escaping of slashes or other
+    special characters, and a value that itself looks like a token is
+    never replaced again.
+
+    :param text: Text containing tokens e.g. 'Hello [USER]'.
+    :type text: str
+
+    :param tokens: A dictionary of token names (without square brackets)
+        and the values they should be replaced with.
+    :type tokens: dict
+
+    :returns: The text with all known tokens replaced.
+    :rtype: str
+    """
+    if not tokens:
+        return text
+    pattern = re.compile(r'\[(%s)\]' % '|'.join(
+        re.escape(key) for key in tokens))
+    return pattern.sub(lambda match: str(tokens[match.group(1)]), text)
+
+
+def render_template(template_path, tokens):
+    """Render a local [TOKEN] style template e.g. from fabgis_resources.
+
+    :param template_path: Local path to the template file.
+    :type template_path: str
+
+    :param tokens: A dictionary of key-values that should be replaced
+        in the template.
+    :type tokens: dict
+
+    :returns: The rendered template.
+    :rtype: str
+    """
+    with open(template_path) as template_file:
+        return render_tokens(template_file.read(), tokens)
+
+
+def upload_template_file(
+        template_path, remote_path, tokens, use_sudo=False, mode=None):
+    """Render a [TOKEN] style template locally and upload it in one transfer.
+
+    :param template_path: Local path to the template file.
+    :type template_path: str
+
+    :param remote_path: Path to the remote file that should be written.
+    :type remote_path: str
+
+    :param tokens: A dictionary of key-values that should be replaced
+        in the template.
+    :type tokens: dict
+
+    :param use_sudo: Whether the upload needs sudo rights.
+    :type use_sudo: bool
+
+    :param mode: Optional file mode for the remote file e.g. 0755.
+    :type mode: int
+
+    :returns: True if the file was uploaded, False if it was up to date.
+    :rtype: bool
+
+    Example::
+
+        upload_template_file(
+            resource_path('server_config', 'cron', 'pg_backups.py.templ'),
+            '/etc/cron.daily/pg_backups',
+            {'USER': env.fg.user},
+            use_sudo=True,
+            mode=0755)
+
+    """
+    return upload_content(
+        render_template(template_path, tokens),
+        remote_path,
+        use_sudo=use_sudo,
+        mode=mode)
 
 
 def append_if_not_present(filename, text, use_sudo=False):
@@ -20,6 +122,129 @@ def append_if_not_present(filename, text, use_sudo=False):
         append(filename, text, use_sudo=use_sudo)
 
 
+def shell_quote(text):
+    """Quote text so that the shell treats it as a single literal word.
+
+    :param text: Text to quote.
+    :type text: str
+
+    :returns: The text in single quotes with embedded single quotes escaped.
+    :rtype: str
+    """
+    return "'%s'" % text.replace("'", "'\\''")
+
+
+def as_bool(value):
+    """Interpret a task argument as a boolean.
+
+    Arguments given on the fab command line are strings, so
+    ``fab foo:restart=False`` passes 'False' which is true in python.
+
+    :param value: Value of the argument e.g. True, 'False', 'no' or '1'.
+    :type value: bool, str
+
+    :returns: The boolean the value stands for.
+    :rtype: bool
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower() in ['true', 'yes', 'y', 'on', '1']
+    return bool(value)
+
+
+def ensure_lines(path, lines, use_sudo=False):
+    """Make sure a remote file contains all of the given lines.
+
+    The file is read once, the missing lines are determined locally and then
+    appended in a single remote command. The lines are appended to a copy of
+    the file which then atomically replaces the original, so a failed or
+    interrupted edit never leaves a half written file behind.
+
+    A line counts as present when the file has a line that is identical
+    ignoring leading and trailing white space. The file is created if it
+    does not exist.
+
+    :param path: Path to the remote file.
+    :type path: str
+
+    :param lines: Lines that should be present, in the order they should be
+        appended if missing.
+    :type lines: list
+
+    :param use_sudo: Run the commands as sudo.
+    :type use_sudo: bool
+
+    :returns: The lines that were appended.
+    :rtype: list
+
+    Example::
+
+        ensure_lines(
+            '/etc/sysctl.conf',
+            ['net.ipv4.tcp_syncookies = 1', 'net.ipv4.tcp_synack_retries = 2'],
+            use_sudo=True)
+
+    """
+    func = sudo if use_sudo else run
+    with hide('everything'), settings(warn_only=True):
+        content = func('cat %s' % path, pty=False)
+    if content.failed:
+        content = ''
+    present = set(line.strip() for line in content.splitlines())
+    missing = []
+    for line in lines:
+        if line.strip() not in present and line not in missing:
+            missing.append(line)
+    if not missing:
+        return missing
+
+    temp_path = '%s.fabgis.tmp' % path
+    command = (
+        '(cp -p %(path)s %(temp)s 2>/dev/null || touch %(temp)s) && '
+        # Make sure we start on a new line
+        '([ -z "$(tail -c 1 %(temp)s)" ] || echo >> %(temp)s) && '
+        'printf \'%%s\\n\' %(lines)s >> %(temp)s && '
+        'mv %(temp)s %(path)s' % {
+            'path': path,
+            'temp': temp_path,
+            'lines': ' '.join(shell_quote(line) for line in missing)})
+    with hide('running'):
+        func(command)
+    return missing
+
+
+def ensure_replacements(path, replacements, use_sudo=False, backup='.bak'):
+    """Apply several sed style replacements to a remote file in one command.
+
+    This is equivalent to calling ``fabric.contrib.files.sed`` once for each
+    replacement, but runs a single ``sed`` with one expression per
+    replacement.
+
+    :param path: Path to the remote file.
+    :type path: str
+
+    :param replacements: A list of (before, after) tuples. ``before`` is an
+        extended regular expression and every match of it is replaced with
+        ``after``.
+    :type replacements: list
+
+    :param use_sudo: Run the command as sudo.
+    :type use_sudo: bool
+
+    :param backup: Suffix for the backup copy sed makes of the file. Use ''
+        to skip the backup.
+    :type backup: str
+    """
+    if not replacements:
+        return
+    expressions = []
+    for before, after in replacements:
+        expression = 's/%s/%s/g' % (
+            before.replace('/', r'\/'), after.replace('/', r'\/'))
+        expressions.append('-e %s' % shell_quote(expression))
+    func = sudo if use_sudo else run
+    func('sed -i%s -r %s %s' % (backup, ' '.join(expressions), path))
+
+
 def replace_tokens(conf_file, tokens):
     """Deprecated: prepare a template config file by replacing its tokens.
 
@@ -46,30 +271,21 @@ def replace_tokens(conf_file, tokens):
             'SITENAME': sitename,  # Choosen name of jenkins 'root'
         }
 
-    .. deprecated:: You should use fabric.contrib.files.upload_template rather.
-    """
+    .. deprecated:: You should use :func:`upload_template_file` rather,
+        which renders the template locally before uploading it.
 
+    .. versionchanged:: The file is now fetched once, all tokens are replaced
+        locally in a single pass and the result is uploaded once, rather than
+        running a remote sed per token.
+    """
     if '.templ' == conf_file[-6:]:
         templ_file = conf_file
         conf_file = conf_file.replace('.templ', '')
-        sudo(
-            'cp %(templ_file)s %(conf_file)s' % {
-            'templ_file': templ_file,
-            'conf_file': conf_file})
-
-    base_path, file_name = os.path.split(conf_file)
-    if base_path is not '':
-        # The file is not in the current working dir.
-        with cd(base_path):
-            for key, value in tokens.iteritems():
-                sudo('sed -i.bak -r -e "s/\[%s\]/%s/g" %s' % (
-                    key, value, file_name))
-            sudo('rm %s.bak' % file_name)
     else:
-        # filename only, not full path - assumes the current working dir is
-        # the same as where the conf file is located
-        for key, value in tokens.iteritems():
-            sudo('sed -i.bak -r -e "s/\[%s\]/%s/g" %s' % (
-                key, value, file_name))
-            sudo('rm %s.bak' % file_name)
+        templ_file = conf_file
+
+    template = StringIO()
+    get(templ_file, template)
+    upload_content(
+        render_tokens(template.getvalue(), tokens), conf_file, use_sudo=True)
     return conf_file
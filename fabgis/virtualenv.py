@@ -5,10 +5,10 @@ import os
 from fabric.api import fastprint, run, cd, task
 from fabric.contrib.files import sed
 from fabric.colors import blue, green
-from fabtools.require.deb import packages as require_packages
 from fabtools.require.python import virtualenv
 
 from .common import setup_env
+from .packages import require_packages
 
 
 @task